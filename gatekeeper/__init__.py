@@ -0,0 +1,27 @@
+"""GateKeeper backend components
+Purpose: the pieces of the backend that keep state of their own next to the Flask routes in server.py, such as the
+in-memory caches used by the gateway ingest path.
+
+Usage: server.py builds each component with the shared connection pool and wires it to its routes.
+"""
+
+from .notifications import NotificationListener
+from .beacons import Beacon, BeaconRegistry, BEACON_CHANNEL
+from .tag_state import TagState, TagStateEngine, Movement
+from .tag_state import ADVERTISEMENT_ACCEPTED, ADVERTISEMENT_DUPLICATE, ADVERTISEMENT_IGNORED
+from .ingest_queue import IngestQueue
+from .decoder import Advertisement, decode_payload, decode_device_list, PRESENCE_PACKET
+from .ingest import Ingestor, ProcedureIngestor, BATTERY_MAX_MILLIVOLTS
+from .sharding import ShardedIngest, shard_of
+from .spawning import spawn_context
+from .dedup import DuplicateCache
+from .framing import decompress_body, decode_frames, encode_frames, FramingError, FRAMES_CONTENT_TYPE
+from .archive import ArchiveWriter, ArchiveRecord, read_segment, read_archive
+from .live import PresenceFeed, PRESENCE_CHANNEL, RESYNC
+from .counts import CountCache, RowCount
+from .partitions import PartitionMaintainer
+from .typeahead import TypeaheadIndex, LOOKUP_CHANNEL
+from .exports import ExportColumn, write_xlsx, copy_statement
+from .export_jobs import ExportJobs, ExportJob
+from .attendance import AttendanceRollup
+from .occupancy import OccupancyTracker, RESOLUTIONS
@@ -0,0 +1,234 @@
+"""Raw advertisement archive
+Purpose: keeps every decoded advertisement received by the gateway endpoint, before any decision is taken on it, so
+that history can be reprocessed after a beacon misconfiguration and the ingest logic can be benchmarked on real
+traffic. Advertisements are stored as fixed-width records in append-only segment files, which are rotated after a
+set number of records. The endpoint only hands the decoded advertisements over to a background thread, which packs
+and writes them in batches, so archiving adds next to nothing to the request.
+
+Usage: build an ArchiveWriter with the archive directory, call start() at startup and stop() at shutdown, then
+append() the advertisements of every gateway message together with their scan times and the gateway address.
+read_segment() and read_archive() read the records back through mmap, as ArchiveRecord tuples, and
+ArchiveRecord.advertisement() turns a record back into the Advertisement the ingest engine expects.
+
+Segment layout: a 16 byte header (SEGMENT_MAGIC, then the record size as a little endian 32 bit integer and 4 unused
+bytes) followed by records of RECORD_SIZE bytes: received_at (unix time, double), scan_time (unsigned 32 bit),
+gateway address (16 bytes, IPv4 addresses are mapped to IPv6), echobeacon number, packet type, packet counter, tag MAC
+address (6 bytes), RSSI, flags and TLM voltage, little endian and padded to 48 bytes.
+"""
+
+import ipaddress
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+from datetime import datetime
+from typing import NamedTuple
+
+from .decoder import Advertisement, TLM_FLAG
+
+SEGMENT_MAGIC = b"GKARCH01"
+_SEGMENT_HEADER_STRUCT = struct.Struct("<8sI4x")
+SEGMENT_HEADER_SIZE = _SEGMENT_HEADER_STRUCT.size
+
+_RECORD_STRUCT = struct.Struct("<dI16sHBB6sbBH6x")
+RECORD_SIZE = _RECORD_STRUCT.size
+
+_new_advertisement = tuple.__new__
+
+
+class ArchiveRecord(NamedTuple):
+    received_at: float
+    scan_time: int
+    gateway: str
+    beacon_number: int
+    packet_type: int
+    packet_counter: int
+    mac_address: str
+    rssi: int
+    flags: int
+    voltage: int
+
+    def advertisement(self):
+        return _new_advertisement(Advertisement, (
+            self.beacon_number, self.packet_type, self.packet_counter, self.mac_address,
+            self.rssi, bool(self.flags & TLM_FLAG), self.voltage
+        ))
+
+
+def _packed_gateway(address):
+    try:
+        ip = ipaddress.ip_address(address)
+    except ValueError:
+        return bytes(16)
+    if ip.version == 4:
+        ip = ipaddress.IPv6Address(b"\0" * 10 + b"\xff\xff" + ip.packed)
+    return ip.packed
+
+
+def _gateway_address(packed):
+    ip = ipaddress.IPv6Address(packed)
+    return str(ip.ipv4_mapped or ip)
+
+
+def _scan_time(value):
+    try:
+        return min(max(int(value), 0), 0xFFFFFFFF)
+    except (TypeError, ValueError):
+        return 0
+
+
+class ArchiveWriter:
+    # Pending gateway messages above this are dropped (and counted) rather than letting the buffer grow forever
+    MAX_PENDING_MESSAGES = 100000
+
+    def __init__(self, directory, segment_records=1000000, flush_interval=1.0):
+        self.directory = directory
+        self.segment_records = segment_records
+        self.flush_interval = flush_interval
+        self._pending = deque()  # (received_at, gateway, advertisements, scan_times)
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._file = None
+        self._segment_path = None
+        self._segment_written = 0
+        self._counters = {
+            "records": 0,
+            "segments": 0,
+            "dropped_messages": 0,
+            "failed_writes": 0
+        }
+
+    def append(self, advertisements, scan_times, gateway):
+        """Queue the advertisements of a gateway message. Undecodable devices (None) are skipped when written."""
+        if len(self._pending) >= self.MAX_PENDING_MESSAGES:
+            with self._lock:
+                self._counters["dropped_messages"] += 1
+            return
+        self._pending.append((time.time(), gateway, advertisements, scan_times))
+
+    def start(self):
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name="advertisement-archive", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _run(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error in advertisement archive: {e}")
+
+    def _open_segment(self):
+        if self._file is not None:
+            self._file.close()
+        name = f"segment-{datetime.now().strftime('%Y%m%d-%H%M%S-%f')}.gka"
+        self._segment_path = os.path.join(self.directory, name)
+        self._file = open(self._segment_path, "xb")
+        self._file.write(_SEGMENT_HEADER_STRUCT.pack(SEGMENT_MAGIC, RECORD_SIZE))
+        self._segment_written = 0
+        with self._lock:
+            self._counters["segments"] += 1
+
+    def flush(self):
+        """Pack and write everything queued so far. Only the writer thread, or stop(), calls this."""
+        pack = _RECORD_STRUCT.pack
+        records = []
+        gateways = {}
+        while self._pending:
+            received_at, gateway, advertisements, scan_times = self._pending.popleft()
+            packed_gateway = gateways.get(gateway)
+            if packed_gateway is None:
+                packed_gateway = gateways[gateway] = _packed_gateway(gateway)
+            for advertisement, scan_time in zip(advertisements, scan_times):
+                if advertisement is None:
+                    continue
+                records.append(pack(
+                    received_at, _scan_time(scan_time), packed_gateway, advertisement.beacon_number,
+                    advertisement.packet_type, advertisement.packet_counter, bytes.fromhex(advertisement.mac_address),
+                    advertisement.rssi, TLM_FLAG if advertisement.tlm else 0, advertisement.voltage
+                ))
+        if not records:
+            return 0
+
+        try:
+            start = 0
+            while start < len(records):
+                if self._file is None or self._segment_written >= self.segment_records:
+                    self._open_segment()
+                chunk = records[start:start + self.segment_records - self._segment_written]
+                self._file.write(b"".join(chunk))
+                self._segment_written += len(chunk)
+                start += len(chunk)
+            self._file.flush()
+        except Exception:
+            with self._lock:
+                self._counters["failed_writes"] += 1
+            raise
+        with self._lock:
+            self._counters["records"] += len(records)
+        return len(records)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "pending_messages": len(self._pending),
+                "segment": self._segment_path,
+                **self._counters
+            }
+
+
+def read_segment(path):
+    """Yield the ArchiveRecords of a segment file, read through mmap. A partially written last record is skipped."""
+    with open(path, "rb") as f:
+        size = os.fstat(f.fileno()).st_size
+        if size <= SEGMENT_HEADER_SIZE:
+            return
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as data:
+            magic, record_size = _SEGMENT_HEADER_STRUCT.unpack_from(data, 0)
+            if magic != SEGMENT_MAGIC or record_size != RECORD_SIZE:
+                raise Exception(f"{path} is not an advertisement archive segment")
+            end = SEGMENT_HEADER_SIZE + (size - SEGMENT_HEADER_SIZE) // RECORD_SIZE * RECORD_SIZE
+            gateways = {}
+            view = memoryview(data)[SEGMENT_HEADER_SIZE:end]
+            rows = _RECORD_STRUCT.iter_unpack(view)
+            try:
+                for received_at, scan_time, packed_gateway, beacon_number, packet_type, packet_counter, mac, rssi, \
+                        flags, voltage in rows:
+                    gateway = gateways.get(packed_gateway)
+                    if gateway is None:
+                        gateway = gateways[packed_gateway] = _gateway_address(packed_gateway)
+                    yield _new_advertisement(ArchiveRecord, (
+                        received_at, scan_time, gateway, beacon_number, packet_type, packet_counter,
+                        mac.hex().upper(), rssi, flags, voltage
+                    ))
+            finally:
+                # The mmap can only be closed once nothing points into it anymore
+                del rows
+                view.release()
+
+
+def segment_files(directory):
+    return sorted(
+        os.path.join(directory, name) for name in os.listdir(directory)
+        if name.startswith("segment-") and name.endswith(".gka")
+    )
+
+
+def read_archive(directory):
+    """Yield the ArchiveRecords of every segment in the directory, oldest segment first."""
+    for path in segment_files(directory):
+        yield from read_segment(path)
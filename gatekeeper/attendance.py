@@ -0,0 +1,105 @@
+"""Daily attendance rollup
+Purpose: daily_attendance (migrations/008_daily_attendance.sql) holds the hours on site of every crew member in every
+shipyard day by day, for the attendance report and its exports. The logs closed by the ingest are added to it by the
+database as they close; every other change to the logs only marks its days as dirty, and this counts the dirty days
+again from the logs, from a thread of its own: as soon as it is asked to with request_refresh(), which the web routes
+that change the logs call without waiting for it, and every night, for the changes made anywhere else. Every run of
+consecutive dirty days is counted in transactions of its own, so that the logs closing meanwhile, which wait for the
+refresh of their days, wait for one run at most.
+
+Usage: build it with the pool and the hour of the night to run at, call start() at startup and stop() at shutdown.
+request_refresh() wakes the thread, refresh_dirty() counts the dirty days right away, refresh(first_day, last_day)
+counts a range of days again whatever they are marked as, a month per transaction, e.g. after loading logs with the
+triggers disabled.
+"""
+
+import threading
+from datetime import date, datetime, timedelta
+
+
+class AttendanceRollup:
+    def __init__(self, pool, refresh_hour=3):
+        self.pool = pool
+        self.refresh_hour = refresh_hour
+        self._stop = threading.Event()
+        # Set by stop() and request_refresh(), wakes the thread before the night
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {"refreshes": 0, "days_refreshed": 0, "failed_rounds": 0}
+        self._last_round = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="attendance-refresh", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def request_refresh(self):
+        """Have the thread count the dirty days again as soon as it can, without waiting for it"""
+        self._wake.set()
+
+    def _seconds_to_night(self):
+        now = datetime.now()
+        night = now.replace(hour=self.refresh_hour, minute=0, second=0, microsecond=0)
+        if night <= now:
+            night += timedelta(days=1)
+        return (night - now).total_seconds()
+
+    def _run(self):
+        # The first round runs at startup, for the days marked while the server was down
+        while True:
+            # Cleared first, so that the days marked while the round runs get a round of their own
+            self._wake.clear()
+            try:
+                self.refresh_dirty()
+                with self._lock:
+                    self._last_round = datetime.now()
+            except Exception as e:
+                with self._lock:
+                    self._counters["failed_rounds"] += 1
+                print(f"Error in attendance refresh: {e}")
+            self._wake.wait(self._seconds_to_night())
+            if self._stop.is_set():
+                return
+
+    def refresh_dirty(self):
+        """Count the dirty days again, a run of consecutive days at a time, returns how many"""
+        with self.pool.connection() as conn:
+            runs = conn.execute("SELECT first_day, last_day FROM dirty_attendance_runs()").fetchall()
+        days = 0
+        for run in runs:
+            self.refresh(run["first_day"], run["last_day"])
+            days += (run["last_day"] - run["first_day"]).days + 1
+        with self._lock:
+            self._counters["refreshes"] += 1
+        return days
+
+    def refresh(self, first_day, last_day):
+        """Count the days from first_day to last_day again, returns the rows written"""
+        rows = 0
+        month = date(first_day.year, first_day.month, 1)
+        while month <= last_day:
+            next_month = (month + timedelta(days=32)).replace(day=1)
+            # A transaction per month, so that the logs closing meanwhile wait for one month at most
+            with self.pool.connection() as conn:
+                rows += conn.execute(
+                    "SELECT refresh_daily_attendance(%s, %s) AS rows",
+                    (max(first_day, month), min(last_day, next_month - timedelta(days=1)))
+                ).fetchone()["rows"]
+            month = next_month
+        with self._lock:
+            self._counters["days_refreshed"] += (last_day - first_day).days + 1
+        return rows
+
+    def stats(self):
+        with self._lock:
+            return {
+                "refresh_hour": self.refresh_hour,
+                "last_round": self._last_round.isoformat() if self._last_round else None,
+                **self._counters
+            }
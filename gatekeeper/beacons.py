@@ -0,0 +1,54 @@
+"""Activator beacon registry
+Purpose: the activator_beacon table holds at most two rows per shipyard and almost never changes, so the ingest path
+reads it from memory instead of querying it for every advertisement.
+
+Usage: build it with the connection pool, call load() at startup and subscribe reload() to BEACON_CHANNEL on a
+NotificationListener, so edits made to the table (the trg_activator_beacon_notify trigger) refresh it.
+"""
+
+from typing import NamedTuple
+
+# Channel notified by the trg_activator_beacon_notify trigger
+BEACON_CHANNEL = "activator_beacon_changed"
+
+
+class Beacon(NamedTuple):
+    id: int
+    shipyard_id: int
+    is_first_when_entering: bool
+
+
+class BeaconRegistry:
+    def __init__(self, pool):
+        self.pool = pool
+        # (friendly_number -> Beacon, id -> Beacon), swapped as a whole so readers never need a lock
+        self._beacons = None
+
+    def load(self):
+        with self.pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT id, friendly_number, shipyard_id, is_first_when_entering
+                FROM activator_beacon
+            """).fetchall()
+        by_friendly_number = {}
+        by_id = {}
+        for row in rows:
+            beacon = Beacon(row['id'], row['shipyard_id'], row['is_first_when_entering'])
+            by_id[beacon.id] = beacon
+            if row['friendly_number'] is not None:
+                by_friendly_number[row['friendly_number']] = beacon
+        self._beacons = (by_friendly_number, by_id)
+
+    def reload(self, payload=None):
+        self.load()
+
+    def _tables(self):
+        if self._beacons is None:
+            self.load()
+        return self._beacons
+
+    def by_friendly_number(self, friendly_number):
+        return self._tables()[0].get(friendly_number)
+
+    def by_id(self, beacon_id):
+        return self._tables()[1].get(beacon_id)
@@ -0,0 +1,91 @@
+"""Table count cache
+Purpose: the HTMX tables show how many rows match their filters, which takes a COUNT(*) over the same joins as the
+rows themselves. The count is only needed on the first page of a filter set, and it is kept here for a short time
+to last across the typeahead keystrokes that repeat the same filters and the reloads of the same page. Writes that
+may change a count invalidate it: the web routes invalidate everything, the presence notifications of the ingest
+only the table they wrote to.
+
+Usage: build it with the time to live, key the counts with key(table_type, filters), get() before counting, and
+put() the count with the generation() read before counting, so that a count started before an invalidation is not
+stored after it. Subscribe notify() to PRESENCE_CHANNEL on a NotificationListener, and call invalidate() after
+the other writes.
+"""
+
+import json
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple
+
+
+class RowCount(NamedTuple):
+    value: int
+    # From the planner statistics instead of counting, shown as a lower bound
+    estimated: bool = False
+
+
+class CountCache:
+    def __init__(self, ttl=10.0, max_entries=1000):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._counts = OrderedDict()  # (table_type, filters) -> (monotonic expiry, RowCount)
+        self._generations = {}  # table_type -> invalidations so far
+        self._generation = 0  # invalidations of every table so far
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @staticmethod
+    def key(table_type, filters):
+        """Filters that only differ by blanks, empty values or case count the same rows"""
+        return table_type, tuple(sorted(
+            (name, str(value).strip().lower()) for name, value in filters.items() if value and str(value).strip()
+        ))
+
+    def generation(self, table_type):
+        with self._lock:
+            return self._generation, self._generations.get(table_type, 0)
+
+    def get(self, key):
+        now = time.monotonic()
+        with self._lock:
+            entry = self._counts.get(key)
+            if entry is None or entry[0] <= now:
+                self._misses += 1
+                return None
+            self._hits += 1
+            return entry[1]
+
+    def put(self, key, count, generation):
+        with self._lock:
+            if generation != (self._generation, self._generations.get(key[0], 0)):
+                return
+            self._counts[key] = (time.monotonic() + self.ttl, count)
+            self._counts.move_to_end(key)
+            while len(self._counts) > self.max_entries:
+                self._counts.popitem(last=False)
+
+    def invalidate(self, table_type=None):
+        """Forget the counts of a table type, or of all of them"""
+        with self._lock:
+            if table_type is None:
+                self._generation += 1
+                self._counts.clear()
+                return
+            self._generations[table_type] = self._generations.get(table_type, 0) + 1
+            for key in [key for key in self._counts if key[0] == table_type]:
+                del self._counts[key]
+
+    def notify(self, payload):
+        """NotificationListener callback for PRESENCE_CHANNEL: None after a reconnection, when anything may have changed"""
+        self.invalidate(json.loads(payload)["table"] if payload is not None else None)
+
+    def stats(self):
+        with self._lock:
+            lookups = self._hits + self._misses
+            return {
+                "entries": len(self._counts),
+                "hits": self._hits,
+                "misses": self._misses,
+                "hit_ratio": self._hits / lookups if lookups else 0.0
+            }
@@ -0,0 +1,95 @@
+"""Gateway payload decoder
+Purpose: decodes the hex "data" field of the devices in a gateway device_list into compact Advertisement records,
+converting every payload with bytes.fromhex and a single precompiled struct instead of slicing and parsing the hex
+string field by field.
+
+Usage: call decode_device_list() with the device_list of a gateway message. The result has one entry per device,
+in the same order, which is None for the devices whose payload is missing or malformed. When all the payloads of
+the list have the same length, which is the normal case, the whole list is converted at once.
+"""
+
+import struct
+from typing import NamedTuple
+
+# The gateway prepends its own 8 byte header to the advertisement
+GATEWAY_HEADER_SIZE = 8
+
+# Echobeacon number, packet type, packet counter, tag MAC address, RSSI, flags, TLM voltage (millivolts)
+_ADVERTISEMENT_STRUCT = struct.Struct(">HBB6sbBH")
+ADVERTISEMENT_SIZE = _ADVERTISEMENT_STRUCT.size
+
+PRESENCE_PACKET = 0x03
+TLM_FLAG = 0x04
+
+
+class Advertisement(NamedTuple):
+    beacon_number: int
+    packet_type: int
+    packet_counter: int
+    mac_address: str
+    rssi: int
+    tlm: bool
+    voltage: int
+
+
+def decode_payload(payload):
+    """Decode a single hex payload, header included. Returns None if it is missing or malformed."""
+    if not payload or not isinstance(payload, str):
+        return None
+    try:
+        raw = bytes.fromhex(payload)
+    except ValueError:
+        return None
+    # bytes.fromhex skips whitespace, which would shift the MAC address slice below
+    if len(raw) * 2 != len(payload) or len(raw) < GATEWAY_HEADER_SIZE + ADVERTISEMENT_SIZE:
+        return None
+    beacon_number, packet_type, packet_counter, _, rssi, flags, voltage = _ADVERTISEMENT_STRUCT.unpack_from(
+        raw, GATEWAY_HEADER_SIZE
+    )
+    # In upper case like the binary frames and the tag table (migrations/010_tag_mac_uppercase.sql), since tags are
+    # matched on the string
+    mac_start = (GATEWAY_HEADER_SIZE + 4) * 2
+    mac_address = payload[mac_start:mac_start + 12].upper()
+    return Advertisement(beacon_number, packet_type, packet_counter, mac_address, rssi, bool(flags & TLM_FLAG), voltage)
+
+
+# Structs used by decode_device_list, by payload size in bytes
+_BATCH_STRUCTS = {}
+_new_advertisement = tuple.__new__
+
+
+def _batch_struct(payload_size):
+    struct_ = _BATCH_STRUCTS.get(payload_size)
+    if struct_ is None:
+        trailing = payload_size - GATEWAY_HEADER_SIZE - ADVERTISEMENT_SIZE
+        struct_ = _BATCH_STRUCTS[payload_size] = struct.Struct(f">{GATEWAY_HEADER_SIZE}xHBB6sbBH{trailing}x")
+    return struct_
+
+
+def decode_device_list(device_list):
+    payloads = [device.get("data") if isinstance(device, dict) else None for device in device_list]
+
+    # Fast path: when every payload has the same length, convert the whole list with a single bytes.fromhex
+    # and unpack it with struct.iter_unpack
+    if payloads and all(isinstance(payload, str) for payload in payloads):
+        hex_size = len(payloads[0])
+        if hex_size % 2 == 0 and hex_size >= (GATEWAY_HEADER_SIZE + ADVERTISEMENT_SIZE) * 2 \
+                and all(len(payload) == hex_size for payload in payloads):
+            joined = "".join(payloads)
+            try:
+                raw = bytes.fromhex(joined)
+            except ValueError:
+                raw = None
+            if raw is not None and len(raw) * 2 == len(joined):
+                mac_start = (GATEWAY_HEADER_SIZE + 4) * 2
+                mac_end = mac_start + 12
+                return [
+                    _new_advertisement(Advertisement, (
+                        beacon_number, packet_type, packet_counter, payload[mac_start:mac_end].upper(),
+                        rssi, bool(flags & TLM_FLAG), voltage
+                    ))
+                    for (beacon_number, packet_type, packet_counter, _, rssi, flags, voltage), payload
+                    in zip(_batch_struct(hex_size // 2).iter_unpack(raw), payloads)
+                ]
+
+    return [decode_payload(payload) for payload in payloads]
@@ -0,0 +1,53 @@
+"""Duplicate advertisement cache
+Purpose: gateways retry their POSTs, and the same advertisement is often seen in several consecutive scans. This
+bounded LRU remembers the (MAC address, packet counter, echobeacon number) of the advertisements already applied for
+a short time, so that exact copies are dropped before they cost a savepoint or any other database work.
+
+Usage: build it with the maximum number of entries and the time to live, check seen() before processing an
+advertisement and call add() once it has been applied. Entries expire ttl seconds after they were added, which has
+to stay well below the time a tag takes to wrap its 8 bit packet counter. It is safe to share across threads.
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+
+class DuplicateCache:
+    def __init__(self, max_entries, ttl):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> expiry (monotonic time)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def seen(self, key):
+        now = time.monotonic()
+        with self._lock:
+            expiry = self._entries.get(key)
+            if expiry is not None and expiry > now:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return True
+            if expiry is not None:
+                del self._entries[key]
+            self.misses += 1
+            return False
+
+    def add(self, key):
+        with self._lock:
+            self._entries[key] = time.monotonic() + self.ttl
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_ratio": round(self.hits / lookups, 4) if lookups else 0.0
+            }
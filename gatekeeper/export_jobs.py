@@ -0,0 +1,307 @@
+"""Background export jobs
+Purpose: exports of months of logs take minutes to write. Run inside a web request, they hold a server thread and a
+pool connection the whole time, and the gateway requests wait for them. Here every export is a job run by a pool of
+worker processes, each with a database connection of its own, that writes the file to EXPORT_CACHE_DIR and reports
+how many rows it has written; the browser polls the job and downloads the file when it is done.
+
+Finished files of ranges that are over, with no open logs in them, stay in the directory as a cache keyed by the
+export query: the same export asked again is served right away, without running it. The cache is emptied by every
+add, edit or delete made from the web pages and by every rename of the names the exports show, and its files are
+kept for max_age seconds at most, as the tag columns show the current tags and batteries. Every other file is kept
+for job_ttl seconds after its job ends, for the download.
+
+Usage: build it with the database URL and the cache directory, and register stop() to run at shutdown; the worker
+processes are started, with the spawn method (see spawning.py), by the first submit(). submit() takes the export query
+with its parameters, the order of its rows and the columns, and returns the job, a new one or the one of the same
+export; job() finds a job again by its id. invalidate() empties the cache.
+"""
+
+import hashlib
+import json
+import os
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from .exports import write_xlsx, copy_statement
+from .spawning import spawn_context
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+# Delimiters of the text formats, the other format is xlsx
+TEXT_DELIMITERS = {"csv": ",", "tsv": "\t"}
+
+# Rows between two progress reports of a worker
+PROGRESS_ROWS = 5000
+
+# Files written by the jobs, the only ones removed from the directory
+_FILE_NAME = re.compile(r"[0-9a-f]{32}\.(xlsx|csv|tsv)(\.part)?")
+
+# Set in every worker process by _worker_init
+_progress = None
+
+
+def _worker_init(progress):
+    global _progress
+    _progress = progress
+
+
+def _export_main(job_id, conninfo, export_format, query, params, order_by, open_condition, columns, title, path,
+                 fetch_rows):
+    """Write the rows of query to path, returns (rows, open rows)"""
+    # Imported here so that only the worker processes pay for them
+    import psycopg
+    from psycopg.rows import dict_row
+
+    part = f"{path}.part"
+    try:
+        with psycopg.connect(conninfo, row_factory=dict_row) as conn:
+            # The count and the rows from the same snapshot
+            conn.isolation_level = psycopg.IsolationLevel.REPEATABLE_READ
+            # The rows still open may change after the export, and keep it out of the cache
+            counts = conn.execute(
+                f"SELECT COUNT(*) AS total, COUNT(*) FILTER (WHERE {open_condition or 'FALSE'}) AS open "
+                f"FROM ({query}) export_rows",
+                params
+            ).fetchone()
+            total = counts["total"]
+            _progress.put((job_id, 0, total))
+
+            def report(rows):
+                _progress.put((job_id, rows, total))
+
+            if export_format in TEXT_DELIMITERS:
+                rows_query = psycopg.ClientCursor(conn).mogrify(query, params)
+                statement = copy_statement(columns, rows_query, order_by, TEXT_DELIMITERS[export_format])
+                # COPY sends the header and then a block per row
+                blocks = 0
+                with open(part, "wb") as f, conn.cursor().copy(statement) as copy:
+                    for data in copy:
+                        f.write(data)
+                        blocks += 1
+                        if blocks % PROGRESS_ROWS == 0:
+                            report(blocks - 1)
+                written = max(blocks - 1, 0)
+            else:
+                with conn.cursor(name=f"export_{job_id}") as curs:
+                    curs.itersize = fetch_rows
+                    curs.execute(f"SELECT * FROM ({query}) export_rows ORDER BY {order_by}", params)
+                    written = write_xlsx(curs, columns, title, part, progress=report, progress_every=PROGRESS_ROWS)
+    except BaseException:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+    os.replace(part, path)
+    report(written)
+    return written, counts["open"]
+
+
+class ExportJob:
+    def __init__(self, key, export_format, download_name, path, cacheable, generation):
+        self.id = secrets.token_hex(16)
+        self.key = key
+        self.format = export_format
+        self.download_name = download_name
+        self.path = path
+        self.cacheable = cacheable
+        self.generation = generation
+        self.status = JOB_QUEUED
+        self.rows = 0
+        self.total = None
+        self.error = None
+        self.cached = False
+        self.submitted = time.time()
+        self.finished = None
+
+    def to_dict(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "rows": self.rows,
+            "total": self.total,
+            "cached": self.cached,
+            "error": self.error
+        }
+
+
+class ExportJobs:
+    def __init__(self, conninfo, cache_dir, workers=2, max_age=24 * 3600, max_files=20, job_ttl=3600,
+                 fetch_rows=2000):
+        self.conninfo = conninfo
+        self.cache_dir = cache_dir
+        self.workers = workers
+        self.max_age = max_age
+        self.max_files = max_files
+        self.job_ttl = job_ttl
+        self.fetch_rows = fetch_rows
+        # The workers import the gatekeeper package only, never the main module of the server
+        self._context = spawn_context()
+        self._executor = None
+        self._progress = None
+        self._jobs = {}  # id -> ExportJob
+        self._running = {}  # key -> ExportJob not finished yet
+        self._cache = {}  # key -> finished cacheable ExportJob
+        self._dropped = []  # jobs out of the cache, whose files may not be needed anymore
+        self._generation = 0  # invalidations so far
+        self._lock = threading.Lock()
+        self._start_lock = threading.Lock()
+        self._counters = {"submitted": 0, "cache_hits": 0, "failed": 0}
+
+    def start(self):
+        with self._start_lock:
+            if self._executor is None:
+                self._start()
+
+    def _start(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        # Files of a previous run may be out of date, the invalidations that happened since are lost
+        for name in os.listdir(self.cache_dir):
+            if _FILE_NAME.fullmatch(name):
+                try:
+                    os.remove(os.path.join(self.cache_dir, name))
+                except OSError:
+                    pass
+        self._progress = self._context.Queue()
+        self._executor = ProcessPoolExecutor(
+            max_workers=self.workers,
+            mp_context=self._context,
+            initializer=_worker_init,
+            initargs=(self._progress,)
+        )
+        threading.Thread(target=self._collect_progress, name="export-progress", daemon=True).start()
+
+    def stop(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._progress.put(None)
+
+    def _collect_progress(self):
+        while True:
+            message = self._progress.get()
+            if message is None:
+                return
+            job_id, rows, total = message
+            with self._lock:
+                job = self._jobs.get(job_id)
+                if job is not None and job.status in (JOB_QUEUED, JOB_RUNNING):
+                    job.status = JOB_RUNNING
+                    job.rows = rows
+                    job.total = total
+
+    @staticmethod
+    def key(export_format, query, params):
+        """Exports of the same rows in the same format, whatever the filters that asked for them"""
+        text = json.dumps([export_format, " ".join(query.split()), params], default=str)
+        return hashlib.sha256(text.encode()).hexdigest()
+
+    def submit(self, export_format, query, params, order_by, columns, title, download_name, closed=False,
+               open_condition=None):
+        """
+        Job exporting the rows of query, ordered by order_by on its column names. closed tells that no new row can
+        match the query anymore, open_condition selects the rows that can still change, so that the file is cached
+        only if there are none
+        """
+        self.start()
+        key = self.key(export_format, query, params)
+        self._expire()
+        with self._lock:
+            self._counters["submitted"] += 1
+            cached = self._cache.get(key)
+            if cached is not None:
+                self._counters["cache_hits"] += 1
+                job = ExportJob(key, export_format, download_name, cached.path, True, cached.generation)
+                job.status = JOB_DONE
+                job.rows = job.total = cached.rows
+                job.cached = True
+                job.finished = time.time()
+                self._jobs[job.id] = job
+                return job
+            running = self._running.get(key)
+            if running is not None:
+                return running
+            job = ExportJob(key, export_format, download_name, None, closed, self._generation)
+            # A file of its own, an older one of the same export may still be downloading
+            job.path = os.path.join(self.cache_dir, f"{job.id}.{export_format}")
+            self._jobs[job.id] = job
+            self._running[key] = job
+
+        future = self._executor.submit(
+            _export_main, job.id, self.conninfo, export_format, query, params, order_by, open_condition, columns,
+            title, job.path, self.fetch_rows
+        )
+        future.add_done_callback(lambda future: self._finish(job, future))
+        return job
+
+    def _finish(self, job, future):
+        try:
+            rows, open_rows = future.result()
+        except Exception as e:
+            print(f"Error in export job {job.id}: {e}")
+            with self._lock:
+                job.status = JOB_FAILED
+                job.error = str(e)
+                job.finished = time.time()
+                self._running.pop(job.key, None)
+                self._counters["failed"] += 1
+            return
+        with self._lock:
+            job.status = JOB_DONE
+            job.rows = job.total = rows
+            job.finished = time.time()
+            self._running.pop(job.key, None)
+            # An invalidation while the job ran may have changed its rows
+            if job.cacheable and not open_rows and job.generation == self._generation:
+                self._cache[job.key] = job
+            else:
+                job.cacheable = False
+
+    def job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def invalidate(self):
+        """Forget every cached file, the running jobs won't be cached"""
+        with self._lock:
+            self._generation += 1
+            self._dropped.extend(self._cache.values())
+            self._cache.clear()
+
+    def _expire(self):
+        """Drop the jobs past job_ttl, the cached files past max_age or above max_files, and the files no one needs"""
+        now = time.time()
+        with self._lock:
+            cached = sorted(self._cache.values(), key=lambda job: job.finished)
+            for number, job in enumerate(cached):
+                if now - job.finished > self.max_age or number < len(cached) - self.max_files:
+                    del self._cache[job.key]
+                    self._dropped.append(job)
+            expired = [
+                job for job in self._jobs.values()
+                if job.finished is not None and now - job.finished > self.job_ttl
+            ]
+            for job in expired:
+                del self._jobs[job.id]
+            candidates = expired + self._dropped
+            self._dropped = []
+            # A file is still needed by the cache or by a job still in time for its download
+            needed = {job.path for job in self._cache.values()} | {job.path for job in self._jobs.values()}
+        for path in {job.path for job in candidates} - needed:
+            try:
+                os.remove(path)
+            except OSError:
+                # Missing after a failure, or still being downloaded on Windows, the next start removes it
+                pass
+
+    def stats(self):
+        with self._lock:
+            return {
+                "jobs": len(self._jobs),
+                "running": len(self._running),
+                "cached_files": len(self._cache),
+                **self._counters
+            }
@@ -0,0 +1,115 @@
+"""Table exports
+Purpose: writes the logs and entries exported from the tables to an XLSX file while they are read, in openpyxl
+write-only mode: every row goes to the temporary file of the worksheet as soon as it is appended, and the cells
+refer to a few named styles of the workbook instead of carrying fonts and borders of their own, so the memory used is
+the same for ten rows and for a million. For delimited text there is nothing to do in Python at all: copy_statement()
+has the database format the same columns as CSV or TSV with COPY ... TO STDOUT, and the response passes its blocks on.
+
+Usage: write_xlsx(rows, columns, title, file) with the rows as an iterable of dicts, best a server-side cursor, and an
+ExportColumn for every column. The file is a path or a binary file object; returns the number of rows written.
+Background jobs (export_jobs.py) pass a progress callback too.
+copy_statement(columns, rows_query, order_by, delimiter) wraps a query of the rows, with its parameters already bound
+(ClientCursor.mogrify), into the COPY to run with cursor.copy().
+"""
+
+from datetime import date, datetime
+from typing import NamedTuple
+
+from psycopg import sql
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+from openpyxl.styles import NamedStyle, Font, Alignment, PatternFill, Border, Side
+from openpyxl.utils import get_column_letter
+
+TIMESTAMP_FORMAT = '%d/%m/%Y %H:%M:%S'
+DATE_FORMAT = '%d/%m/%Y'
+# The same formats for to_char()
+SQL_TIMESTAMP_FORMAT = 'DD/MM/YYYY HH24:MI:SS'
+SQL_DATE_FORMAT = 'DD/MM/YYYY'
+
+
+class ExportColumn(NamedTuple):
+    header: str
+    key: str  # key of the value in the rows
+    width: int
+    style: str = "text"  # "text", "center" or "bold"
+    timestamp: bool = False  # formatted with TIMESTAMP_FORMAT
+    date: bool = False  # formatted with DATE_FORMAT
+
+
+def named_styles():
+    thin = Side(style='thin', color='E5E7EB')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    left = Alignment(horizontal='left', vertical='center')
+    center = Alignment(horizontal='center', vertical='center')
+    return (
+        NamedStyle(
+            name="export_header",
+            font=Font(bold=True, color="FFFFFF", size=12),
+            fill=PatternFill(start_color="1E40AF", end_color="1E40AF", fill_type="solid"),
+            alignment=center,
+            border=border
+        ),
+        NamedStyle(name="export_text", alignment=left, border=border),
+        NamedStyle(name="export_center", alignment=center, border=border),
+        NamedStyle(name="export_bold", font=Font(bold=True), alignment=left, border=border)
+    )
+
+
+def cell_value(value):
+    """Value of a cell as the tables show it"""
+    if isinstance(value, datetime):
+        return value.strftime(TIMESTAMP_FORMAT)
+    if isinstance(value, date):
+        return value.strftime(DATE_FORMAT)
+    return value
+
+
+def write_xlsx(rows, columns, title, file, progress=None, progress_every=5000):
+    """progress, if given, is called with the rows written so far every progress_every rows"""
+    wb = Workbook(write_only=True)
+    for style in named_styles():
+        wb.add_named_style(style)
+    ws = wb.create_sheet(title)
+
+    # Sizes and frozen header row have to be set before the first row is written
+    for number, column in enumerate(columns, 1):
+        ws.column_dimensions[get_column_letter(number)].width = column.width
+    ws.row_dimensions[1].height = 25
+    ws.freeze_panes = 'A2'
+
+    def cell(value, style):
+        cell = WriteOnlyCell(ws, value=value)
+        cell.style = style
+        return cell
+
+    ws.append([cell(column.header, "export_header") for column in columns])
+    styles = [f"export_{column.style}" for column in columns]
+    written = 0
+    for row in rows:
+        ws.append([cell(cell_value(row[column.key]), style) for column, style in zip(columns, styles)])
+        written += 1
+        if progress is not None and written % progress_every == 0:
+            progress(written)
+    wb.save(file)
+    return written
+
+
+def copy_statement(columns, rows_query, order_by, delimiter=","):
+    """
+    COPY sending the columns of the rows of rows_query, in the order_by order of its column names, as delimited text
+    with a header row, the timestamps and dates formatted like the XLSX cells
+    """
+    def field(column):
+        if column.timestamp or column.date:
+            return sql.SQL("to_char({}, {}) AS {}").format(
+                sql.Identifier(column.key),
+                sql.Literal(SQL_TIMESTAMP_FORMAT if column.timestamp else SQL_DATE_FORMAT),
+                sql.Identifier(column.header)
+            )
+        return sql.SQL("{} AS {}").format(sql.Identifier(column.key), sql.Identifier(column.header))
+
+    fields = sql.SQL(", ").join(field(column) for column in columns)
+    return sql.SQL(
+        "COPY (SELECT {} FROM ({}) export_rows ORDER BY {}) TO STDOUT (FORMAT csv, HEADER, DELIMITER {})"
+    ).format(fields, sql.SQL(rows_query), sql.SQL(order_by), sql.Literal(delimiter))
@@ -0,0 +1,125 @@
+"""Binary gateway framing
+Purpose: a compact alternative to the JSON gateway message, for gateways that can be configured to send it. Instead
+of a JSON envelope with hex strings, the body is a sequence of frames, each made of the scan time (4 bytes, unsigned,
+big endian), the length of the advertisement (1 byte) and the raw advertisement bytes, without the gateway header.
+Frames are decoded straight into the same Advertisement records as the JSON device_list. Gzip and deflate request
+bodies are accepted for both formats.
+
+Usage: call decompress_body() with the request body and its Content-Encoding header, then decode_frames() when the
+Content-Type is FRAMES_CONTENT_TYPE. Both raise FramingError when the body can't be used. encode_frames() builds a
+body out of (scan_time, advertisement bytes) pairs.
+"""
+
+import struct
+import zlib
+
+from .decoder import Advertisement, ADVERTISEMENT_SIZE, TLM_FLAG, _ADVERTISEMENT_STRUCT
+
+FRAMES_CONTENT_TYPE = "application/vnd.gatekeeper.frames"
+
+# Scan time, advertisement length
+_FRAME_HEADER_STRUCT = struct.Struct(">IB")
+FRAME_HEADER_SIZE = _FRAME_HEADER_STRUCT.size
+
+_new_advertisement = tuple.__new__
+
+# Structs used by the fast path of decode_frames, by advertisement length
+_BATCH_STRUCTS = {}
+
+
+class FramingError(ValueError):
+    pass
+
+
+def decompress_body(body, content_encoding, max_size):
+    """Return the body without its Content-Encoding, refusing to inflate it to more than max_size bytes."""
+    encoding = (content_encoding or "identity").strip().lower()
+    if encoding == "identity":
+        if len(body) > max_size:
+            raise FramingError("Body too large")
+        return body
+    if encoding in ("gzip", "x-gzip"):
+        wbits = 16 + zlib.MAX_WBITS
+    elif encoding == "deflate":
+        # Some clients send raw deflate data without the zlib wrapper that the HTTP specification asks for
+        wbits = zlib.MAX_WBITS if body[:1] == b"\x78" else -zlib.MAX_WBITS
+    else:
+        raise FramingError(f"Unsupported Content-Encoding {content_encoding}")
+
+    decompressor = zlib.decompressobj(wbits)
+    try:
+        inflated = decompressor.decompress(body, max_size)
+    except zlib.error as e:
+        raise FramingError(f"Invalid {encoding} body: {e}")
+    if decompressor.unconsumed_tail:
+        raise FramingError("Body too large")
+    if not decompressor.eof:
+        raise FramingError(f"Truncated {encoding} body")
+    return inflated
+
+
+def _batch_struct(length):
+    struct_ = _BATCH_STRUCTS.get(length)
+    if struct_ is None:
+        struct_ = _BATCH_STRUCTS[length] = struct.Struct(f">IxHBB6sbBH{length - ADVERTISEMENT_SIZE}x")
+    return struct_
+
+
+def decode_frames(body, scan_times=None):
+    """
+    Decode a framed body into one Advertisement per frame, in order. Frames too short to hold an advertisement
+    decode to None, like malformed JSON devices do. A body that ends in the middle of a frame raises FramingError.
+    When scan_times is a list, the scan time of every frame is appended to it.
+    """
+    # Fast path: when every frame has the same length, which is the normal case, unpack them all with
+    # struct.iter_unpack
+    if len(body) >= FRAME_HEADER_SIZE:
+        length = body[FRAME_HEADER_SIZE - 1]
+        frame_size = FRAME_HEADER_SIZE + length
+        frames = len(body) // frame_size
+        if length >= ADVERTISEMENT_SIZE and len(body) == frames * frame_size \
+                and body[FRAME_HEADER_SIZE - 1::frame_size] == bytes((length,)) * frames:
+            rows = list(_batch_struct(length).iter_unpack(body))
+            if scan_times is not None:
+                scan_times.extend([row[0] for row in rows])
+            return [
+                _new_advertisement(Advertisement, (
+                    beacon_number, packet_type, packet_counter, mac.hex().upper(), rssi, bool(flags & TLM_FLAG), voltage
+                ))
+                for _, beacon_number, packet_type, packet_counter, mac, rssi, flags, voltage in rows
+            ]
+
+    advertisements = []
+    append = advertisements.append
+    unpack_header = _FRAME_HEADER_STRUCT.unpack_from
+    unpack_advertisement = _ADVERTISEMENT_STRUCT.unpack_from
+    offset = 0
+    size = len(body)
+    while offset < size:
+        if offset + FRAME_HEADER_SIZE > size:
+            raise FramingError("Truncated frame header")
+        scan_time, length = unpack_header(body, offset)
+        offset += FRAME_HEADER_SIZE
+        if offset + length > size:
+            raise FramingError("Truncated frame")
+        if scan_times is not None:
+            scan_times.append(scan_time)
+        if length < ADVERTISEMENT_SIZE:
+            append(None)
+        else:
+            beacon_number, packet_type, packet_counter, mac, rssi, flags, voltage = unpack_advertisement(body, offset)
+            # Tags are matched on the MAC address as the JSON gateways write it, in uppercase hex
+            append(_new_advertisement(Advertisement, (
+                beacon_number, packet_type, packet_counter, mac.hex().upper(), rssi, bool(flags & TLM_FLAG), voltage
+            )))
+        offset += length
+    return advertisements
+
+
+def encode_frames(frames):
+    """Build a framed body from (scan_time, advertisement bytes) pairs."""
+    parts = []
+    for scan_time, advertisement in frames:
+        parts.append(_FRAME_HEADER_STRUCT.pack(scan_time, len(advertisement)))
+        parts.append(advertisement)
+    return b"".join(parts)
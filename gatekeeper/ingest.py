@@ -0,0 +1,454 @@
+"""Advertisement ingest
+Purpose: applies decoded gateway advertisements to the database, following the rules of the "Leaving or entering?"
+and "Logs" sections of the design document. Duplicate and direction decisions are taken in memory by the tag state
+engine, only the resulting logs and unassigned tag entries are written while the advertisements are processed. With
+pipeline set, the writes of a whole batch are sent together through a psycopg pipeline rather than one round trip
+at a time.
+
+ProcedureIngestor is the alternative that leaves the decisions to the ingest_advertisements database function instead
+(see migrations/002_ingest_advertisement.sql): it keeps no state in memory, and applies a whole batch of
+advertisements with a single statement.
+
+Usage: build an Ingestor with the connection pool, the beacon registry, the tag state engine and optionally a
+DuplicateCache, or a ProcedureIngestor with the connection pool and optionally a DuplicateCache. Then call
+process_device_list() with the device_list of a gateway message, or process_advertisements() with already decoded
+advertisements and optionally the time each of them was received, which goes on the logs and entries (the queued
+ingest modes and the archive replay pass it). Without it every row gets the clock time of its own statement, so the
+movements of a batch don't all share the start of its transaction. Both return how many advertisements were
+accepted, duplicate or ignored. With an OccupancyTracker, the Ingestor hands it the logs it opened and closed in
+every shipyard once their transaction commits.
+"""
+
+from .decoder import decode_device_list, PRESENCE_PACKET
+from .tag_state import ADVERTISEMENT_ACCEPTED, ADVERTISEMENT_DUPLICATE, ADVERTISEMENT_IGNORED
+
+# Used to determine remaining battery percentage
+BATTERY_MAX_MILLIVOLTS = 3600
+
+
+def usable_battery(advertisement):
+    """
+    Remaining battery percentage of an advertisement that can be processed, or None for advertisements that are
+    ignored before looking at the tag: malformed, not a presence packet, without TLM or with a battery above 100%.
+    """
+    if advertisement is None:
+        return None
+    if advertisement.packet_type != PRESENCE_PACKET:  # presence packets only
+        return None
+    if not advertisement.tlm:  # require Eddystone TLM flag
+        return None
+
+    remaining_battery_percentage = round((advertisement.voltage / BATTERY_MAX_MILLIVOLTS) * 100, 1)
+
+    # The tag table rejects batteries above 100%, keep such packets out of the write-behind state
+    if remaining_battery_percentage > 100:
+        return None
+    return remaining_battery_percentage
+
+
+class Ingestor:
+    def __init__(self, pool, beacon_registry, tag_state_engine, duplicate_cache=None, pipeline=False,
+                 occupancy=None):
+        self.pool = pool
+        self.beacon_registry = beacon_registry
+        self.tag_state_engine = tag_state_engine
+        self.duplicate_cache = duplicate_cache
+        self.pipeline = pipeline
+        self.occupancy = occupancy
+
+    def decide(self, advertisement, undo=None, timestamp=None):
+        """
+        Take the decisions for a single decoded advertisement in memory, without writing anything. The tag state
+        changes are appended to undo, if given, for TagStateEngine.restore() when the movement can't be written.
+        timestamp, when the advertisement was received, goes on the movement.
+        Returns (outcome, movement): the outcome is ADVERTISEMENT_DUPLICATE if the tag already saw this packet
+        counter, ADVERTISEMENT_IGNORED if the packet can't be used at all (malformed, not a presence packet, unknown
+        tag) and ADVERTISEMENT_ACCEPTED otherwise. movement is the log or entry to record, if any.
+        """
+        remaining_battery_percentage = usable_battery(advertisement)
+        if remaining_battery_percentage is None:
+            return ADVERTISEMENT_IGNORED, None
+
+        beacon_mac_address = advertisement.mac_address
+        packet_counter = advertisement.packet_counter
+        current_beacon = self.beacon_registry.by_friendly_number(advertisement.beacon_number)
+
+        # Dedup and direction are decided in memory
+        outcome, movement = self.tag_state_engine.observe(
+            beacon_mac_address, packet_counter, remaining_battery_percentage, current_beacon, undo
+        )
+        if movement is not None and timestamp is not None:
+            movement = movement._replace(timestamp=timestamp)
+        return outcome, movement
+
+    def record_movement(self, curs, movement):
+        """
+        Write the log or unassigned tag entry of a movement, one statement at a time. Returns the change of the open
+        logs of its shipyard: 1 if a log was opened, -1 if one was closed, 0 otherwise.
+        """
+        tag_id = movement.tag_id
+        current_shipyard_id = movement.shipyard_id
+        is_direction_entering = movement.is_entering
+
+        # Resolve assigned crew member (if any)
+        curs.execute("""
+            SELECT id
+            FROM crew_member
+            WHERE tag_id = %s
+        """, (tag_id,))
+        crew_member = curs.fetchone()
+
+        if not crew_member:
+            # Unassigned tag → record
+            curs.execute("""
+                INSERT INTO unassigned_tag_entry (tag_id, shipyard_id, is_entering, advertisement_timestamp)
+                VALUES (%s, %s, %s, COALESCE(%s::timestamp, clock_timestamp()))
+            """, (tag_id, current_shipyard_id, is_direction_entering, movement.timestamp))
+            return 0
+
+        crew_member_id = crew_member['id']
+
+        if is_direction_entering:
+            # Open new log
+            curs.execute("""
+                INSERT INTO permanence_log (crew_member_id, shipyard_id, entry_timestamp)
+                VALUES (%s, %s, COALESCE(%s::timestamp, clock_timestamp()))
+            """, (crew_member_id, current_shipyard_id, movement.timestamp))
+            return 1
+        else:
+            # Close most recent open log (or create exit-only)
+            curs.execute("""
+                UPDATE permanence_log
+                SET leave_timestamp = COALESCE(%s::timestamp, clock_timestamp())
+                WHERE id = (
+                    SELECT id FROM permanence_log
+                    WHERE crew_member_id = %s
+                    AND shipyard_id = %s
+                    AND leave_timestamp IS NULL
+                    ORDER BY entry_timestamp DESC
+                    LIMIT 1
+                )
+            """, (movement.timestamp, crew_member_id, current_shipyard_id))
+            if curs.rowcount == 0:
+                curs.execute("""
+                    INSERT INTO permanence_log (crew_member_id, shipyard_id, leave_timestamp)
+                    VALUES (%s, %s, COALESCE(%s::timestamp, clock_timestamp()))
+                """, (crew_member_id, current_shipyard_id, movement.timestamp))
+                return 0
+            return -1
+
+    def record_movements_pipelined(self, conn, movements):
+        """
+        Write the logs and unassigned tag entries of a list of movements, in order, with the statements sent
+        together through a psycopg pipeline instead of waiting for each of them. The crew members are fetched first
+        with a single query, since every write depends on them, and closing a log creates the exit-only log in the
+        same statement when there is no open one, instead of deciding it on the row count of the UPDATE.
+        Raises on the first failing statement, leaving the transaction to be rolled back by the caller.
+        Returns the change of the open logs of every shipyard.
+        """
+        crew_members = {
+            row['tag_id']: row['id']
+            for row in conn.execute("""
+                SELECT id, tag_id
+                FROM crew_member
+                WHERE tag_id = ANY(%s)
+            """, (list({movement.tag_id for movement in movements}),)).fetchall()
+        }
+
+        deltas = {}
+        closes = []  # (shipyard id, cursor of the close)
+        with conn.pipeline(), conn.cursor() as curs:
+            for movement in movements:
+                crew_member_id = crew_members.get(movement.tag_id)
+                if crew_member_id is None:
+                    curs.execute("""
+                        INSERT INTO unassigned_tag_entry (tag_id, shipyard_id, is_entering, advertisement_timestamp)
+                        VALUES (%s, %s, %s, COALESCE(%s::timestamp, clock_timestamp()))
+                    """, (movement.tag_id, movement.shipyard_id, movement.is_entering, movement.timestamp))
+                elif movement.is_entering:
+                    curs.execute("""
+                        INSERT INTO permanence_log (crew_member_id, shipyard_id, entry_timestamp)
+                        VALUES (%s, %s, COALESCE(%s::timestamp, clock_timestamp()))
+                    """, (crew_member_id, movement.shipyard_id, movement.timestamp))
+                    deltas[movement.shipyard_id] = deltas.get(movement.shipyard_id, 0) + 1
+                else:
+                    # A cursor of its own, to read later whether it closed a log
+                    closes.append((movement.shipyard_id, conn.execute("""
+                        WITH closed AS (
+                            UPDATE permanence_log
+                            SET leave_timestamp = COALESCE(%(timestamp)s::timestamp, clock_timestamp())
+                            WHERE id = (
+                                SELECT id FROM permanence_log
+                                WHERE crew_member_id = %(crew_member_id)s
+                                AND shipyard_id = %(shipyard_id)s
+                                AND leave_timestamp IS NULL
+                                ORDER BY entry_timestamp DESC
+                                LIMIT 1
+                            )
+                            RETURNING id
+                        ), exit_only AS (
+                            INSERT INTO permanence_log (crew_member_id, shipyard_id, leave_timestamp)
+                            SELECT
+                                %(crew_member_id)s,
+                                %(shipyard_id)s,
+                                COALESCE(%(timestamp)s::timestamp, clock_timestamp())
+                            WHERE NOT EXISTS (SELECT 1 FROM closed)
+                        )
+                        SELECT EXISTS (SELECT 1 FROM closed) AS closed
+                    """, {
+                        "crew_member_id": crew_member_id,
+                        "shipyard_id": movement.shipyard_id,
+                        "timestamp": movement.timestamp
+                    })))
+        for shipyard_id, close in closes:
+            if close.fetchone()['closed']:
+                deltas[shipyard_id] = deltas.get(shipyard_id, 0) - 1
+        return deltas
+
+    def process_device(self, curs, advertisement, deltas=None, undo=None, timestamp=None):
+        """
+        Decide and record a single decoded advertisement on an already open transaction, returning its outcome.
+        The change of the open logs of its shipyard is added to deltas, and the tag state changes to undo, if given.
+        timestamp is when the advertisement was received, the time of the write if None.
+        """
+        outcome, movement = self.decide(advertisement, undo, timestamp)
+        if movement is not None:
+            delta = self.record_movement(curs, movement)
+            if deltas is not None and delta:
+                deltas[movement.shipyard_id] = deltas.get(movement.shipyard_id, 0) + delta
+        return outcome
+
+    @staticmethod
+    def transaction_id(conn):
+        """Id of the open transaction, for the OccupancyTracker to tell whether a count of the logs includes it"""
+        return int(conn.execute("SELECT pg_current_xact_id()::text AS xid").fetchone()['xid'])
+
+    def apply_occupancy(self, deltas, xid):
+        if self.occupancy is not None and any(deltas.values()):
+            self.occupancy.apply(deltas, xid)
+
+    def process_advertisements(self, advertisements, timestamps=None):
+        """
+        Apply a list of decoded advertisements over one pool connection and one transaction. timestamps, if given,
+        holds the time every advertisement was received, for its log or entry.
+        Every advertisement runs inside its own savepoint, so a failing one is rolled back and counted as
+        ignored without losing the rest of the batch. Exact copies of recently applied advertisements are counted
+        as duplicates before they get a savepoint. The tag states of the advertisements that were not written, a
+        failing one or the whole batch if it doesn't commit, are put back as they were.
+        With pipeline set, the writes of the whole batch are pipelined instead, see process_advertisements_pipelined.
+        """
+        if self.pipeline:
+            return self.process_advertisements_pipelined(advertisements, timestamps)
+
+        counts = {
+            ADVERTISEMENT_ACCEPTED: 0,
+            ADVERTISEMENT_DUPLICATE: 0,
+            ADVERTISEMENT_IGNORED: 0
+        }
+        deltas = {}
+        xid = None
+        undo = []
+        keys = []
+        try:
+            with self.pool.connection() as conn:
+                with conn.transaction():
+                    with conn.cursor() as curs:
+                        for i, advertisement in enumerate(advertisements):
+                            key = None
+                            if advertisement is not None and self.duplicate_cache is not None:
+                                key = (
+                                    advertisement.mac_address, advertisement.packet_counter, advertisement.beacon_number
+                                )
+                                if self.duplicate_cache.seen(key):
+                                    counts[ADVERTISEMENT_DUPLICATE] += 1
+                                    continue
+                            advertisement_deltas = {}
+                            advertisement_undo = []
+                            try:
+                                with conn.transaction():
+                                    outcome = self.process_device(
+                                        curs, advertisement, advertisement_deltas, advertisement_undo,
+                                        timestamps[i] if timestamps else None
+                                    )
+                            except Exception as e:
+                                print(f"Error in process_device: {e}")
+                                # Its log or entry is not written, the retry of the packet has to be decided again
+                                self.tag_state_engine.restore(advertisement_undo)
+                                outcome = ADVERTISEMENT_IGNORED
+                            else:
+                                undo.extend(advertisement_undo)
+                                # The logs of a rolled back savepoint were neither opened nor closed
+                                for shipyard_id, delta in advertisement_deltas.items():
+                                    deltas[shipyard_id] = deltas.get(shipyard_id, 0) + delta
+                            # Failed and unusable advertisements are not remembered, a retry gets processed again
+                            if key is not None and outcome != ADVERTISEMENT_IGNORED:
+                                keys.append(key)
+                            counts[outcome] += 1
+                    if self.occupancy is not None and deltas:
+                        xid = self.transaction_id(conn)
+        except Exception:
+            # Nothing of the batch was written
+            self.tag_state_engine.restore(undo)
+            raise
+        # Once committed
+        for key in keys:
+            self.duplicate_cache.add(key)
+        self.apply_occupancy(deltas, xid)
+        return counts
+
+    def process_advertisements_pipelined(self, advertisements, timestamps=None):
+        """
+        Apply a list of decoded advertisements by taking all the decisions in memory first, then writing all the
+        resulting movements in one transaction through a pipeline. If the pipelined writes fail, the transaction is
+        rolled back and the movements are written again one by one, each in its own savepoint, so that only the
+        failing ones are lost and counted as ignored. The tag of a movement that is not written, a failing one or
+        every one if the batch doesn't commit, is put back as it was before it, with its later advertisements in the
+        batch counted as ignored too, so that the retry of the packets is decided again in the same order.
+        """
+        counts = {
+            ADVERTISEMENT_ACCEPTED: 0,
+            ADVERTISEMENT_DUPLICATE: 0,
+            ADVERTISEMENT_IGNORED: 0
+        }
+        undo = []
+        decided = []  # (mac address, dedup key, outcome, movement, position of its changes in undo)
+        for i, advertisement in enumerate(advertisements):
+            key = None
+            if advertisement is not None and self.duplicate_cache is not None:
+                key = (advertisement.mac_address, advertisement.packet_counter, advertisement.beacon_number)
+                if self.duplicate_cache.seen(key):
+                    counts[ADVERTISEMENT_DUPLICATE] += 1
+                    continue
+            position = len(undo)
+            try:
+                outcome, movement = self.decide(advertisement, undo, timestamps[i] if timestamps else None)
+            except Exception as e:
+                print(f"Error in process_device: {e}")
+                outcome, movement = ADVERTISEMENT_IGNORED, None
+            mac_address = advertisement.mac_address if advertisement is not None else None
+            decided.append((mac_address, key, outcome, movement, position))
+        moving = [decision for decision in decided if decision[3] is not None]
+        movements = [decision[3] for decision in moving]
+
+        failed = set()
+        deltas = {}
+        xid = None
+        error = None
+        if movements:
+            try:
+                with self.pool.connection() as conn:
+                    try:
+                        with conn.transaction():
+                            deltas = self.record_movements_pipelined(conn, movements)
+                            if self.occupancy is not None and deltas:
+                                xid = self.transaction_id(conn)
+                    except Exception as e:
+                        print(f"Error in pipelined ingest, writing the batch one movement at a time: {e}")
+                        deltas = {}
+                        with conn.transaction():
+                            with conn.cursor() as curs:
+                                failed_tags = set()
+                                for i, movement in enumerate(movements):
+                                    # Decided on the state left by a movement that is not written
+                                    if movement.tag_id in failed_tags:
+                                        failed.add(i)
+                                        continue
+                                    try:
+                                        with conn.transaction():
+                                            delta = self.record_movement(curs, movement)
+                                    except Exception as e:
+                                        print(f"Error in process_device: {e}")
+                                        failed.add(i)
+                                        failed_tags.add(movement.tag_id)
+                                        continue
+                                    deltas[movement.shipyard_id] = deltas.get(movement.shipyard_id, 0) + delta
+                            if self.occupancy is not None and deltas:
+                                xid = self.transaction_id(conn)
+            except Exception as e:
+                # Nothing of the batch was written
+                error = e
+                failed = set(range(len(movements)))
+
+        # Every tag goes back to before its first movement that was not written
+        restored = {}
+        for i, (mac_address, _, _, _, position) in enumerate(moving):
+            if i in failed:
+                restored.setdefault(mac_address, position)
+        self.tag_state_engine.restore([
+            change for position, change in enumerate(undo)
+            if change[0] in restored and position >= restored[change[0]]
+        ])
+
+        for mac_address, key, outcome, movement, position in decided:
+            if mac_address in restored and position >= restored[mac_address]:
+                counts[ADVERTISEMENT_IGNORED] += 1
+                continue
+            # Failed and unusable advertisements are not remembered, a retry gets processed again
+            if key is not None and outcome != ADVERTISEMENT_IGNORED:
+                self.duplicate_cache.add(key)
+            counts[outcome] += 1
+        if error is not None:
+            raise error
+        # Once committed
+        self.apply_occupancy(deltas, xid)
+        return counts
+
+    def process_device_list(self, device_list):
+        return self.process_advertisements(decode_device_list(device_list))
+
+
+class ProcedureIngestor:
+    def __init__(self, pool, duplicate_cache=None):
+        self.pool = pool
+        self.duplicate_cache = duplicate_cache
+
+    def process_advertisements(self, advertisements, timestamps=None):
+        """
+        Apply a list of decoded advertisements with one call to ingest_advertisements, which takes the same
+        decisions as Ingestor in the database. Advertisements that can't be used, and exact copies of recently
+        applied ones, are counted without being sent. timestamps, if given, holds the time every advertisement was
+        received, for its log or entry.
+        """
+        counts = {
+            ADVERTISEMENT_ACCEPTED: 0,
+            ADVERTISEMENT_DUPLICATE: 0,
+            ADVERTISEMENT_IGNORED: 0
+        }
+        keys = []
+        columns = ([], [], [], [], [])
+        for i, advertisement in enumerate(advertisements):
+            remaining_battery_percentage = usable_battery(advertisement)
+            if remaining_battery_percentage is None:
+                counts[ADVERTISEMENT_IGNORED] += 1
+                continue
+            key = None
+            if self.duplicate_cache is not None:
+                key = (advertisement.mac_address, advertisement.packet_counter, advertisement.beacon_number)
+                if self.duplicate_cache.seen(key):
+                    counts[ADVERTISEMENT_DUPLICATE] += 1
+                    continue
+            keys.append(key)
+            columns[0].append(advertisement.mac_address)
+            columns[1].append(advertisement.packet_counter)
+            columns[2].append(advertisement.beacon_number)
+            columns[3].append(remaining_battery_percentage)
+            columns[4].append(timestamps[i] if timestamps else None)
+        if not keys:
+            return counts
+
+        with self.pool.connection() as conn:
+            outcomes = conn.execute("""
+                SELECT ingest_advertisements(
+                    %s::varchar[], %s::integer[], %s::integer[], %s::real[], %s::timestamp[]
+                ) AS outcomes
+            """, columns).fetchone()['outcomes']
+
+        for key, outcome in zip(keys, outcomes):
+            # Failed and unusable advertisements are not remembered, a retry gets processed again
+            if key is not None and outcome != ADVERTISEMENT_IGNORED:
+                self.duplicate_cache.add(key)
+            counts[outcome] += 1
+        return counts
+
+    def process_device_list(self, device_list):
+        return self.process_advertisements(decode_device_list(device_list))
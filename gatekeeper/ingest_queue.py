@@ -0,0 +1,128 @@
+"""Asynchronous ingest queue
+Purpose: lets the gateway endpoint acknowledge a gateway message as soon as it is decoded. Its advertisements are put
+on in-process queues, with the time they were submitted, which a pool of worker threads drains in batches through the
+batch processing function. The logs get the time the message was received, however long it waited in the queue. Every
+worker has a queue of its own, and every tag MAC address is hashed to one of them like the shards of ShardedIngest, so
+the advertisements of a tag are always applied in order by a single worker: two batches holding the same tag could
+commit in the opposite order of their decisions, e.g. the close of a log before the log itself.
+
+Usage: build it with the function that processes a list of advertisements and the times they were received, and returns
+its outcome counts, call start(), then submit() the advertisements of every gateway message. submit() returns False when
+the queue would go above its high-water mark, in which case the gateway has to retry later. stats() returns the counters
+exposed for monitoring.
+"""
+
+import queue
+import threading
+import time
+from collections import deque
+from datetime import datetime
+
+from .sharding import shard_of
+
+
+class IngestQueue:
+    # Drain rate is averaged over this many seconds
+    DRAIN_RATE_WINDOW_SECONDS = 60.0
+
+    def __init__(self, process_batch, high_water_mark, workers, batch_size):
+        self.process_batch = process_batch
+        self.high_water_mark = high_water_mark
+        self.workers = workers
+        self.batch_size = batch_size
+        self._queues = [queue.Queue() for _ in range(workers)]
+        self._submit_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._threads = []
+        self._drained = deque()  # (monotonic time, devices processed)
+        self._counters = {
+            "enqueued": 0,
+            "rejected": 0,
+            "processed": 0,
+            "failed_batches": 0
+        }
+        self._outcomes = {}
+
+    def submit(self, advertisements):
+        received_at = datetime.now()
+        with self._submit_lock:
+            if self.depth() + len(advertisements) > self.high_water_mark:
+                with self._stats_lock:
+                    self._counters["rejected"] += len(advertisements)
+                return False
+            for advertisement in advertisements:
+                # Undecodable advertisements only get counted, any worker will do
+                worker = shard_of(advertisement.mac_address, self.workers) if advertisement is not None else 0
+                self._queues[worker].put_nowait((advertisement, received_at))
+        with self._stats_lock:
+            self._counters["enqueued"] += len(advertisements)
+        return True
+
+    def depth(self):
+        return sum(worker_queue.qsize() for worker_queue in self._queues)
+
+    def start(self):
+        if self._threads:
+            return
+        for i in range(self.workers):
+            thread = threading.Thread(target=self._run, args=(self._queues[i],), name=f"ingest-worker-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=10.0):
+        """Give the workers up to timeout seconds to drain what is left in their queues, then stop them."""
+        deadline = time.monotonic() + timeout
+        while self.depth() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        self._stop.set()
+        for thread in self._threads:
+            thread.join(max(0.0, deadline - time.monotonic()))
+
+    def _next_batch(self, worker_queue):
+        try:
+            batch = [worker_queue.get(timeout=0.5)]
+        except queue.Empty:
+            return []
+        while len(batch) < self.batch_size:
+            try:
+                batch.append(worker_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, worker_queue):
+        while not self._stop.is_set():
+            batch = self._next_batch(worker_queue)
+            if not batch:
+                continue
+            try:
+                counts = self.process_batch(
+                    [advertisement for advertisement, _ in batch], [received_at for _, received_at in batch]
+                )
+            except Exception as e:
+                print(f"Error in ingest worker: {e}")
+                counts = None
+            with self._stats_lock:
+                self._counters["processed"] += len(batch)
+                self._drained.append((time.monotonic(), len(batch)))
+                if counts is None:
+                    self._counters["failed_batches"] += 1
+                else:
+                    for outcome, count in counts.items():
+                        self._outcomes[outcome] = self._outcomes.get(outcome, 0) + count
+
+    def stats(self):
+        now = time.monotonic()
+        with self._stats_lock:
+            while self._drained and self._drained[0][0] < now - self.DRAIN_RATE_WINDOW_SECONDS:
+                self._drained.popleft()
+            drained = sum(count for _, count in self._drained)
+            return {
+                "depth": self.depth(),
+                "high_water_mark": self.high_water_mark,
+                "workers": self.workers,
+                **self._counters,
+                **self._outcomes,
+                "drain_rate_per_second": round(drained / self.DRAIN_RATE_WINDOW_SECONDS, 2)
+            }
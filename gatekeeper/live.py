@@ -0,0 +1,80 @@
+"""Live presence feed
+Purpose: pushes every permanence log that is opened, closed or edited and every unassigned tag entry to the browsers
+looking at the log and entry tables, as soon as the transaction that wrote it commits. The rows are announced by the
+trg_permanence_log_notify and trg_unassigned_tag_entry_notify triggers on PRESENCE_CHANNEL, whatever wrote them
+(any ingest mode or strategy, or an operator), and every row is loaded once and handed to all the connected clients.
+
+Usage: build it with a load_row(table, id) callable returning the row to show, or None, subscribe notify() to
+PRESENCE_CHANNEL on a NotificationListener, then subscribe() a queue for every client and unsubscribe() it when the
+client goes away. Clients get (table, row) events, or RESYNC when they may have missed some and have to reload
+their table: after the listener reconnects, or when they fall more than max_pending events behind.
+"""
+
+import json
+import queue
+import threading
+
+# Channel notified by the trg_permanence_log_notify and trg_unassigned_tag_entry_notify triggers
+PRESENCE_CHANNEL = "presence_event"
+
+# Event telling a client to reload its table
+RESYNC = "resync"
+
+
+class PresenceFeed:
+    def __init__(self, load_row, max_clients=8, max_pending=100):
+        self.load_row = load_row
+        self.max_clients = max_clients
+        self.max_pending = max_pending
+        self._clients = set()
+        self._lock = threading.Lock()
+        self._published = 0
+        self._resyncs = 0
+
+    def subscribe(self):
+        """A queue receiving the events from now on, or None if max_clients are already connected."""
+        with self._lock:
+            if len(self._clients) >= self.max_clients:
+                return None
+            client = queue.Queue(self.max_pending)
+            self._clients.add(client)
+            return client
+
+    def unsubscribe(self, client):
+        with self._lock:
+            self._clients.discard(client)
+
+    def notify(self, payload):
+        """NotificationListener callback"""
+        with self._lock:
+            clients = list(self._clients)
+        # Nobody is watching, no need to load anything
+        if not clients:
+            return
+        if payload is None:
+            self.publish(clients, RESYNC)
+            return
+        event = json.loads(payload)
+        row = self.load_row(event["table"], event["id"])
+        if row is not None:
+            self.publish(clients, (event["table"], row))
+
+    def publish(self, clients, event):
+        for client in clients:
+            try:
+                client.put_nowait(event)
+            except queue.Full:
+                # The client is too far behind to catch up row by row: drop what it has queued and make it reload
+                try:
+                    while True:
+                        client.get_nowait()
+                except queue.Empty:
+                    pass
+                client.put_nowait(RESYNC)
+                self._resyncs += 1
+        self._published += 1
+
+    def stats(self):
+        with self._lock:
+            clients = len(self._clients)
+        return {"clients": clients, "published": self._published, "resyncs": self._resyncs}
@@ -0,0 +1,58 @@
+"""Postgres LISTEN/NOTIFY fan-out
+Purpose: keeps one dedicated autocommit connection listening on any number of channels, and calls the callbacks
+subscribed to a channel whenever a notification arrives on it.
+
+Usage: subscribe the callbacks, then call start(). After every (re)connection each callback is also called with
+None as the payload, because notifications sent while the listener was disconnected are lost: subscribers are
+expected to resync their whole state when they get None.
+"""
+
+import threading
+import time
+import psycopg
+from psycopg import sql
+
+
+class NotificationListener:
+    RECONNECT_DELAY_SECONDS = 5.0
+    POLL_TIMEOUT_SECONDS = 1.0
+
+    def __init__(self, conninfo):
+        self.conninfo = conninfo
+        self._callbacks = {}
+        self._stop = threading.Event()
+        self._thread = None
+
+    def subscribe(self, channel, callback):
+        self._callbacks.setdefault(channel, []).append(callback)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="pg-notification-listener", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _dispatch(self, channel, payload):
+        for callback in self._callbacks.get(channel, []):
+            try:
+                callback(payload)
+            except Exception as e:
+                print(f"Error in notification callback for {channel}: {e}")
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                with psycopg.connect(self.conninfo, autocommit=True) as conn:
+                    for channel in self._callbacks:
+                        conn.execute(sql.SQL("LISTEN {}").format(sql.Identifier(channel)))
+                    for channel in self._callbacks:
+                        self._dispatch(channel, None)
+                    while not self._stop.is_set():
+                        for notify in conn.notifies(timeout=self.POLL_TIMEOUT_SECONDS):
+                            self._dispatch(notify.channel, notify.payload)
+            except psycopg.Error as e:
+                print(f"Notification listener disconnected: {e}")
+                time.sleep(self.RECONNECT_DELAY_SECONDS)
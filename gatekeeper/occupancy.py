@@ -0,0 +1,227 @@
+"""Shipyard occupancy
+Purpose: how many people are in every shipyard right now, and how many there were over time. The headcount of a
+shipyard is the number of its open logs. The Ingestor moves the counters kept here as it opens and closes logs, so
+the current headcount is read without querying permanence_log; the logs opened or closed anywhere else (the web
+pages, the shard processes, the ingest_advertisements function) are picked up by reconcile(), which counts the open
+logs again every reconcile_interval seconds, or as soon as one is asked for with request_reconcile(), and replaces the
+counters with them.
+
+Every sample_interval seconds the counters are written to occupancy_sample (migrations/009_occupancy_series.sql),
+which adds them to the minute, hour and day buckets of the moment; the minute buckets are deleted after minute_days
+days and the hour buckets after hour_days days.
+
+Usage: build it with the pool, pass it to the Ingestor, call start() at startup and stop() at shutdown. The Ingestor
+calls apply() after every committed batch with the change of the open logs of every shipyard and the id of the
+transaction that made it. request_reconcile() has the counters counted again by the background thread after a change
+made anywhere else. current() gives the counters, series() the buckets of a time range.
+"""
+
+import threading
+import time
+from datetime import datetime, timedelta
+
+# Bucket width of every resolution, from the finest
+RESOLUTIONS = {"minute": timedelta(minutes=1), "hour": timedelta(hours=1), "day": timedelta(days=1)}
+
+
+class Snapshot:
+    """The transactions visible to a query, from the text of pg_current_snapshot()"""
+
+    def __init__(self, text):
+        xmin, xmax, xip = text.split(":")
+        self.xmin = int(xmin)
+        self.xmax = int(xmax)
+        self.xip = {int(xid) for xid in xip.split(",") if xid}
+
+    def visible(self, xid):
+        """Whether a committed transaction was committed before the snapshot was taken"""
+        return xid < self.xmin or (xid < self.xmax and xid not in self.xip)
+
+
+class OccupancyTracker:
+    def __init__(self, pool, sample_interval=60, reconcile_interval=300, minute_days=7, hour_days=366,
+                 expire_interval=3600):
+        self.pool = pool
+        self.sample_interval = sample_interval
+        self.reconcile_interval = reconcile_interval
+        self.minute_days = minute_days
+        self.hour_days = hour_days
+        self.expire_interval = expire_interval
+        self._counts = {}  # shipyard id -> open logs
+        self._snapshot = None  # of the last reconcile, the transactions it counted
+        self._journal = None  # (xid, deltas) applied while a reconcile runs
+        self._stop = threading.Event()
+        # Set by stop() and request_reconcile(), wakes the thread between two samples
+        self._wake = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._reconcile_lock = threading.Lock()
+        self._counters = {"applied": 0, "reconciles": 0, "corrections": 0, "samples": 0, "failed_rounds": 0}
+        self._last_sample = None
+
+    def start(self, reconcile_interval=None):
+        """reconcile_interval overrides the one given at build, e.g. when no Ingestor of this process feeds it"""
+        if self._thread is not None:
+            return
+        if reconcile_interval is not None:
+            self.reconcile_interval = reconcile_interval
+        self._thread = threading.Thread(target=self._run, name="occupancy", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+
+    def request_reconcile(self):
+        """Have the background thread count the open logs again as soon as it can, without waiting for it"""
+        self._wake.set()
+
+    def _run(self):
+        last_reconcile = last_expire = None
+        while True:
+            now = time.monotonic()
+            try:
+                # The first round reconciles at startup, the counters start empty
+                if last_reconcile is None or now - last_reconcile >= self.reconcile_interval - 1:
+                    self.reconcile()
+                    last_reconcile = now
+                self.sample()
+                if last_expire is None or now - last_expire >= self.expire_interval:
+                    self.expire()
+                    last_expire = now
+            except Exception as e:
+                with self._lock:
+                    self._counters["failed_rounds"] += 1
+                print(f"Error in occupancy sampling: {e}")
+            # On the turn of the interval, so that every sample lands in a bucket of its own
+            next_sample = time.time() + self.sample_interval - time.time() % self.sample_interval
+            while self._wake.wait(max(0.0, next_sample - time.time())):
+                if self._stop.is_set():
+                    return
+                # Cleared first, so that the requests made while it runs get a reconcile of their own
+                self._wake.clear()
+                try:
+                    self.reconcile()
+                    last_reconcile = time.monotonic()
+                except Exception as e:
+                    with self._lock:
+                        self._counters["failed_rounds"] += 1
+                    print(f"Error in occupancy sampling: {e}")
+            if self._stop.is_set():
+                return
+
+    def apply(self, deltas, xid):
+        """Add the change of the open logs of every shipyard made by the committed transaction xid"""
+        with self._lock:
+            self._counters["applied"] += 1
+            if self._journal is not None:
+                self._journal.append((xid, deltas))
+            # Already counted by the last reconcile, if it committed before it
+            if self._snapshot is not None and self._snapshot.visible(xid):
+                return
+            for shipyard_id, delta in deltas.items():
+                self._counts[shipyard_id] = self._counts.get(shipyard_id, 0) + delta
+
+    def reconcile(self):
+        """Count the open logs again and replace the counters, returns by how much they were off"""
+        with self._reconcile_lock:
+            with self._lock:
+                self._journal = []
+            try:
+                with self.pool.connection() as conn:
+                    # The snapshot of the count itself, from the same statement
+                    rows = conn.execute("""
+                        SELECT s.snapshot, c.shipyard_id, c.headcount
+                        FROM (SELECT pg_current_snapshot()::text AS snapshot) s
+                        LEFT JOIN (
+                            SELECT shipyard_id, COUNT(*) AS headcount
+                            FROM permanence_log
+                            WHERE leave_timestamp IS NULL AND shipyard_id IS NOT NULL
+                            GROUP BY shipyard_id
+                        ) c ON TRUE
+                    """).fetchall()
+                snapshot = Snapshot(rows[0]["snapshot"])
+                counts = {row["shipyard_id"]: row["headcount"] for row in rows if row["shipyard_id"] is not None}
+                with self._lock:
+                    # The batches applied meanwhile that committed after the count was taken
+                    for xid, deltas in self._journal:
+                        if not snapshot.visible(xid):
+                            for shipyard_id, delta in deltas.items():
+                                counts[shipyard_id] = counts.get(shipyard_id, 0) + delta
+                    off = sum(
+                        abs(counts.get(shipyard_id, 0) - self._counts.get(shipyard_id, 0))
+                        for shipyard_id in counts.keys() | self._counts.keys()
+                    )
+                    # The first one fills the counters, it corrects nothing
+                    if self._snapshot is not None:
+                        self._counters["corrections"] += off
+                    self._counts = counts
+                    self._snapshot = snapshot
+                    self._counters["reconciles"] += 1
+                return off
+            finally:
+                with self._lock:
+                    self._journal = None
+
+    def current(self):
+        """Open logs of every shipyard that has any"""
+        with self._lock:
+            return {shipyard_id: count for shipyard_id, count in self._counts.items() if count}
+
+    def sample(self):
+        """Add the counters to the buckets of now"""
+        counts = self.current()
+        with self.pool.connection() as conn:
+            conn.execute(
+                "SELECT record_occupancy(%s::integer[], %s::integer[])",
+                (list(counts.keys()), list(counts.values()))
+            )
+        with self._lock:
+            self._counters["samples"] += 1
+            self._last_sample = datetime.now()
+
+    def expire(self):
+        """Delete the minute and hour buckets past their days, returns how many"""
+        with self.pool.connection() as conn:
+            return conn.execute(
+                "SELECT expire_occupancy_samples(%s, %s) AS expired", (self.minute_days, self.hour_days)
+            ).fetchone()["expired"]
+
+    def resolution(self, start, end, max_points):
+        """
+        The finest resolution with at most max_points buckets from start to end that is still kept for start, the
+        day one if none is
+        """
+        now = datetime.now()
+        kept = {"minute": timedelta(days=self.minute_days), "hour": timedelta(days=self.hour_days)}
+        for resolution, days in kept.items():
+            if (end - start) / RESOLUTIONS[resolution] <= max_points and start >= now - days:
+                return resolution
+        return "day"
+
+    def series(self, curs, resolution, start, end, shipyard_id=None):
+        """The buckets of resolution from the one holding start to end, by shipyard and time"""
+        conditions = ["os.resolution = %s", "os.bucket >= date_trunc(%s, %s::timestamp)", "os.bucket <= %s"]
+        params = [resolution, resolution, start, end]
+        if shipyard_id is not None:
+            conditions.append("os.shipyard_id = %s")
+            params.append(shipyard_id)
+        curs.execute(f"""
+            SELECT os.shipyard_id, s.name AS shipyard_name, os.bucket, os.headcount_avg, os.headcount_min,
+                os.headcount_max
+            FROM occupancy_sample os
+            JOIN shipyard s ON s.id = os.shipyard_id
+            WHERE {" AND ".join(conditions)}
+            ORDER BY os.shipyard_id, os.bucket
+        """, params)
+        return curs.fetchall()
+
+    def stats(self):
+        with self._lock:
+            return {
+                "headcount": sum(self._counts.values()),
+                "sample_interval": self.sample_interval,
+                "reconcile_interval": self.reconcile_interval,
+                "last_sample": self._last_sample.isoformat() if self._last_sample else None,
+                **self._counters
+            }
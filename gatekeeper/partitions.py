@@ -0,0 +1,72 @@
+"""Event table partitions
+Purpose: permanence_log and unassigned_tag_entry are partitioned by month (migrations/006_event_partitions.sql). This
+keeps the partitions of the coming months created ahead of time, so that new rows never land in the default
+partitions, and, when a retention is set, detaches the partitions of the months older than that into the
+event_archive schema, which takes no longer for a month of millions of rows than for an empty one and leaves nothing
+behind to vacuum, unlike deleting them. The archived months are out of every query and can be exported to files and
+dropped with python -m tools.partitions --export DIR.
+
+Usage: build it with the pool, the months to create ahead and the months to keep before the current one (0 keeps
+everything), call start() at startup and stop() at shutdown. maintain() runs one round right away.
+"""
+
+import threading
+
+
+class PartitionMaintainer:
+    def __init__(self, pool, months_ahead=3, retention_months=0, interval=6 * 3600):
+        self.pool = pool
+        self.months_ahead = months_ahead
+        self.retention_months = retention_months
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = None
+        self._lock = threading.Lock()
+        self._counters = {"created": 0, "detached": 0, "failed_rounds": 0}
+
+    def start(self):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, name="partition-maintenance", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        # The first round runs at startup, so that a server that was down at the turn of a month catches up
+        while True:
+            try:
+                self.maintain()
+            except Exception as e:
+                with self._lock:
+                    self._counters["failed_rounds"] += 1
+                print(f"Error in partition maintenance: {e}")
+            if self._stop.wait(self.interval):
+                return
+
+    def maintain(self):
+        """Create the partitions of the coming months and detach the expired ones, returns the detached ones"""
+        with self.pool.connection() as conn:
+            created = conn.execute(
+                "SELECT create_event_partitions(%s) AS created", (self.months_ahead,)
+            ).fetchone()["created"]
+            detached = []
+            if self.retention_months > 0:
+                detached = [row["name"] for row in conn.execute(
+                    "SELECT detach_event_partitions(%s) AS name", (self.retention_months,)
+                ).fetchall()]
+        for name in detached:
+            print(f"Partition {name} detached to event_archive")
+        with self._lock:
+            self._counters["created"] += created
+            self._counters["detached"] += len(detached)
+        return detached
+
+    def stats(self):
+        with self._lock:
+            return {
+                "months_ahead": self.months_ahead,
+                "retention_months": self.retention_months,
+                **self._counters
+            }
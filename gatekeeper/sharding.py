@@ -0,0 +1,228 @@
+"""Sharded multi-process ingest
+Purpose: spreads advertisement processing over several worker processes, so that it runs in parallel across CPU cores
+instead of sharing the GIL of the web server. Every tag MAC address is hashed to exactly one shard, and every shard
+processes its queue in order with a single consumer, so the advertisements of a tag are always applied in the order they
+were received, and written with the time they were submitted rather than the time they were processed. Each worker
+process owns its own small connection pool, beacon registry and tag state engine, which only holds the tags of its
+shard.
+
+Usage: build it with the database URL and the shard options, call start() at startup (from the main process only:
+workers are started with the spawn method, see spawning.py) and stop() at shutdown, then submit() the decoded
+advertisements of every gateway message. submit() returns False when a shard is above its high-water mark. stats()
+returns the counters and the throughput of every shard.
+"""
+
+import queue
+import threading
+import time
+import zlib
+from collections import deque
+from datetime import datetime
+
+from .spawning import spawn_context
+
+# Layout of the shared counters of each shard
+_PENDING, _PROCESSED, _ACCEPTED, _DUPLICATE, _IGNORED, _BUSY_SECONDS, _DEDUP_HITS, _DEDUP_MISSES = range(8)
+_COUNTERS = 8
+
+
+def shard_of(mac_address, shards):
+    """Stable across processes and restarts, unlike hash()"""
+    return zlib.crc32(mac_address.encode()) % shards
+
+
+def _shard_main(shard, shards, conninfo, pool_size, batch_size, flush_interval, engine_options, dedup_options,
+                strategy, pipeline, inbox, counters):
+    # Imported here so that only the worker processes pay for them
+    from psycopg.rows import dict_row
+    from psycopg_pool import ConnectionPool
+    from .beacons import BeaconRegistry, BEACON_CHANNEL
+    from .notifications import NotificationListener
+    from .tag_state import TagStateEngine, ADVERTISEMENT_ACCEPTED, ADVERTISEMENT_DUPLICATE, ADVERTISEMENT_IGNORED
+    from .dedup import DuplicateCache
+    from .ingest import Ingestor, ProcedureIngestor
+
+    pool = ConnectionPool(
+        conninfo=conninfo,
+        min_size=1,
+        max_size=pool_size,
+        timeout=30.0,
+        configure=lambda conn: setattr(conn, 'row_factory', dict_row)
+    )
+    duplicate_cache = DuplicateCache(**dedup_options)
+    notification_listener = None
+    tag_state_engine = None
+    if strategy == "procedure":
+        # The database function keeps the tag state, there is nothing to load
+        ingestor = ProcedureIngestor(pool, duplicate_cache)
+    else:
+        beacon_registry = BeaconRegistry(pool)
+        notification_listener = NotificationListener(conninfo)
+        notification_listener.subscribe(BEACON_CHANNEL, beacon_registry.reload)
+        tag_state_engine = TagStateEngine(pool, beacon_registry, **engine_options)
+        ingestor = Ingestor(pool, beacon_registry, tag_state_engine, duplicate_cache, pipeline)
+
+        beacon_registry.load()
+        notification_listener.start()
+        tag_state_engine.load(owns=lambda mac_address: shard_of(mac_address, shards) == shard)
+        tag_state_engine.start(flush_interval)
+
+    stopping = False
+    while not stopping:
+        message = inbox.get()
+        if message is None:
+            break
+        batch = []
+        timestamps = []
+        while True:
+            advertisements, received_at = message
+            batch.extend(advertisements)
+            timestamps.extend([received_at] * len(advertisements))
+            if len(batch) >= batch_size:
+                break
+            try:
+                message = inbox.get_nowait()
+            except queue.Empty:
+                break
+            if message is None:
+                stopping = True
+                break
+
+        started = time.perf_counter()
+        try:
+            counts = ingestor.process_advertisements(batch, timestamps)
+        except Exception as e:
+            print(f"Error in ingest shard {shard}: {e}")
+            counts = {ADVERTISEMENT_IGNORED: len(batch)}
+        busy_seconds = time.perf_counter() - started
+
+        with counters.get_lock():
+            counters[_PENDING] -= len(batch)
+            counters[_PROCESSED] += len(batch)
+            counters[_ACCEPTED] += counts.get(ADVERTISEMENT_ACCEPTED, 0)
+            counters[_DUPLICATE] += counts.get(ADVERTISEMENT_DUPLICATE, 0)
+            counters[_IGNORED] += counts.get(ADVERTISEMENT_IGNORED, 0)
+            counters[_BUSY_SECONDS] += busy_seconds
+            counters[_DEDUP_HITS] = duplicate_cache.hits
+            counters[_DEDUP_MISSES] = duplicate_cache.misses
+
+    if tag_state_engine is not None:
+        notification_listener.stop()
+        tag_state_engine.stop()
+    pool.close()
+
+
+class ShardedIngest:
+    # Throughput is averaged over this many seconds
+    THROUGHPUT_WINDOW_SECONDS = 60.0
+
+    def __init__(self, conninfo, shards, pool_size, high_water_mark, batch_size, flush_interval, engine_options,
+                 dedup_options, strategy="memory", pipeline=False):
+        self.conninfo = conninfo
+        self.shards = shards
+        self.pool_size = pool_size
+        self.high_water_mark = high_water_mark
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.engine_options = engine_options
+        self.dedup_options = dedup_options
+        self.strategy = strategy
+        self.pipeline = pipeline
+        # The shard processes import the gatekeeper package only, never the main module of the server
+        self._context = spawn_context()
+        self._inboxes = []
+        self._counters = []
+        self._processes = []
+        self._samples = deque()  # (monotonic time, processed devices of every shard)
+        self._undecodable = 0
+        self._lock = threading.Lock()
+
+    def start(self):
+        if self._processes:
+            return
+        for shard in range(self.shards):
+            inbox = self._context.Queue()
+            counters = self._context.Array('d', _COUNTERS)
+            process = self._context.Process(
+                target=_shard_main,
+                args=(
+                    shard, self.shards, self.conninfo, self.pool_size, self.batch_size,
+                    self.flush_interval, self.engine_options, self.dedup_options, self.strategy, self.pipeline,
+                    inbox, counters
+                ),
+                name=f"ingest-shard-{shard}",
+                daemon=True
+            )
+            process.start()
+            self._inboxes.append(inbox)
+            self._counters.append(counters)
+            self._processes.append(process)
+
+    def stop(self, timeout=10.0):
+        for inbox in self._inboxes:
+            inbox.put(None)
+        deadline = time.monotonic() + timeout
+        for process in self._processes:
+            process.join(max(0.0, deadline - time.monotonic()))
+
+    def submit(self, advertisements):
+        received_at = datetime.now()
+        by_shard = {}
+        ignored = 0
+        for advertisement in advertisements:
+            if advertisement is None:
+                ignored += 1
+                continue
+            by_shard.setdefault(shard_of(advertisement.mac_address, self.shards), []).append(advertisement)
+
+        with self._lock:
+            for shard, advertisements in by_shard.items():
+                if self._counters[shard][_PENDING] + len(advertisements) > self.high_water_mark:
+                    return False
+
+            for shard, advertisements in by_shard.items():
+                counters = self._counters[shard]
+                with counters.get_lock():
+                    counters[_PENDING] += len(advertisements)
+                self._inboxes[shard].put((advertisements, received_at))
+            self._undecodable += ignored
+        return True
+
+    def stats(self):
+        now = time.monotonic()
+        snapshot = []
+        for counters in self._counters:
+            with counters.get_lock():
+                snapshot.append(list(counters))
+
+        with self._lock:
+            self._samples.append((now, [values[_PROCESSED] for values in snapshot]))
+            while len(self._samples) > 1 and self._samples[0][0] < now - self.THROUGHPUT_WINDOW_SECONDS:
+                self._samples.popleft()
+            oldest_time, oldest_processed = self._samples[0]
+        elapsed = now - oldest_time
+
+        shards = []
+        for shard, values in enumerate(snapshot):
+            recent = values[_PROCESSED] - oldest_processed[shard]
+            shards.append({
+                "shard": shard,
+                "alive": self._processes[shard].is_alive(),
+                "pending": int(values[_PENDING]),
+                "processed": int(values[_PROCESSED]),
+                "accepted": int(values[_ACCEPTED]),
+                "duplicate": int(values[_DUPLICATE]),
+                "ignored": int(values[_IGNORED]),
+                "dedup_hits": int(values[_DEDUP_HITS]),
+                "dedup_misses": int(values[_DEDUP_MISSES]),
+                # Devices per second over the last samples, and per second actually spent processing
+                "throughput_per_second": round(recent / elapsed, 2) if elapsed > 0 else 0.0,
+                "capacity_per_second": round(values[_PROCESSED] / values[_BUSY_SECONDS], 2) if values[_BUSY_SECONDS] else None
+            })
+        return {
+            "shards": shards,
+            "high_water_mark": self.high_water_mark,
+            "pending": sum(shard["pending"] for shard in shards),
+            "undecodable": self._undecodable,
+            "throughput_per_second": round(sum(shard["throughput_per_second"] for shard in shards), 2)
+        }
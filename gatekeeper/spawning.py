@@ -0,0 +1,52 @@
+"""Worker process spawning
+Purpose: the shard processes of ShardedIngest and the export workers of ExportJobs are started with the spawn method,
+which normally runs the main module of the parent again in every child, as __mp_main__, so that the objects defined
+there can be unpickled. The main module of the backend is server.py: every child would build the Flask app, the
+connection pool and the production wiring again, and run every side effect added to it later. The children started
+from this context skip the main module: their target is a function of the gatekeeper package, imported by name, and
+everything it needs is passed to it as arguments.
+
+Usage: spawn_context() returns the multiprocessing context to build the processes, queues and shared values with, or
+to pass as mp_context to a ProcessPoolExecutor.
+"""
+
+import threading
+from multiprocessing import spawn
+from multiprocessing.context import SpawnContext, SpawnProcess
+
+_launching = threading.local()
+_get_preparation_data = spawn.get_preparation_data
+
+
+def _preparation_data(name):
+    # What the child sets up before running its target: the main module is left out only for the processes of this
+    # context, and only on the thread launching them
+    data = _get_preparation_data(name)
+    if getattr(_launching, "without_main", False):
+        data.pop("init_main_from_name", None)
+        data.pop("init_main_from_path", None)
+    return data
+
+
+class _Process(SpawnProcess):
+    @staticmethod
+    def _Popen(process_obj):
+        _launching.without_main = True
+        try:
+            return SpawnProcess._Popen(process_obj)
+        finally:
+            _launching.without_main = False
+
+
+class _Context(SpawnContext):
+    Process = _Process
+
+
+_context = _Context()
+
+
+def spawn_context():
+    # Installed once, it behaves as the original for every other process
+    if spawn.get_preparation_data is not _preparation_data:
+        spawn.get_preparation_data = _preparation_data
+    return _context
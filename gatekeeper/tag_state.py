@@ -0,0 +1,273 @@
+"""Tag state engine
+Purpose: keeps the battery, packet counter and previous echobeacon of every tag in memory, so that the duplicate and
+direction decisions for an advertisement are taken without touching the database. The state is written back to the
+tag table in bulk by a background thread (write-behind), and reloaded from it at startup. Battery readings are
+coalesced: a tag whose packet counter didn't change is only written back when its battery moved by at least
+battery_delta percentage points, or when its last written battery is older than battery_max_interval seconds.
+
+Usage: build it with the connection pool and the beacon registry, call load() and start() at startup and stop() at
+shutdown, then call observe() for every decoded advertisement. observe() returns the outcome of the advertisement and,
+when a beacon pair was completed, the Movement that has to be recorded as a log or an unassigned tag entry. The
+changes observe() makes to the packet counters and pairings are collected in an undo list if one is given, and
+restore() puts them back when the movements of those advertisements could not be written, so that the retry of the
+same packets is decided again instead of being taken for a duplicate.
+"""
+
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+# Outcomes of an advertisement
+ADVERTISEMENT_ACCEPTED = "accepted"
+ADVERTISEMENT_DUPLICATE = "duplicate"
+ADVERTISEMENT_IGNORED = "ignored"
+
+
+class Movement(NamedTuple):
+    tag_id: int
+    shipyard_id: int
+    is_entering: bool
+    # When the advertisement was received, written on the log or entry instead of the time of the write
+    timestamp: Optional[datetime] = None
+
+
+class TagState:
+    __slots__ = (
+        "tag_id", "remaining_battery", "packet_counter", "previous_echobeacon",
+        "flushed_battery", "battery_flushed_at"
+    )
+
+    def __init__(self, tag_id, remaining_battery, packet_counter, previous_echobeacon):
+        self.tag_id = tag_id
+        self.remaining_battery = remaining_battery
+        self.packet_counter = packet_counter
+        self.previous_echobeacon = previous_echobeacon
+        # Battery as last written to the tag table
+        self.flushed_battery = remaining_battery
+        self.battery_flushed_at = time.monotonic()
+
+
+class TagStateEngine:
+    # Unknown MAC addresses are looked up in the tag table again only after this many seconds
+    UNKNOWN_TAG_RETRY_SECONDS = 60.0
+
+    def __init__(self, pool, beacon_registry, battery_delta=1.0, battery_max_interval=600.0):
+        self.pool = pool
+        self.beacon_registry = beacon_registry
+        self.battery_delta = battery_delta
+        self.battery_max_interval = battery_max_interval
+        self._states = {}
+        # Tags whose packet counter or pairing changed, and tags whose battery only differs from the written one
+        self._dirty = set()
+        self._battery_pending = set()
+        self._unknown = {}
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # ===== LOADING =====
+
+    def load(self, owns=None):
+        """Load the state of every tag, or only of the MAC addresses for which owns() is true."""
+        with self.pool.connection() as conn:
+            rows = conn.execute("""
+                SELECT id, mac_address, remaining_battery, packet_counter, previous_echobeacon
+                FROM tag
+                WHERE mac_address IS NOT NULL
+            """).fetchall()
+        states = {
+            row['mac_address']: TagState(row['id'], row['remaining_battery'], row['packet_counter'], row['previous_echobeacon'])
+            for row in rows
+            if owns is None or owns(row['mac_address'])
+        }
+        with self._lock:
+            self._states = states
+            self._dirty.clear()
+            self._battery_pending.clear()
+            self._unknown.clear()
+
+    def _state_for(self, mac_address):
+        state = self._states.get(mac_address)
+        if state is not None:
+            return state
+
+        # Tags registered after load() are picked up on their first advertisement
+        retry_at = self._unknown.get(mac_address)
+        if retry_at is not None and retry_at > time.monotonic():
+            return None
+        with self.pool.connection() as conn:
+            row = conn.execute("""
+                SELECT id, remaining_battery, packet_counter, previous_echobeacon
+                FROM tag
+                WHERE mac_address = %s
+            """, (mac_address,)).fetchone()
+        with self._lock:
+            if not row:
+                self._unknown[mac_address] = time.monotonic() + self.UNKNOWN_TAG_RETRY_SECONDS
+                return None
+            self._unknown.pop(mac_address, None)
+            return self._states.setdefault(
+                mac_address,
+                TagState(row['id'], row['remaining_battery'], row['packet_counter'], row['previous_echobeacon'])
+            )
+
+    # ===== DECISIONS =====
+
+    def observe(self, mac_address, packet_counter, remaining_battery, current_beacon, undo=None):
+        """
+        Apply an advertisement to the state of its tag and return (outcome, movement).
+        movement is None unless the advertisement completes a valid beacon pair, in which case the pairing is reset.
+        If the packet counter changes, (mac_address, old packet counter, old previous echobeacon, new packet counter)
+        is appended to undo, when given.
+        """
+        state = self._state_for(mac_address)
+        if state is None:
+            return ADVERTISEMENT_IGNORED, None
+
+        with self._lock:
+            # Every advertisement updates the battery, even if it is not valid
+            state.remaining_battery = remaining_battery
+            if remaining_battery != state.flushed_battery:
+                self._battery_pending.add(mac_address)
+
+            old_packet_counter = state.packet_counter
+            previous_echobeacon_id = state.previous_echobeacon
+
+            # Ignore duplicates
+            if old_packet_counter == packet_counter:
+                return ADVERTISEMENT_DUPLICATE, None
+
+            # Set previous_echobeacon to current beacon only when packet changes
+            self._dirty.add(mac_address)
+            if undo is not None:
+                undo.append((mac_address, old_packet_counter, previous_echobeacon_id, packet_counter))
+            state.packet_counter = packet_counter
+            state.previous_echobeacon = current_beacon.id if current_beacon else None
+
+            # First-ever packets and packets without a prior beacon can't compute a direction
+            if old_packet_counter is None or not previous_echobeacon_id:
+                return ADVERTISEMENT_ACCEPTED, None
+
+            # No movement across same beacon, or from/to beacons that don't exist
+            if not current_beacon or previous_echobeacon_id == current_beacon.id:
+                return ADVERTISEMENT_ACCEPTED, None
+            previous_beacon = self.beacon_registry.by_id(previous_echobeacon_id)
+            if not previous_beacon:
+                return ADVERTISEMENT_ACCEPTED, None
+
+            # Ignore cross-yard transitions
+            if current_beacon.shipyard_id != previous_beacon.shipyard_id:
+                return ADVERTISEMENT_ACCEPTED, None
+
+            # Direction from beacon pair
+            if previous_beacon.is_first_when_entering and not current_beacon.is_first_when_entering:
+                is_direction_entering = True
+            elif (not previous_beacon.is_first_when_entering) and current_beacon.is_first_when_entering:
+                is_direction_entering = False
+            else:
+                return ADVERTISEMENT_ACCEPTED, None  # invalid pair (e.g., two firsts or two seconds)
+
+            # Reset pairing (prevents overlapping pairs)
+            state.previous_echobeacon = None
+            return ADVERTISEMENT_ACCEPTED, Movement(state.tag_id, current_beacon.shipyard_id, is_direction_entering)
+
+    def restore(self, undo):
+        """
+        Put back the packet counters and pairings of an undo list filled by observe(), latest first. A tag that saw a
+        later packet in the meantime keeps its state, the retry of the old packet is decided on that one.
+        """
+        with self._lock:
+            for mac_address, packet_counter, previous_echobeacon, observed_packet_counter in reversed(undo):
+                state = self._states.get(mac_address)
+                if state is None or state.packet_counter != observed_packet_counter:
+                    continue
+                state.packet_counter = packet_counter
+                state.previous_echobeacon = previous_echobeacon
+                self._dirty.add(mac_address)
+
+    # ===== WRITE-BEHIND =====
+
+    def _battery_due(self, state, now):
+        if state.remaining_battery == state.flushed_battery:
+            return False
+        if state.flushed_battery is None or state.remaining_battery is None:
+            return True
+        return abs(state.remaining_battery - state.flushed_battery) >= self.battery_delta \
+            or now - state.battery_flushed_at >= self.battery_max_interval
+
+    def flush(self, force=False):
+        """
+        Write the changed tag states back in one statement. Battery-only changes that are still below the
+        coalescing thresholds are kept for a later flush, unless force is set.
+        """
+        now = time.monotonic()
+        with self._lock:
+            battery_due = {
+                mac_address for mac_address in self._battery_pending
+                if force or self._battery_due(self._states[mac_address], now)
+            }
+            flushed = self._dirty | battery_due
+            rows = []
+            written_batteries = {}
+            for mac_address in flushed:
+                state = self._states.get(mac_address)
+                if state is not None:
+                    rows.append((state.tag_id, state.remaining_battery, state.packet_counter, state.previous_echobeacon))
+                    written_batteries[mac_address] = state.remaining_battery
+            self._dirty = set()
+            self._battery_pending -= flushed
+        if not rows:
+            return 0
+
+        try:
+            with self.pool.connection() as conn:
+                # Rows that already hold these values are skipped, so they don't leave dead tuples behind.
+                # Beacons deleted since the advertisement are stored as NULL, like the foreign key would do
+                conn.execute("""
+                    UPDATE tag
+                    SET remaining_battery = v.remaining_battery,
+                        packet_counter = v.packet_counter,
+                        previous_echobeacon = (SELECT id FROM activator_beacon WHERE id = v.previous_echobeacon)
+                    FROM unnest(%s::integer[], %s::real[], %s::smallint[], %s::integer[])
+                        AS v(id, remaining_battery, packet_counter, previous_echobeacon)
+                    WHERE tag.id = v.id
+                    AND (
+                        tag.remaining_battery IS DISTINCT FROM v.remaining_battery
+                        OR tag.packet_counter IS DISTINCT FROM v.packet_counter
+                        OR tag.previous_echobeacon IS DISTINCT FROM v.previous_echobeacon
+                    )
+                """, [list(column) for column in zip(*rows)])
+        except Exception:
+            with self._lock:
+                self._dirty |= flushed
+            raise
+
+        with self._lock:
+            for mac_address, battery in written_batteries.items():
+                state = self._states.get(mac_address)
+                if state is None:
+                    continue
+                state.flushed_battery = battery
+                state.battery_flushed_at = now
+                # Readings that arrived while the statement was running wait for the next flush
+                if state.remaining_battery != battery:
+                    self._battery_pending.add(mac_address)
+        return len(rows)
+
+    def start(self, flush_interval):
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(target=self._run, args=(flush_interval,), name="tag-state-flush", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self.flush(force=True)
+
+    def _run(self, flush_interval):
+        while not self._stop.wait(flush_interval):
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Error in tag state flush: {e}")
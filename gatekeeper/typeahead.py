@@ -0,0 +1,172 @@
+"""Typeahead name index
+Purpose: the search and filter dropdowns look up ships, roles, shipyards and crew members by a case insensitive
+substring of their name at every debounced keystroke. These tables are small and change rarely, so their names are
+kept in memory, case-folded and in name order, and the dropdowns are answered without a database round trip. The
+folded names of a table are joined in a single string, so that finding a substring (or a prefix) is a str.find() over
+all of them, and the first matches found are already in name order.
+
+Two differences from the ORDER BY and LIKE queries it replaces: names are ordered by their str.casefold() code points,
+not by the collation of the database (accented letters come after "z"), and the query is a plain substring, so "%" and
+"_" match themselves instead of being wildcards.
+
+Usage: build it with the connection pool and subscribe notify() to LOOKUP_CHANNEL on a NotificationListener: the
+trg_*_lookup_notify triggers send every inserted, renamed or deleted row, which is applied to the index without
+reloading it. Every table is loaded the first time it is searched, and again after invalidate(), which the web
+routes call after their writes so that they don't depend on the listener. search() returns (id, name) tuples in
+name order, all() every row, name() the name of an id.
+"""
+
+import bisect
+import json
+import threading
+from typing import NamedTuple
+
+# Channel notified by the trg_*_lookup_notify triggers
+LOOKUP_CHANNEL = "lookup_changed"
+
+# Indexed tables and their name column
+LOOKUP_TABLES = {
+    "ship": "name",
+    "crew_member_roles": "role_name",
+    "shipyard": "name",
+    "crew_member": "name"
+}
+
+# Never part of a name, separates them in the joined string
+_SEPARATOR = "\n"
+
+
+def fold(text):
+    return (text or "").casefold()
+
+
+class _Snapshot(NamedTuple):
+    rows: list  # (id, name) in name order
+    folded: str  # the folded names of rows, joined by _SEPARATOR
+    starts: list  # where every name starts in folded
+    names: dict  # id -> name
+
+
+class TypeaheadIndex:
+    def __init__(self, pool, tables=LOOKUP_TABLES):
+        self.pool = pool
+        self.tables = tables
+        # table -> sorted [(folded name, id, name)] and {id: folded name}, None until loaded
+        self._entries = {table: None for table in tables}
+        self._folded_by_id = {table: None for table in tables}
+        # table -> _Snapshot of the entries, None after every change; searches build it again and swap it in
+        self._snapshots = {table: None for table in tables}
+        self._lock = threading.Lock()
+        self._counters = {"searches": 0, "loads": 0, "updates": 0}
+
+    def load(self, table=None):
+        """Read a table, or all of them, from the database"""
+        for name in (self.tables if table is None else (table,)):
+            with self.pool.connection() as conn:
+                rows = conn.execute(f"SELECT id, {self.tables[name]} AS name FROM {name}").fetchall()
+            entries = sorted((fold(row["name"]), row["id"], row["name"] or "") for row in rows)
+            with self._lock:
+                self._entries[name] = entries
+                self._folded_by_id[name] = {entry[1]: entry[0] for entry in entries}
+                self._snapshots[name] = None
+                self._counters["loads"] += 1
+
+    def invalidate(self, table=None):
+        """Reload a table, or all of them, the next time it is searched"""
+        with self._lock:
+            for name in (self.tables if table is None else (table,)):
+                self._entries[name] = None
+                self._folded_by_id[name] = None
+                self._snapshots[name] = None
+
+    def notify(self, payload):
+        """NotificationListener callback for LOOKUP_CHANNEL, None after a reconnection when anything may have changed"""
+        if payload is None:
+            self.invalidate()
+            return
+        event = json.loads(payload)
+        table = event["table"]
+        if table not in self.tables:
+            return
+        if event.get("id") is None:
+            # TRUNCATE
+            self.invalidate(table)
+            return
+        with self._lock:
+            entries = self._entries[table]
+            # Not loaded yet, it will be read as it is now
+            if entries is None:
+                return
+            folded_by_id = self._folded_by_id[table]
+            row_id = event["id"]
+            if row_id in folded_by_id:
+                del entries[bisect.bisect_left(entries, (folded_by_id.pop(row_id), row_id))]
+            if event["op"] != "DELETE":
+                name = event.get("name") or ""
+                bisect.insort(entries, (fold(name), row_id, name))
+                folded_by_id[row_id] = fold(name)
+            self._snapshots[table] = None
+            self._counters["updates"] += 1
+
+    def _snapshot(self, table):
+        snapshot = self._snapshots[table]
+        if snapshot is not None:
+            return snapshot
+        if self._entries[table] is None:
+            self.load(table)
+        with self._lock:
+            entries = self._entries[table]
+            if entries is None:
+                # Invalidated again while loading, this search still gets the rows just read
+                entries = []
+            starts = []
+            position = 0
+            for folded, _, _ in entries:
+                starts.append(position)
+                position += len(folded) + len(_SEPARATOR)
+            snapshot = _Snapshot(
+                [(row_id, name) for _, row_id, name in entries],
+                _SEPARATOR.join(folded for folded, _, _ in entries),
+                starts,
+                {row_id: name for _, row_id, name in entries}
+            )
+            if self._entries[table] is entries:
+                self._snapshots[table] = snapshot
+        return snapshot
+
+    def search(self, table, query, limit=10):
+        """The first limit rows, in name order, whose name contains query, ignoring case"""
+        snapshot = self._snapshot(table)
+        with self._lock:
+            self._counters["searches"] += 1
+        query = fold(query)
+        if not query:
+            return snapshot.rows[:limit]
+        if _SEPARATOR in query:
+            return []
+        results = []
+        position = snapshot.folded.find(query)
+        while position != -1 and len(results) < limit:
+            index = bisect.bisect_right(snapshot.starts, position) - 1
+            results.append(snapshot.rows[index])
+            # Every name is listed once, however many times it contains the query
+            if index + 1 >= len(snapshot.starts):
+                break
+            position = snapshot.folded.find(query, snapshot.starts[index + 1])
+        return results
+
+    def all(self, table):
+        return list(self._snapshot(table).rows)
+
+    def name(self, table, row_id):
+        """Name of an id, None if there is no such row"""
+        return self._snapshot(table).names.get(row_id)
+
+    def stats(self):
+        with self._lock:
+            return {
+                "rows": {
+                    table: len(entries) if entries is not None else None for table, entries in self._entries.items()
+                },
+                **self._counters
+            }
@@ -0,0 +1,19 @@
+-- Notify the backend whenever activator beacons change, so its in-memory beacon registry reloads
+
+CREATE OR REPLACE FUNCTION notify_activator_beacon_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('activator_beacon_changed', TG_OP);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_activator_beacon_notify ON activator_beacon;
+
+CREATE TRIGGER trg_activator_beacon_notify
+    AFTER INSERT OR UPDATE OR DELETE OR TRUNCATE ON activator_beacon
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_activator_beacon_changed();
+
+COMMENT ON TRIGGER trg_activator_beacon_notify ON activator_beacon IS
+'Notifies activator_beacon_changed so the backend reloads its beacon registry';
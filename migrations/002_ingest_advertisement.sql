@@ -0,0 +1,150 @@
+-- Server-side version of the advertisement ingest, so that the backend applies a whole gateway message
+-- in one round trip.
+-- Follows the same rules as the Python ingest: see "Leaving or entering?" and "Logs" in DESIGN-DOCUMENT.md
+-- Every log and unassigned tag entry gets p_received_at, the time the advertisement was received (the queued ingest
+-- modes write a batch well after its gateway message arrived), or the clock time of its statement if NULL, so that the
+-- movements of a batch don't all get the start of its transaction
+
+CREATE OR REPLACE FUNCTION ingest_advertisement(
+    p_mac_address VARCHAR,
+    p_packet_counter INTEGER,
+    p_beacon_number INTEGER,
+    p_remaining_battery REAL,
+    p_received_at TIMESTAMP
+)
+RETURNS TEXT AS $$
+DECLARE
+    v_tag RECORD;
+    v_current RECORD;
+    v_previous RECORD;
+    v_previous_echobeacon INTEGER;
+    v_is_entering BOOLEAN;
+    v_crew_member_id INTEGER;
+    -- The clock of this statement rather than the start of the transaction, when the receipt time is not known
+    v_timestamp TIMESTAMP := COALESCE(p_received_at, clock_timestamp());
+BEGIN
+    -- The tag table rejects batteries above 100%
+    IF p_remaining_battery > 100 THEN
+        RETURN 'ignored';
+    END IF;
+
+    -- The row lock keeps concurrent advertisements of the same tag in order
+    SELECT id, packet_counter, previous_echobeacon INTO v_tag
+    FROM tag
+    WHERE mac_address = p_mac_address
+    FOR UPDATE;
+    IF NOT FOUND THEN
+        RETURN 'ignored';
+    END IF;
+
+    -- Every advertisement updates the battery, even if it is not valid
+    IF v_tag.packet_counter IS NOT DISTINCT FROM p_packet_counter THEN
+        UPDATE tag SET remaining_battery = p_remaining_battery WHERE id = v_tag.id;
+        RETURN 'duplicate';
+    END IF;
+
+    SELECT id, shipyard_id, is_first_when_entering INTO v_current
+    FROM activator_beacon
+    WHERE friendly_number = p_beacon_number;
+
+    -- Set previous_echobeacon to current beacon only when packet changes
+    v_previous_echobeacon := v_current.id;
+
+    -- First-ever packets and packets without a prior beacon can't compute a direction, and there is no movement
+    -- across the same beacon or from/to beacons that don't exist
+    IF v_tag.packet_counter IS NOT NULL AND COALESCE(v_tag.previous_echobeacon, 0) <> 0
+            AND v_current.id IS NOT NULL AND v_current.id <> v_tag.previous_echobeacon THEN
+        SELECT shipyard_id, is_first_when_entering INTO v_previous
+        FROM activator_beacon
+        WHERE id = v_tag.previous_echobeacon;
+
+        -- Cross-yard transitions are ignored, and so are invalid pairs (two firsts or two seconds)
+        IF FOUND AND v_previous.shipyard_id = v_current.shipyard_id THEN
+            IF v_previous.is_first_when_entering AND NOT v_current.is_first_when_entering THEN
+                v_is_entering := TRUE;
+            ELSIF NOT v_previous.is_first_when_entering AND v_current.is_first_when_entering THEN
+                v_is_entering := FALSE;
+            END IF;
+        END IF;
+    END IF;
+
+    -- Reset pairing (prevents overlapping pairs)
+    IF v_is_entering IS NOT NULL THEN
+        v_previous_echobeacon := NULL;
+    END IF;
+
+    UPDATE tag
+    SET remaining_battery = p_remaining_battery,
+        packet_counter = p_packet_counter,
+        previous_echobeacon = v_previous_echobeacon
+    WHERE id = v_tag.id;
+
+    IF v_is_entering IS NULL THEN
+        RETURN 'accepted';
+    END IF;
+
+    -- Resolve assigned crew member (if any)
+    SELECT id INTO v_crew_member_id
+    FROM crew_member
+    WHERE tag_id = v_tag.id;
+
+    IF v_crew_member_id IS NULL THEN
+        -- Unassigned tag, record
+        INSERT INTO unassigned_tag_entry (tag_id, shipyard_id, is_entering, advertisement_timestamp)
+        VALUES (v_tag.id, v_current.shipyard_id, v_is_entering, v_timestamp);
+    ELSIF v_is_entering THEN
+        -- Open new log
+        INSERT INTO permanence_log (crew_member_id, shipyard_id, entry_timestamp)
+        VALUES (v_crew_member_id, v_current.shipyard_id, v_timestamp);
+    ELSE
+        -- Close most recent open log (or create exit-only)
+        UPDATE permanence_log
+        SET leave_timestamp = v_timestamp
+        WHERE id = (
+            SELECT id FROM permanence_log
+            WHERE crew_member_id = v_crew_member_id
+            AND shipyard_id = v_current.shipyard_id
+            AND leave_timestamp IS NULL
+            ORDER BY entry_timestamp DESC
+            LIMIT 1
+        );
+        IF NOT FOUND THEN
+            INSERT INTO permanence_log (crew_member_id, shipyard_id, leave_timestamp)
+            VALUES (v_crew_member_id, v_current.shipyard_id, v_timestamp);
+        END IF;
+    END IF;
+
+    RETURN 'accepted';
+END;
+$$ LANGUAGE plpgsql;
+
+-- Batch version: applies the advertisements in order and returns their outcomes, in the same order. p_received_at
+-- may be NULL, or have NULL items, for the advertisements whose receipt time is not known.
+-- A failing advertisement is rolled back on its own and counted as ignored, like the savepoints of the Python ingest
+CREATE OR REPLACE FUNCTION ingest_advertisements(
+    p_mac_addresses VARCHAR[],
+    p_packet_counters INTEGER[],
+    p_beacon_numbers INTEGER[],
+    p_remaining_batteries REAL[],
+    p_received_at TIMESTAMP[]
+)
+RETURNS TEXT[] AS $$
+DECLARE
+    v_outcomes TEXT[] := '{}';
+    v_outcome TEXT;
+BEGIN
+    FOR i IN 1 .. COALESCE(array_length(p_mac_addresses, 1), 0) LOOP
+        BEGIN
+            v_outcome := ingest_advertisement(
+                p_mac_addresses[i], p_packet_counters[i], p_beacon_numbers[i], p_remaining_batteries[i],
+                p_received_at[i]
+            );
+        EXCEPTION WHEN OTHERS THEN
+            RAISE WARNING 'ingest_advertisement failed for %: %', p_mac_addresses[i], SQLERRM;
+            v_outcome := 'ignored';
+        END;
+        v_outcomes := v_outcomes || v_outcome;
+    END LOOP;
+    RETURN v_outcomes;
+END;
+$$ LANGUAGE plpgsql;
@@ -0,0 +1,30 @@
+-- Notify the backend whenever a permanence log is opened, closed or edited, or an unassigned tag entry is recorded,
+-- so the live log and entry tables get the row as soon as the transaction that wrote it commits
+
+CREATE OR REPLACE FUNCTION notify_presence_event()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify('presence_event', json_build_object('table', TG_TABLE_NAME, 'id', NEW.id)::text);
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_permanence_log_notify ON permanence_log;
+
+CREATE TRIGGER trg_permanence_log_notify
+    AFTER INSERT OR UPDATE ON permanence_log
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_presence_event();
+
+DROP TRIGGER IF EXISTS trg_unassigned_tag_entry_notify ON unassigned_tag_entry;
+
+CREATE TRIGGER trg_unassigned_tag_entry_notify
+    AFTER INSERT ON unassigned_tag_entry
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_presence_event();
+
+COMMENT ON TRIGGER trg_permanence_log_notify ON permanence_log IS
+'Notifies presence_event so the backend pushes the log to the live tables';
+
+COMMENT ON TRIGGER trg_unassigned_tag_entry_notify ON unassigned_tag_entry IS
+'Notifies presence_event so the backend pushes the entry to the live tables';
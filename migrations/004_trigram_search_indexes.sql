@@ -0,0 +1,11 @@
+-- Trigram indexes for the substring searches of the filters and of the search endpoints (name ILIKE '%query%'),
+-- which otherwise read the whole table at every keystroke.
+-- pg_trgm is a trusted extension: the owner of the database can create it
+
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS idx_crew_member_name_trgm ON crew_member USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_ship_name_trgm ON ship USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_crew_member_roles_role_name_trgm ON crew_member_roles USING gin (role_name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_shipyard_name_trgm ON shipyard USING gin (name gin_trgm_ops);
+CREATE INDEX IF NOT EXISTS idx_tag_mac_address_trgm ON tag USING gin (mac_address gin_trgm_ops);
@@ -0,0 +1,21 @@
+-- Time span of a permanence log as a range, indexed with GiST, so that the time filter of the logs is a single
+-- overlap condition (permanence_period(entry_timestamp, leave_timestamp) && tsrange(start, end, '[]')) that the
+-- index serves, and that also finds the logs spanning the whole window, like someone still on site since before it.
+-- Both timestamps are nullable and nothing keeps them in order, so the function never builds an invalid range:
+-- logs without an exit are open-ended, exit-only logs last an instant, swapped timestamps are put back in order
+
+CREATE OR REPLACE FUNCTION permanence_period(p_entry_timestamp TIMESTAMP, p_leave_timestamp TIMESTAMP)
+RETURNS tsrange AS $$
+    SELECT CASE
+        WHEN p_entry_timestamp IS NULL THEN tsrange(p_leave_timestamp, p_leave_timestamp, '[]')
+        WHEN p_leave_timestamp IS NULL THEN tsrange(p_entry_timestamp, NULL, '[)')
+        ELSE tsrange(
+            LEAST(p_entry_timestamp, p_leave_timestamp),
+            GREATEST(p_entry_timestamp, p_leave_timestamp),
+            '[]'
+        )
+    END
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+CREATE INDEX IF NOT EXISTS idx_permanence_log_period
+    ON permanence_log USING gist (permanence_period(entry_timestamp, leave_timestamp));
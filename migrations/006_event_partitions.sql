@@ -0,0 +1,247 @@
+-- Monthly range partitions for the two event tables, so that old months can be detached and archived at once
+-- instead of deleting their rows, and so that a time window that ends in the past skips the months after it.
+-- permanence_log is partitioned by LEAST(entry_timestamp, leave_timestamp), the start of permanence_period, and
+-- unassigned_tag_entry by advertisement_timestamp. Rows outside of every month partition (and without a timestamp)
+-- go to the default partitions, which create_event_partition empties of the rows of the months it creates.
+-- The conversion rewrites both tables: it takes an ACCESS EXCLUSIVE lock on them (the renames) and copies every row
+-- into the partitioned tables, so the ingest and the web pages wait on them until the migration commits. Run it in a
+-- maintenance window on large tables.
+-- Limitation: the partitioned tables have no primary key of their own. Unique constraints on a partitioned table
+-- have to include the partition key, which is an expression for permanence_log and a nullable column for
+-- unassigned_tag_entry, so neither can be part of one. id is the primary key of every partition, the default ones
+-- included, but unique across the partitions only because it comes from the sequence: a row inserted with an
+-- explicit id may repeat the id of a row in another month, and no foreign key can reference either table.
+
+CREATE SCHEMA IF NOT EXISTS event_archive;
+
+-- The triggers are defined on the partitioned tables and cloned on every partition, where TG_TABLE_NAME is the name
+-- of the partition: the table name of the notification comes from the trigger argument instead
+CREATE OR REPLACE FUNCTION notify_presence_event()
+RETURNS TRIGGER AS $$
+BEGIN
+    PERFORM pg_notify(
+        'presence_event',
+        json_build_object('table', COALESCE(TG_ARGV[0], TG_TABLE_NAME), 'id', NEW.id)::text
+    );
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Create the partition of a month of permanence_log or unassigned_tag_entry, moving into it the rows of that month
+-- that were written to the default partition. Returns FALSE if the partition already exists
+CREATE OR REPLACE FUNCTION create_event_partition(p_table TEXT, p_month DATE)
+RETURNS BOOLEAN AS $$
+DECLARE
+    v_start DATE := date_trunc('month', p_month)::date;
+    v_end DATE := (date_trunc('month', p_month) + INTERVAL '1 month')::date;
+    v_partition TEXT := format('%s_p%s', p_table, to_char(p_month, 'YYYYMM'));
+    v_key TEXT;
+BEGIN
+    v_key := CASE p_table
+        WHEN 'permanence_log' THEN 'LEAST(entry_timestamp, leave_timestamp)'
+        WHEN 'unassigned_tag_entry' THEN 'advertisement_timestamp'
+    END;
+    IF v_key IS NULL THEN
+        RAISE EXCEPTION '% is not partitioned by month', p_table;
+    END IF;
+    IF to_regclass(format('%I', v_partition)) IS NOT NULL THEN
+        RETURN FALSE;
+    END IF;
+
+    EXECUTE format('CREATE TABLE %I (LIKE %I)', v_partition, p_table);
+    EXECUTE format(
+        'WITH moved AS (DELETE FROM %I WHERE %s >= %L AND %s < %L RETURNING *) INSERT INTO %I SELECT * FROM moved',
+        p_table || '_default', v_key, v_start, v_key, v_end, v_partition
+    );
+    EXECUTE format('ALTER TABLE %I ADD PRIMARY KEY (id)', v_partition);
+    -- Indexes, foreign keys and triggers of the partitioned table are added to the partition when it is attached
+    EXECUTE format(
+        'ALTER TABLE %I ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)', p_table, v_partition, v_start, v_end
+    );
+    RETURN TRUE;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Create the partitions of the current month and of the p_months_ahead following ones, for both event tables.
+-- Returns how many were created. Runs as the owner of the schema, so that the backend can call it
+CREATE OR REPLACE FUNCTION create_event_partitions(p_months_ahead INTEGER)
+RETURNS INTEGER AS $$
+DECLARE
+    v_table TEXT;
+    v_month DATE;
+    v_created INTEGER := 0;
+BEGIN
+    -- The backend and the partitions tool may run at the same time
+    PERFORM pg_advisory_xact_lock(hashtext('event_partitions'));
+    FOREACH v_table IN ARRAY ARRAY['permanence_log', 'unassigned_tag_entry'] LOOP
+        FOR v_month IN
+            SELECT generate_series(
+                date_trunc('month', LOCALTIMESTAMP),
+                date_trunc('month', LOCALTIMESTAMP) + make_interval(months => p_months_ahead),
+                INTERVAL '1 month'
+            )::date
+        LOOP
+            IF create_event_partition(v_table, v_month) THEN
+                v_created := v_created + 1;
+            END IF;
+        END LOOP;
+    END LOOP;
+    RETURN v_created;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- Detach the month partitions of both event tables that ended more than p_keep_months months before the current
+-- month, and move them to the event_archive schema. Returns the names of the detached partitions.
+-- The archived tables lose their foreign keys, so that deleting a crew member or a shipyard leaves them untouched.
+-- Runs as the owner of the schema, so that the backend can call it
+CREATE OR REPLACE FUNCTION detach_event_partitions(p_keep_months INTEGER)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    v_cutoff DATE;
+    v_partition RECORD;
+    v_constraint RECORD;
+BEGIN
+    IF p_keep_months IS NULL OR p_keep_months < 1 THEN
+        RAISE EXCEPTION 'At least one month before the current one has to be kept';
+    END IF;
+    v_cutoff := (date_trunc('month', LOCALTIMESTAMP) - make_interval(months => p_keep_months))::date;
+
+    PERFORM pg_advisory_xact_lock(hashtext('event_partitions'));
+    FOR v_partition IN
+        SELECT parent.relname AS parent, child.relname AS partition
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relnamespace = 'public'::regnamespace
+          AND parent.relname IN ('permanence_log', 'unassigned_tag_entry')
+          AND child.relname ~ '_p[0-9]{6}$'
+          AND to_date(right(child.relname, 6), 'YYYYMM') + INTERVAL '1 month' <= v_cutoff
+        ORDER BY child.relname
+    LOOP
+        EXECUTE format('ALTER TABLE %I DETACH PARTITION %I', v_partition.parent, v_partition.partition);
+        FOR v_constraint IN
+            SELECT conname FROM pg_constraint
+            WHERE conrelid = format('%I', v_partition.partition)::regclass AND contype = 'f'
+        LOOP
+            EXECUTE format('ALTER TABLE %I DROP CONSTRAINT %I', v_partition.partition, v_constraint.conname);
+        END LOOP;
+        EXECUTE format('ALTER TABLE %I SET SCHEMA event_archive', v_partition.partition);
+        RETURN NEXT v_partition.partition;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER SET search_path = public;
+
+-- Convert permanence_log, unless it is already partitioned (new installations, DESIGN-DOCUMENT.md)
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'permanence_log'::regclass) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE permanence_log RENAME TO permanence_log_unpartitioned;
+    DROP TRIGGER IF EXISTS trg_permanence_log_notify ON permanence_log_unpartitioned;
+    DROP INDEX IF EXISTS idx_permanence_log_period;
+
+    CREATE TABLE permanence_log (
+        id INTEGER NOT NULL DEFAULT nextval('permanence_log_id_seq'),
+        crew_member_id INTEGER,
+        shipyard_id INTEGER,
+        entry_timestamp TIMESTAMP DEFAULT NULL,
+        leave_timestamp TIMESTAMP DEFAULT NULL,
+        CONSTRAINT fk_log_crew
+            FOREIGN KEY (crew_member_id)
+            REFERENCES crew_member(id)
+            ON DELETE CASCADE,
+        CONSTRAINT fk_log_shipyard
+            FOREIGN KEY (shipyard_id)
+            REFERENCES shipyard(id)
+            ON DELETE CASCADE
+    ) PARTITION BY RANGE ((LEAST(entry_timestamp, leave_timestamp)));
+    ALTER SEQUENCE permanence_log_id_seq OWNED BY permanence_log.id;
+
+    CREATE TABLE permanence_log_default PARTITION OF permanence_log DEFAULT;
+    ALTER TABLE permanence_log_default ADD PRIMARY KEY (id);
+    PERFORM create_event_partition('permanence_log', month::date)
+    FROM generate_series(
+        (SELECT date_trunc('month', MIN(LEAST(entry_timestamp, leave_timestamp))) FROM permanence_log_unpartitioned),
+        date_trunc('month', LOCALTIMESTAMP),
+        INTERVAL '1 month'
+    ) month;
+
+    INSERT INTO permanence_log (id, crew_member_id, shipyard_id, entry_timestamp, leave_timestamp)
+    SELECT id, crew_member_id, shipyard_id, entry_timestamp, leave_timestamp FROM permanence_log_unpartitioned;
+    DROP TABLE permanence_log_unpartitioned;
+END $$;
+
+-- Convert unassigned_tag_entry, unless it is already partitioned
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'unassigned_tag_entry'::regclass) THEN
+        RETURN;
+    END IF;
+
+    ALTER TABLE unassigned_tag_entry RENAME TO unassigned_tag_entry_unpartitioned;
+    DROP TRIGGER IF EXISTS trg_unassigned_tag_entry_notify ON unassigned_tag_entry_unpartitioned;
+
+    CREATE TABLE unassigned_tag_entry (
+        id INTEGER NOT NULL DEFAULT nextval('unassigned_tag_entry_id_seq'),
+        tag_id INTEGER,
+        shipyard_id INTEGER,
+        advertisement_timestamp TIMESTAMP DEFAULT NOW(),
+        is_entering BOOLEAN,
+        CONSTRAINT fk_entry_tag
+            FOREIGN KEY (tag_id)
+            REFERENCES tag(id)
+            ON DELETE CASCADE,
+        CONSTRAINT fk_entry_shipyard
+            FOREIGN KEY (shipyard_id)
+            REFERENCES shipyard(id)
+            ON DELETE CASCADE
+    ) PARTITION BY RANGE (advertisement_timestamp);
+    ALTER SEQUENCE unassigned_tag_entry_id_seq OWNED BY unassigned_tag_entry.id;
+
+    CREATE TABLE unassigned_tag_entry_default PARTITION OF unassigned_tag_entry DEFAULT;
+    ALTER TABLE unassigned_tag_entry_default ADD PRIMARY KEY (id);
+    PERFORM create_event_partition('unassigned_tag_entry', month::date)
+    FROM generate_series(
+        (SELECT date_trunc('month', MIN(advertisement_timestamp)) FROM unassigned_tag_entry_unpartitioned),
+        date_trunc('month', LOCALTIMESTAMP),
+        INTERVAL '1 month'
+    ) month;
+
+    INSERT INTO unassigned_tag_entry (id, tag_id, shipyard_id, advertisement_timestamp, is_entering)
+    SELECT id, tag_id, shipyard_id, advertisement_timestamp, is_entering FROM unassigned_tag_entry_unpartitioned;
+    DROP TABLE unassigned_tag_entry_unpartitioned;
+END $$;
+
+-- Built on every partition after the rows have been copied
+CREATE INDEX IF NOT EXISTS idx_permanence_log_period
+    ON permanence_log USING gist (permanence_period(entry_timestamp, leave_timestamp));
+
+-- The open log an exit closes is looked for in every month, only through the open ones
+CREATE INDEX IF NOT EXISTS idx_permanence_log_open
+    ON permanence_log (crew_member_id, shipyard_id, entry_timestamp)
+    WHERE leave_timestamp IS NULL;
+
+DROP TRIGGER IF EXISTS trg_permanence_log_notify ON permanence_log;
+
+CREATE TRIGGER trg_permanence_log_notify
+    AFTER INSERT OR UPDATE ON permanence_log
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_presence_event('permanence_log');
+
+DROP TRIGGER IF EXISTS trg_unassigned_tag_entry_notify ON unassigned_tag_entry;
+
+CREATE TRIGGER trg_unassigned_tag_entry_notify
+    AFTER INSERT ON unassigned_tag_entry
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_presence_event('unassigned_tag_entry');
+
+COMMENT ON TRIGGER trg_permanence_log_notify ON permanence_log IS
+'Notifies presence_event so the backend pushes the log to the live tables';
+
+COMMENT ON TRIGGER trg_unassigned_tag_entry_notify ON unassigned_tag_entry IS
+'Notifies presence_event so the backend pushes the entry to the live tables';
+
+-- Partitions for the coming months, afterwards created by the backend (PARTITION_MONTHS_AHEAD)
+SELECT create_event_partitions(3);
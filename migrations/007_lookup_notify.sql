@@ -0,0 +1,84 @@
+-- Notify the backend whenever a ship, role, shipyard or crew member is added, renamed or deleted, with the row id and
+-- its new name, so the in-memory typeahead index of the dropdowns is updated without reading the table again.
+-- A TRUNCATE notifies the table alone, and the backend reads it again
+
+CREATE OR REPLACE FUNCTION notify_lookup_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_LEVEL = 'STATEMENT' THEN
+        PERFORM pg_notify('lookup_changed', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP)::text);
+    ELSIF TG_OP = 'DELETE' THEN
+        PERFORM pg_notify('lookup_changed', json_build_object('table', TG_TABLE_NAME, 'op', TG_OP, 'id', OLD.id)::text);
+    ELSE
+        -- TG_ARGV[0] is the name column of the table
+        PERFORM pg_notify('lookup_changed', json_build_object(
+            'table', TG_TABLE_NAME, 'op', TG_OP, 'id', NEW.id, 'name', to_jsonb(NEW) ->> TG_ARGV[0]
+        )::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_ship_lookup_notify ON ship;
+DROP TRIGGER IF EXISTS trg_ship_lookup_truncate ON ship;
+
+CREATE TRIGGER trg_ship_lookup_notify
+    AFTER INSERT OR UPDATE OF name OR DELETE ON ship
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_lookup_changed('name');
+
+CREATE TRIGGER trg_ship_lookup_truncate
+    AFTER TRUNCATE ON ship
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_lookup_changed();
+
+DROP TRIGGER IF EXISTS trg_crew_member_roles_lookup_notify ON crew_member_roles;
+DROP TRIGGER IF EXISTS trg_crew_member_roles_lookup_truncate ON crew_member_roles;
+
+CREATE TRIGGER trg_crew_member_roles_lookup_notify
+    AFTER INSERT OR UPDATE OF role_name OR DELETE ON crew_member_roles
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_lookup_changed('role_name');
+
+CREATE TRIGGER trg_crew_member_roles_lookup_truncate
+    AFTER TRUNCATE ON crew_member_roles
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_lookup_changed();
+
+DROP TRIGGER IF EXISTS trg_shipyard_lookup_notify ON shipyard;
+DROP TRIGGER IF EXISTS trg_shipyard_lookup_truncate ON shipyard;
+
+CREATE TRIGGER trg_shipyard_lookup_notify
+    AFTER INSERT OR UPDATE OF name OR DELETE ON shipyard
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_lookup_changed('name');
+
+CREATE TRIGGER trg_shipyard_lookup_truncate
+    AFTER TRUNCATE ON shipyard
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_lookup_changed();
+
+DROP TRIGGER IF EXISTS trg_crew_member_lookup_notify ON crew_member;
+DROP TRIGGER IF EXISTS trg_crew_member_lookup_truncate ON crew_member;
+
+CREATE TRIGGER trg_crew_member_lookup_notify
+    AFTER INSERT OR UPDATE OF name OR DELETE ON crew_member
+    FOR EACH ROW
+    EXECUTE FUNCTION notify_lookup_changed('name');
+
+CREATE TRIGGER trg_crew_member_lookup_truncate
+    AFTER TRUNCATE ON crew_member
+    FOR EACH STATEMENT
+    EXECUTE FUNCTION notify_lookup_changed();
+
+COMMENT ON TRIGGER trg_ship_lookup_notify ON ship IS
+'Notifies lookup_changed so the backend updates its typeahead index';
+
+COMMENT ON TRIGGER trg_crew_member_roles_lookup_notify ON crew_member_roles IS
+'Notifies lookup_changed so the backend updates its typeahead index';
+
+COMMENT ON TRIGGER trg_shipyard_lookup_notify ON shipyard IS
+'Notifies lookup_changed so the backend updates its typeahead index';
+
+COMMENT ON TRIGGER trg_crew_member_lookup_notify ON crew_member IS
+'Notifies lookup_changed so the backend updates its typeahead index';
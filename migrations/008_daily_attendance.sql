@@ -0,0 +1,170 @@
+-- Hours on site of every crew member in every shipyard, day by day, kept up to date as the logs change so that the
+-- attendance report reads a row per day instead of the logs. A log closing (the ingest setting its leave_timestamp)
+-- is added to the days it spans right away. Any other change to a closed log (added, edited or deleted by hand,
+-- deleted with its crew member, moved between partitions) marks its days as dirty, and the backend counts them again
+-- from the logs, a run of dirty days per transaction (dirty_attendance_runs), soon after every web write and every
+-- night.
+-- Open logs count from the moment they close, exit-only logs never count
+
+CREATE TABLE IF NOT EXISTS daily_attendance (
+    id BIGSERIAL,
+    day DATE NOT NULL,
+    shipyard_id INTEGER NOT NULL,
+    crew_member_id INTEGER NOT NULL,
+    seconds NUMERIC NOT NULL,
+    visits INTEGER NOT NULL,
+    first_entry TIMESTAMP NOT NULL,
+    last_leave TIMESTAMP NOT NULL,
+    CONSTRAINT pk_daily_attendance PRIMARY KEY (day, shipyard_id, crew_member_id),
+    CONSTRAINT fk_attendance_crew
+        FOREIGN KEY (crew_member_id)
+        REFERENCES crew_member(id)
+        ON DELETE CASCADE,
+    CONSTRAINT fk_attendance_shipyard
+        FOREIGN KEY (shipyard_id)
+        REFERENCES shipyard(id)
+        ON DELETE CASCADE
+);
+
+-- Order of the report table, most recent day first (keyset_order)
+CREATE INDEX IF NOT EXISTS idx_daily_attendance_day_id ON daily_attendance (day DESC NULLS LAST, id DESC);
+-- The crew member foreign key, and the report filtered by crew member
+CREATE INDEX IF NOT EXISTS idx_daily_attendance_crew_member ON daily_attendance (crew_member_id, day);
+
+CREATE TABLE IF NOT EXISTS daily_attendance_dirty (
+    day DATE PRIMARY KEY,
+    marked_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+-- The part of the time span from p_start to p_end that falls in each of its days. A span ending exactly at midnight
+-- doesn't count on the day that begins
+CREATE OR REPLACE FUNCTION attendance_days(p_start TIMESTAMP, p_end TIMESTAMP)
+RETURNS TABLE (day DATE, seconds NUMERIC, first_entry TIMESTAMP, last_leave TIMESTAMP) AS $$
+    SELECT
+        day::date,
+        EXTRACT(EPOCH FROM LEAST(p_end, day + INTERVAL '1 day') - GREATEST(p_start, day)),
+        GREATEST(p_start, day),
+        LEAST(p_end, day + INTERVAL '1 day')
+    FROM generate_series(date_trunc('day', p_start), p_end, INTERVAL '1 day') day
+    WHERE day = date_trunc('day', p_start) OR day < p_end
+$$ LANGUAGE sql IMMUTABLE PARALLEL SAFE;
+
+-- Add a closed log to the days it spans. Timestamps out of order are put back in order, like permanence_period does
+CREATE OR REPLACE FUNCTION add_log_attendance(
+    p_crew_member_id INTEGER,
+    p_shipyard_id INTEGER,
+    p_entry_timestamp TIMESTAMP,
+    p_leave_timestamp TIMESTAMP
+)
+RETURNS VOID AS $$
+    INSERT INTO daily_attendance AS da (day, shipyard_id, crew_member_id, seconds, visits, first_entry, last_leave)
+    SELECT d.day, p_shipyard_id, p_crew_member_id, d.seconds, 1, d.first_entry, d.last_leave
+    FROM attendance_days(
+        LEAST(p_entry_timestamp, p_leave_timestamp), GREATEST(p_entry_timestamp, p_leave_timestamp)
+    ) d
+    ON CONFLICT (day, shipyard_id, crew_member_id) DO UPDATE SET
+        seconds = da.seconds + EXCLUDED.seconds,
+        visits = da.visits + EXCLUDED.visits,
+        first_entry = LEAST(da.first_entry, EXCLUDED.first_entry),
+        last_leave = GREATEST(da.last_leave, EXCLUDED.last_leave)
+$$ LANGUAGE sql;
+
+-- Mark the days spanned by a log as dirty, if it is closed
+CREATE OR REPLACE FUNCTION mark_attendance_dirty(p_entry_timestamp TIMESTAMP, p_leave_timestamp TIMESTAMP)
+RETURNS VOID AS $$
+    INSERT INTO daily_attendance_dirty (day)
+    SELECT d.day
+    FROM attendance_days(
+        LEAST(p_entry_timestamp, p_leave_timestamp), GREATEST(p_entry_timestamp, p_leave_timestamp)
+    ) d
+    WHERE p_entry_timestamp IS NOT NULL AND p_leave_timestamp IS NOT NULL
+    ON CONFLICT (day) DO NOTHING
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION track_daily_attendance()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP = 'UPDATE'
+        AND OLD.leave_timestamp IS NULL AND NEW.leave_timestamp IS NOT NULL AND NEW.entry_timestamp IS NOT NULL
+        AND OLD.entry_timestamp = NEW.entry_timestamp
+        AND OLD.crew_member_id IS NOT DISTINCT FROM NEW.crew_member_id
+        AND OLD.shipyard_id IS NOT DISTINCT FROM NEW.shipyard_id
+    THEN
+        -- A log closing: waits for a refresh of the days in progress, which may not see this log yet
+        PERFORM pg_advisory_xact_lock_shared(hashtext('daily_attendance'));
+        PERFORM add_log_attendance(NEW.crew_member_id, NEW.shipyard_id, NEW.entry_timestamp, NEW.leave_timestamp);
+        RETURN NULL;
+    END IF;
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM mark_attendance_dirty(OLD.entry_timestamp, OLD.leave_timestamp);
+    END IF;
+    IF TG_OP IN ('UPDATE', 'INSERT') THEN
+        PERFORM mark_attendance_dirty(NEW.entry_timestamp, NEW.leave_timestamp);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Count the days from p_from to p_to again from the closed logs, returns the rows written. Waits for the logs
+-- closing in the meantime to commit, without making the ones that come after wait in line behind it: a closing log
+-- never waits for a refresh that is itself waiting for something
+CREATE OR REPLACE FUNCTION refresh_daily_attendance(p_from DATE, p_to DATE)
+RETURNS INTEGER AS $$
+DECLARE
+    v_rows INTEGER;
+BEGIN
+    WHILE NOT pg_try_advisory_xact_lock(hashtext('daily_attendance')) LOOP
+        PERFORM pg_sleep(0.01);
+    END LOOP;
+    -- Cleared first: the days changed from now on are marked again, the ones changed before are counted here
+    DELETE FROM daily_attendance_dirty WHERE day BETWEEN p_from AND p_to;
+    DELETE FROM daily_attendance WHERE day BETWEEN p_from AND p_to;
+    INSERT INTO daily_attendance (day, shipyard_id, crew_member_id, seconds, visits, first_entry, last_leave)
+    SELECT d.day, pl.shipyard_id, pl.crew_member_id, SUM(d.seconds), COUNT(*), MIN(d.first_entry), MAX(d.last_leave)
+    FROM permanence_log pl
+    CROSS JOIN LATERAL attendance_days(
+        LEAST(pl.entry_timestamp, pl.leave_timestamp), GREATEST(pl.entry_timestamp, pl.leave_timestamp)
+    ) d
+    WHERE pl.entry_timestamp IS NOT NULL AND pl.leave_timestamp IS NOT NULL
+        AND pl.crew_member_id IS NOT NULL AND pl.shipyard_id IS NOT NULL
+        -- Same conditions as the time filter of the log table, served by idx_permanence_log_period
+        AND permanence_period(pl.entry_timestamp, pl.leave_timestamp) && tsrange(p_from, p_to + 1, '[)')
+        AND LEAST(pl.entry_timestamp, pl.leave_timestamp) < p_to + 1
+        AND d.day BETWEEN p_from AND p_to
+    GROUP BY d.day, pl.shipyard_id, pl.crew_member_id;
+    GET DIAGNOSTICS v_rows = ROW_COUNT;
+    RETURN v_rows;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS refresh_dirty_attendance();
+
+-- The dirty days, as runs of consecutive days. The caller counts every run again with refresh_daily_attendance in a
+-- transaction of its own, so that the lock of a refresh is released between runs and the closing logs don't wait
+-- for all of them
+CREATE OR REPLACE FUNCTION dirty_attendance_runs()
+RETURNS TABLE (first_day DATE, last_day DATE) AS $$
+    SELECT MIN(day), MAX(day)
+    FROM (SELECT day, day - (ROW_NUMBER() OVER (ORDER BY day))::integer AS run FROM daily_attendance_dirty) days
+    GROUP BY run
+    ORDER BY MIN(day)
+$$ LANGUAGE sql;
+
+DROP TRIGGER IF EXISTS trg_permanence_log_attendance ON permanence_log;
+
+CREATE TRIGGER trg_permanence_log_attendance
+    AFTER INSERT OR UPDATE OF crew_member_id, shipyard_id, entry_timestamp, leave_timestamp OR DELETE
+    ON permanence_log
+    FOR EACH ROW
+    EXECUTE FUNCTION track_daily_attendance();
+
+COMMENT ON TRIGGER trg_permanence_log_attendance ON permanence_log IS
+'Adds the closing logs to daily_attendance and marks the days of the other changes as dirty';
+
+-- The logs written before this migration, once
+SELECT refresh_daily_attendance(
+    MIN(LEAST(entry_timestamp, leave_timestamp))::date,
+    MAX(GREATEST(entry_timestamp, leave_timestamp))::date
+)
+FROM permanence_log
+WHERE NOT EXISTS (SELECT 1 FROM daily_attendance);
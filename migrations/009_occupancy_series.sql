@@ -0,0 +1,60 @@
+-- Headcount of every shipyard over time, for the occupancy charts. The backend samples the open logs of every
+-- shipyard once a minute and adds the sample to its minute, hour and day buckets at once, so every zoom level reads
+-- a bucket per point instead of the logs. The minute and hour buckets are deleted after a while, the day ones kept
+
+CREATE TABLE IF NOT EXISTS occupancy_sample (
+    resolution TEXT NOT NULL,
+    bucket TIMESTAMP NOT NULL,
+    shipyard_id INTEGER NOT NULL,
+    samples INTEGER NOT NULL,
+    headcount_avg REAL NOT NULL,
+    headcount_min INTEGER NOT NULL,
+    headcount_max INTEGER NOT NULL,
+    CONSTRAINT pk_occupancy_sample PRIMARY KEY (resolution, bucket, shipyard_id),
+    CONSTRAINT chk_occupancy_resolution CHECK (resolution IN ('minute', 'hour', 'day')),
+    CONSTRAINT fk_occupancy_shipyard
+        FOREIGN KEY (shipyard_id)
+        REFERENCES shipyard(id)
+        ON DELETE CASCADE
+);
+
+-- The shipyard foreign key
+CREATE INDEX IF NOT EXISTS idx_occupancy_sample_shipyard ON occupancy_sample (shipyard_id);
+
+-- Add a sample of the headcounts to the minute, hour and day buckets of now. Every shipyard gets a sample, the ones
+-- missing from p_shipyard_ids count 0
+CREATE OR REPLACE FUNCTION record_occupancy(p_shipyard_ids INTEGER[], p_headcounts INTEGER[])
+RETURNS VOID AS $$
+    INSERT INTO occupancy_sample AS os (
+        resolution, bucket, shipyard_id, samples, headcount_avg, headcount_min, headcount_max
+    )
+    SELECT
+        r.resolution,
+        date_trunc(r.resolution, LOCALTIMESTAMP),
+        s.id,
+        1,
+        COALESCE(c.headcount, 0),
+        COALESCE(c.headcount, 0),
+        COALESCE(c.headcount, 0)
+    FROM shipyard s
+    LEFT JOIN unnest(p_shipyard_ids, p_headcounts) AS c (shipyard_id, headcount) ON c.shipyard_id = s.id
+    CROSS JOIN (VALUES ('minute'), ('hour'), ('day')) AS r (resolution)
+    ON CONFLICT (resolution, bucket, shipyard_id) DO UPDATE SET
+        samples = os.samples + 1,
+        headcount_avg = (os.headcount_avg * os.samples + EXCLUDED.headcount_avg) / (os.samples + 1),
+        headcount_min = LEAST(os.headcount_min, EXCLUDED.headcount_min),
+        headcount_max = GREATEST(os.headcount_max, EXCLUDED.headcount_max)
+$$ LANGUAGE sql;
+
+-- Delete the minute buckets older than p_minute_days days and the hour buckets older than p_hour_days days, returns
+-- the rows deleted
+CREATE OR REPLACE FUNCTION expire_occupancy_samples(p_minute_days INTEGER, p_hour_days INTEGER)
+RETURNS INTEGER AS $$
+    WITH expired AS (
+        DELETE FROM occupancy_sample
+        WHERE (resolution = 'minute' AND bucket < LOCALTIMESTAMP - make_interval(days => p_minute_days))
+            OR (resolution = 'hour' AND bucket < LOCALTIMESTAMP - make_interval(days => p_hour_days))
+        RETURNING 1
+    )
+    SELECT COUNT(*)::integer FROM expired
+$$ LANGUAGE sql;
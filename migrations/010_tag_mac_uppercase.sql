@@ -0,0 +1,24 @@
+-- Tag MAC addresses in upper case. The gateway ingest matches tags on the exact string, and both decoders (the JSON
+-- device_list and the binary frames) give the MAC address in upper case, so a tag stored in lower case would never be
+-- matched. The existing tags are converted, and the new and edited ones are converted by a trigger.
+-- A tag stored twice, once in each case, makes the UPDATE fail on the unique constraint: merge the two by hand first
+
+CREATE OR REPLACE FUNCTION uppercase_tag_mac_address()
+RETURNS TRIGGER AS $$
+BEGIN
+    NEW.mac_address := UPPER(NEW.mac_address);
+    RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_tag_mac_address_uppercase ON tag;
+
+CREATE TRIGGER trg_tag_mac_address_uppercase
+    BEFORE INSERT OR UPDATE OF mac_address ON tag
+    FOR EACH ROW
+    EXECUTE FUNCTION uppercase_tag_mac_address();
+
+COMMENT ON TRIGGER trg_tag_mac_address_uppercase ON tag IS
+'Keeps tag MAC addresses in upper case, the case of the decoded gateway advertisements';
+
+UPDATE tag SET mac_address = UPPER(mac_address) WHERE mac_address <> UPPER(mac_address);
@@ -1,16 +1,32 @@
-from flask import Flask, request, session, redirect, render_template, jsonify, flash, send_file
+from flask import Flask, request, session, redirect, render_template, jsonify, flash, Response, send_file
+from flask import stream_with_context
 from waitress import serve
 from psycopg.rows import dict_row
 import os
+import json
+import queue
+import atexit
+import tempfile
+import itertools
 from psycopg_pool import ConnectionPool
 from functools import wraps
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 import base64
+from urllib.parse import urlencode
 from typing import TypeVar, ParamSpec, Callable, Concatenate, Any
 import psycopg
-from openpyxl import Workbook
-from openpyxl.styles import Font, Alignment, PatternFill, Border, Side
-from io import BytesIO
+from gatekeeper import NotificationListener, BeaconRegistry, BEACON_CHANNEL
+from gatekeeper import TagStateEngine, DuplicateCache, Ingestor, ProcedureIngestor, IngestQueue, ShardedIngest
+from gatekeeper import decode_device_list, PRESENCE_PACKET
+from gatekeeper import decompress_body, decode_frames, FramingError, FRAMES_CONTENT_TYPE
+from gatekeeper import ArchiveWriter
+from gatekeeper import PresenceFeed, PRESENCE_CHANNEL, RESYNC
+from gatekeeper import CountCache, RowCount
+from gatekeeper import PartitionMaintainer
+from gatekeeper import TypeaheadIndex, LOOKUP_CHANNEL
+from gatekeeper import ExportColumn, write_xlsx, copy_statement, ExportJobs
+from gatekeeper import AttendanceRollup
+from gatekeeper import OccupancyTracker, RESOLUTIONS
 
 # Type variables for typing the decorator
 P = ParamSpec('P')
@@ -69,6 +85,15 @@ def b64encode_filter(data):
         data = data.encode('utf-8')
     return base64.b64encode(data).decode('ascii')
 
+@app.template_filter('date_format')
+def date_format_filter(d):
+    """Format date for display"""
+    if d is None:
+        return ''
+    if hasattr(d, 'strftime'):
+        return d.strftime('%d/%m/%Y')
+    return str(d)
+
 @app.template_filter('datetime_format')
 def datetime_format_filter(dt):
     """Format datetime for display"""
@@ -111,26 +136,388 @@ def validate_timestamp(timestamp_str, field_name):
     except (ValueError, AttributeError):
         return False, f"{field_name} non è un formato valido"
 
-@connected_to_database
-def get_ships_for_dropdown(curs):
-    curs.execute("SELECT id, name FROM ship ORDER BY name")
-    ships = curs.fetchall()
-    return [{"value": ship["id"], "label": ship["name"]} for ship in ships]
+# ===== TYPEAHEAD =====
 
-@connected_to_database
-def get_roles_for_dropdown(curs):
-    curs.execute("SELECT id, role_name FROM crew_member_roles ORDER BY role_name")
-    roles = curs.fetchall()
-    return [{"value": role["id"], "label": role["role_name"]} for role in roles]
+# Names of ships, roles, shipyards and crew members, searched by the dropdowns from memory
+typeahead_index = TypeaheadIndex(db_pool)
 
-@connected_to_database
-def get_shipyards_for_dropdown(curs):
-    curs.execute("SELECT id, name FROM shipyard ORDER BY name")
-    shipyards = curs.fetchall()
-    return [{"value": sy["id"], "label": sy["name"]} for sy in shipyards]
+# Tables the add, edit and delete routes under these paths write to, deleting a ship deletes its crew members too
+TYPEAHEAD_WRITE_PATHS = {
+    "/crew/": ("crew_member",),
+    "/api/crew/": ("crew_member",),
+    "/navi/": ("ship", "crew_member"),
+    "/api/ships/": ("ship", "crew_member")
+}
+
+def typeahead_options(table, query, selected_id=None):
+    """Options of a filter dropdown: the selected row alone when there is no query, else the first matches"""
+    if selected_id and not query:
+        try:
+            name = typeahead_index.name(table, int(selected_id))
+        except (TypeError, ValueError):
+            name = None
+        return [{"value": int(selected_id), "label": name}] if name is not None else []
+    return [{"value": row_id, "label": name} for row_id, name in typeahead_index.search(table, query)]
+
+def get_ships_for_dropdown():
+    return [{"value": row_id, "label": name} for row_id, name in typeahead_index.all("ship")]
+
+def get_roles_for_dropdown():
+    return [{"value": row_id, "label": name} for row_id, name in typeahead_index.all("crew_member_roles")]
+
+def get_shipyards_for_dropdown():
+    return [{"value": row_id, "label": name} for row_id, name in typeahead_index.all("shipyard")]
+
+# ===== TABLE COUNTS =====
+
+# Totals of the first page of every filter set, kept for a short time and invalidated by writes
+table_counts = CountCache(
+    ttl=float(os.getenv("TABLE_COUNT_TTL_SECONDS", "10")),
+    max_entries=int(os.getenv("TABLE_COUNT_MAX_ENTRIES", "1000"))
+)
+# Above this many rows in the planner estimate, the estimate is shown instead of counting them, 0 always counts
+TABLE_COUNT_ESTIMATE_ABOVE = int(os.getenv("TABLE_COUNT_ESTIMATE_ABOVE", "0"))
+
+@app.after_request
+def invalidate_cached_reads(response):
+    # Any add, edit or delete made from the web pages may change the counts of any table. The search endpoints
+    # are POSTs that write nothing, and the gateway writes are notified by the database
+    is_write = request.method == 'DELETE' or (
+        request.method == 'POST' and ('/add' in request.path or '/edit/' in request.path)
+    )
+    if is_write and response.status_code < 400:
+        table_counts.invalidate()
+        export_jobs.invalidate()
+        if request.path.startswith(ATTENDANCE_WRITE_PATHS):
+            # The days of the log just changed, marked dirty by trg_permanence_log_attendance, are counted again by
+            # the attendance thread now that the change is committed, without holding up the response
+            attendance_rollup.request_refresh()
+        if request.path.startswith(OCCUPANCY_WRITE_PATHS):
+            # The headcounts don't wait for the next reconcile to count the logs opened or closed by hand, the
+            # occupancy thread counts them again right away without holding up the response
+            occupancy_tracker.request_reconcile()
+        # Read again at the next search, without waiting for the notification of the change
+        for prefix, tables in TYPEAHEAD_WRITE_PATHS.items():
+            if request.path.startswith(prefix):
+                for table in tables:
+                    typeahead_index.invalidate(table)
+    return response
+
+# ===== KEYSET PAGINATION =====
+
+# Order of the rows of every table, that the cursors follow:
+# (sort expression, id expression, sort key in the rows, descending, type of the sort value). The id makes the order
+# total. The type casts the sort value of the cursor to the one of the column where they differ: a Python float is
+# sent as float8, and a REAL column compared with it is widened to float8, so 45.3 stored would never equal 45.3
+TABLE_KEYSET = {
+    "crew_member": ("cm.name", "cm.id", "crew_member_name", False, None),
+    "ship": ("name", "id", "name", False, None),
+    "tag": ("t.remaining_battery", "t.id", "remaining_battery", False, "real"),
+    "unassigned_tag_entry": ("ute.advertisement_timestamp", "ute.id", "advertisement_timestamp", True, None),
+    "permanence_log": ("cm.name", "pl.id", "crew_member_name", False, None),
+    "daily_attendance": ("da.day", "da.id", "day", True, None)
+}
+
+def encode_cursor(sort_value, row_id):
+    """Opaque cursor pointing right after the row with this sort value and id"""
+    if isinstance(sort_value, datetime):
+        sort_value = {"datetime": sort_value.isoformat()}
+    elif isinstance(sort_value, date):
+        sort_value = {"date": sort_value.isoformat()}
+    return base64.urlsafe_b64encode(json.dumps([sort_value, row_id]).encode()).decode('ascii')
+
+def decode_cursor(cursor):
+    """(sort value, id) of a cursor made by encode_cursor. Raises ValueError if it is not one."""
+    try:
+        sort_value, row_id = json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+        if isinstance(sort_value, dict) and "date" in sort_value:
+            sort_value = date.fromisoformat(sort_value["date"])
+        elif isinstance(sort_value, dict):
+            sort_value = datetime.fromisoformat(sort_value["datetime"])
+    except (ValueError, TypeError, KeyError, UnicodeError) as e:
+        raise ValueError(f"Invalid cursor {cursor!r}") from e
+    if not isinstance(row_id, int):
+        raise ValueError(f"Invalid cursor {cursor!r}")
+    return sort_value, row_id
+
+def keyset_order(table_type):
+    sort_expression, id_expression, _, descending, _ = TABLE_KEYSET[table_type]
+    direction = "DESC" if descending else "ASC"
+    return f"ORDER BY {sort_expression} {direction} NULLS LAST, {id_expression} {direction}"
+
+def keyset_condition(table_type, cursor_values):
+    """Condition and params selecting the rows after the cursor, in the order of keyset_order"""
+    if cursor_values is None:
+        return "", []
+    sort_expression, id_expression, _, descending, sort_type = TABLE_KEYSET[table_type]
+    sort_value, row_id = cursor_values
+    comparison = "<" if descending else ">"
+    placeholder = f"%s::{sort_type}" if sort_type else "%s"
+    # NULL sort values come last, ordered by id only
+    if sort_value is None:
+        return f" AND {sort_expression} IS NULL AND {id_expression} {comparison} %s", [row_id]
+    return f"""
+        AND (
+            {sort_expression} {comparison} {placeholder}
+            OR ({sort_expression} = {placeholder} AND {id_expression} {comparison} %s)
+            OR {sort_expression} IS NULL
+        )
+    """, [sort_value, sort_value, row_id]
+
+def filter_query(table_type, filters):
+    """
+    Select list, FROM ... WHERE, filter conditions and params of the logs or the entries matching the filters, shared
+    by the tables and the exports
+    """
+    if table_type == "unassigned_tag_entry":
+        # Base query parts
+        select_fields = """
+            ute.id,
+            s.name as shipyard_name,
+            t.mac_address as tag_name,
+            t.remaining_battery as battery_level,
+            ute.advertisement_timestamp,
+            CASE WHEN ute.is_entering THEN 'Ingresso' ELSE 'Uscita' END as entry_type
+        """
+        
+        from_where = """
+            FROM unassigned_tag_entry ute
+            JOIN tag t ON ute.tag_id = t.id
+            JOIN shipyard s ON ute.shipyard_id = s.id
+            WHERE 1=1
+        """
+        
+        params = []
+        filter_conditions = ""
+        
+        # Convert string timestamps to datetime objects if needed
+        if filters.get('start_timestamp'):
+            start_ts = filters['start_timestamp']
+            if isinstance(start_ts, str):
+                try:
+                    timestamp_str = start_ts.replace('T', ' ')
+                    # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
+                    # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
+                    if timestamp_str.count(':') == 1:
+                        timestamp_str += ':00'
+                    start_ts = datetime.fromisoformat(timestamp_str)
+                except:
+                    start_ts = datetime.now() - timedelta(hours=24)
+            filter_conditions += " AND ute.advertisement_timestamp >= %s"
+            params.append(start_ts)
+        
+        if filters.get('end_timestamp'):
+            end_ts = filters['end_timestamp']
+            if isinstance(end_ts, str):
+                try:
+                    timestamp_str = end_ts.replace('T', ' ')
+                    # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
+                    # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
+                    if timestamp_str.count(':') == 1:
+                        timestamp_str += ':00'
+                    end_ts = datetime.fromisoformat(timestamp_str)
+                except:
+                    end_ts = datetime.now()
+            filter_conditions += " AND ute.advertisement_timestamp <= %s"
+            params.append(end_ts)
+        
+        if filters.get('shipyard_id') and filters['shipyard_id'].strip():
+            try:
+                shipyard_id = int(filters['shipyard_id'])
+                filter_conditions += " AND ute.shipyard_id = %s"
+                params.append(shipyard_id)
+            except ValueError:
+                pass  # Skip invalid filter
+        
+        if filters.get('tag_name') and filters['tag_name'].strip():
+            filter_conditions += " AND t.mac_address ILIKE %s"
+            params.append(f"%{filters['tag_name'].strip()}%")
+        
+        return select_fields, from_where, filter_conditions, params
+        
+    if table_type == "permanence_log":
+        # Base query parts
+        select_fields = """
+            pl.id,
+            s.name as shipyard_name,
+            current_tag.mac_address as current_tag_name,
+            current_tag.remaining_battery as current_battery_level,
+            ship.name as ship_name,
+            cm.name as crew_member_name,
+            cr.role_name,
+            pl.entry_timestamp,
+            pl.leave_timestamp
+        """
+        
+        from_where = """
+            FROM permanence_log pl
+            JOIN crew_member cm ON pl.crew_member_id = cm.id
+            JOIN shipyard s ON pl.shipyard_id = s.id
+            LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+            LEFT JOIN ship ship ON cm.ship_id = ship.id
+            LEFT JOIN tag current_tag ON cm.tag_id = current_tag.id
+            WHERE 1=1
+        """
+        
+        params = []
+        filter_conditions = ""
+        
+        # Convert string timestamps to datetime objects and apply time filters
+        if filters.get('start_timestamp') and filters.get('end_timestamp'):
+            start_ts = filters['start_timestamp']
+            end_ts = filters['end_timestamp']
+            
+            if isinstance(start_ts, str):
+                try:
+                    timestamp_str = start_ts.replace('T', ' ')
+                    # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
+                    # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
+                    if timestamp_str.count(':') == 1:
+                        timestamp_str += ':00'
+                    start_ts = datetime.fromisoformat(timestamp_str)
+                except:
+                    start_ts = datetime.now() - timedelta(hours=24)
+                    
+            if isinstance(end_ts, str):
+                try:
+                    timestamp_str = end_ts.replace('T', ' ')
+                    # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
+                    # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
+                    if timestamp_str.count(':') == 1:
+                        timestamp_str += ':00'
+                    end_ts = datetime.fromisoformat(timestamp_str)
+                except:
+                    end_ts = datetime.now()
+            
+            # Show log if its time span overlaps the date range, open logs last until now.
+            # Same expression as idx_permanence_log_period, so that the index serves it, and the start of the
+            # span is the partition key, so that the months after the range are skipped
+            if start_ts <= end_ts:
+                filter_conditions += """
+                    AND permanence_period(pl.entry_timestamp, pl.leave_timestamp) && tsrange(%s, %s, '[]')
+                    AND LEAST(pl.entry_timestamp, pl.leave_timestamp) <= %s
+                """
+                params.extend([start_ts, end_ts, end_ts])
+            else:
+                filter_conditions += " AND FALSE"
+        
+        if filters.get('shipyard_id') and filters['shipyard_id'].strip():
+            try:
+                shipyard_id = int(filters['shipyard_id'])
+                filter_conditions += " AND pl.shipyard_id = %s"
+                params.append(shipyard_id)
+            except ValueError:
+                pass  # Skip invalid filter
+        
+        if filters.get('ship_id') and filters['ship_id'].strip():
+            try:
+                ship_id = int(filters['ship_id'])
+                filter_conditions += " AND cm.ship_id = %s"
+                params.append(ship_id)
+            except ValueError:
+                pass  # Skip invalid filter
+        
+        if filters.get('crew_name') and filters['crew_name'].strip():
+            filter_conditions += " AND cm.name ILIKE %s"
+            params.append(f"%{filters['crew_name'].strip()}%")
+        
+        return select_fields, from_where, filter_conditions, params
+
+    if table_type == "daily_attendance":
+        select_fields = """
+            da.id,
+            da.day,
+            s.name as shipyard_name,
+            ship.name as ship_name,
+            cm.name as crew_member_name,
+            cr.role_name,
+            ROUND(da.seconds / 3600, 2) as hours,
+            da.visits,
+            da.first_entry,
+            da.last_leave
+        """
+
+        from_where = """
+            FROM daily_attendance da
+            JOIN crew_member cm ON da.crew_member_id = cm.id
+            JOIN shipyard s ON da.shipyard_id = s.id
+            LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+            LEFT JOIN ship ship ON cm.ship_id = ship.id
+            WHERE 1=1
+        """
+
+        params = []
+        filter_conditions = ""
+
+        start_day = parse_filter_day(filters.get('start_day'))
+        if start_day:
+            filter_conditions += " AND da.day >= %s"
+            params.append(start_day)
+
+        end_day = parse_filter_day(filters.get('end_day'))
+        if end_day:
+            filter_conditions += " AND da.day <= %s"
+            params.append(end_day)
+
+        if filters.get('shipyard_id') and filters['shipyard_id'].strip():
+            try:
+                shipyard_id = int(filters['shipyard_id'])
+                filter_conditions += " AND da.shipyard_id = %s"
+                params.append(shipyard_id)
+            except ValueError:
+                pass  # Skip invalid filter
 
-def get_filtered_data(table_type, filters, page=1, page_size=50):
-    """Get filtered data based on table type and filters"""
+        if filters.get('ship_id') and filters['ship_id'].strip():
+            try:
+                ship_id = int(filters['ship_id'])
+                filter_conditions += " AND cm.ship_id = %s"
+                params.append(ship_id)
+            except ValueError:
+                pass  # Skip invalid filter
+
+        if filters.get('crew_name') and filters['crew_name'].strip():
+            filter_conditions += " AND cm.name ILIKE %s"
+            params.append(f"%{filters['crew_name'].strip()}%")
+
+        return select_fields, from_where, filter_conditions, params
+
+    raise ValueError(f"No filters for {table_type}")
+
+def get_filtered_data(table_type, filters, cursor=None, page_size=50):
+    """
+    Get filtered data based on table type and filters: the page_size rows after the cursor (from the first one
+    without), the total count and the cursor of the next page, None on the last one
+    """
+    cursor_values = None
+    if cursor:
+        try:
+            cursor_values = decode_cursor(cursor)
+        except ValueError as e:
+            print(f"Error in get_filtered_data: {e}")
+            return [], None, None
+
+    def count_rows(curs, from_where, filter_conditions, params):
+        """Total of the rows matching the filters, only for the first page and from the cache when possible"""
+        if cursor_values is not None:
+            return None
+        key = table_counts.key(table_type, filters)
+        count = table_counts.get(key)
+        if count is not None:
+            return count
+        generation = table_counts.generation(table_type)
+        count = None
+        if TABLE_COUNT_ESTIMATE_ABOVE:
+            # The planner estimate is enough when the rows are too many to count at every new filter
+            curs.execute(f"EXPLAIN (FORMAT JSON) SELECT 1 {from_where} {filter_conditions}", params)
+            estimate = int(curs.fetchone()['QUERY PLAN'][0]['Plan']['Plan Rows'])
+            if estimate >= TABLE_COUNT_ESTIMATE_ABOVE:
+                count = RowCount(estimate, estimated=True)
+        if count is None:
+            curs.execute(f"SELECT COUNT(*) as count {from_where} {filter_conditions}", params)
+            result = curs.fetchone()
+            count = RowCount(result['count'] if result else 0)
+        table_counts.put(key, count, generation)
+        return count
     
     @connected_to_database
     def fetch_data(curs):
@@ -138,7 +525,7 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
             # Only show results if there are actual filters applied (not just empty strings)
             has_filters = any(v for v in filters.values() if v and str(v).strip())
             if not has_filters:
-                return [], 0
+                return [], RowCount(0)
                 
             # Base query parts
             select_fields = """
@@ -163,11 +550,11 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
             filter_conditions = ""
             
             if filters.get('crew_name') and filters['crew_name'].strip():
-                filter_conditions += " AND LOWER(cm.name) LIKE LOWER(%s)"
+                filter_conditions += " AND cm.name ILIKE %s"
                 params.append(f"%{filters['crew_name'].strip()}%")
             
             if filters.get('ship_name') and filters['ship_name'].strip():
-                filter_conditions += " AND LOWER(s.name) LIKE LOWER(%s)"
+                filter_conditions += " AND s.name ILIKE %s"
                 params.append(f"%{filters['ship_name'].strip()}%")
             
             if filters.get('role_id') and filters['role_id'].strip():
@@ -187,14 +574,12 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
                     pass  # Skip invalid filter
             
             # Count total
-            count_query = f"SELECT COUNT(*) as count {from_where} {filter_conditions}"
-            curs.execute(count_query, params)
-            result = curs.fetchone()
-            total = result['count'] if result else 0
+            total = count_rows(curs, from_where, filter_conditions, params)
             
             # Get data with pagination
-            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} ORDER BY cm.name LIMIT %s OFFSET %s"
-            params.extend([page_size, (page - 1) * page_size])
+            keyset_conditions, keyset_params = keyset_condition(table_type, cursor_values)
+            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} {keyset_conditions} {keyset_order(table_type)} LIMIT %s"
+            params.extend(keyset_params + [page_size + 1])
             
             curs.execute(data_query, params)
             items = curs.fetchall()
@@ -205,7 +590,7 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
             # Only show results if there is a filter applied (not just empty string)
             has_filters = any(v for v in filters.values() if v and str(v).strip())
             if not has_filters:
-                return [], 0
+                return [], RowCount(0)
 
             # Base query parts
             from_where = "FROM ship WHERE 1=1"
@@ -213,18 +598,16 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
             filter_conditions = ""
             
             if filters.get('ship_name') and filters['ship_name'].strip():
-                filter_conditions += " AND LOWER(name) LIKE LOWER(%s)"
+                filter_conditions += " AND name ILIKE %s"
                 params.append(f"%{filters['ship_name'].strip()}%")
             
             # Count total
-            count_query = f"SELECT COUNT(*) as count {from_where} {filter_conditions}"
-            curs.execute(count_query, params)
-            result = curs.fetchone()
-            total = result['count'] if result else 0
+            total = count_rows(curs, from_where, filter_conditions, params)
             
             # Get data with pagination
-            data_query = f"SELECT id, name {from_where} {filter_conditions} ORDER BY name LIMIT %s OFFSET %s"
-            params.extend([page_size, (page - 1) * page_size])
+            keyset_conditions, keyset_params = keyset_condition(table_type, cursor_values)
+            data_query = f"SELECT id, name {from_where} {filter_conditions} {keyset_conditions} {keyset_order(table_type)} LIMIT %s"
+            params.extend(keyset_params + [page_size + 1])
             
             curs.execute(data_query, params)
             items = curs.fetchall()
@@ -255,101 +638,36 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
                 filter_conditions += " AND cm.id IS NULL"
             elif not filters.get('assigned') and not filters.get('vacant'):
                 # No checkboxes selected - return empty
-                return [], 0
+                return [], RowCount(0)
             
             # Filter by tag name if provided
             if filters.get('tag_name') and filters['tag_name'].strip():
-                filter_conditions += " AND LOWER(t.mac_address) LIKE LOWER(%s)"
+                filter_conditions += " AND t.mac_address ILIKE %s"
                 params.append(f"%{filters['tag_name'].strip()}%")
             
             # Count total
-            count_query = f"SELECT COUNT(*) as count {from_where} {filter_conditions}"
-            curs.execute(count_query, params)
-            result = curs.fetchone()
-            total = result['count'] if result else 0
+            total = count_rows(curs, from_where, filter_conditions, params)
             
             # Get data with pagination
-            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} ORDER BY t.remaining_battery ASC LIMIT %s OFFSET %s"
-            params.extend([page_size, (page - 1) * page_size])
+            keyset_conditions, keyset_params = keyset_condition(table_type, cursor_values)
+            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} {keyset_conditions} {keyset_order(table_type)} LIMIT %s"
+            params.extend(keyset_params + [page_size + 1])
             
             curs.execute(data_query, params)
             items = curs.fetchall()
             
             return items, total
             
-        elif table_type == "unassigned_tag_entry":
-            # Base query parts
-            select_fields = """
-                ute.id,
-                s.name as shipyard_name,
-                t.mac_address as tag_name,
-                t.remaining_battery as battery_level,
-                ute.advertisement_timestamp,
-                CASE WHEN ute.is_entering THEN 'Ingresso' ELSE 'Uscita' END as entry_type
-            """
-            
-            from_where = """
-                FROM unassigned_tag_entry ute
-                JOIN tag t ON ute.tag_id = t.id
-                JOIN shipyard s ON ute.shipyard_id = s.id
-                WHERE 1=1
-            """
-            
-            params = []
-            filter_conditions = ""
-            
-            # Convert string timestamps to datetime objects if needed
-            if filters.get('start_timestamp'):
-                start_ts = filters['start_timestamp']
-                if isinstance(start_ts, str):
-                    try:
-                        timestamp_str = start_ts.replace('T', ' ')
-                        # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
-                        # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
-                        if timestamp_str.count(':') == 1:
-                            timestamp_str += ':00'
-                        start_ts = datetime.fromisoformat(timestamp_str)
-                    except:
-                        start_ts = datetime.now() - timedelta(hours=24)
-                filter_conditions += " AND ute.advertisement_timestamp >= %s"
-                params.append(start_ts)
-            
-            if filters.get('end_timestamp'):
-                end_ts = filters['end_timestamp']
-                if isinstance(end_ts, str):
-                    try:
-                        timestamp_str = end_ts.replace('T', ' ')
-                        # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
-                        # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
-                        if timestamp_str.count(':') == 1:
-                            timestamp_str += ':00'
-                        end_ts = datetime.fromisoformat(timestamp_str)
-                    except:
-                        end_ts = datetime.now()
-                filter_conditions += " AND ute.advertisement_timestamp <= %s"
-                params.append(end_ts)
-            
-            if filters.get('shipyard_id') and filters['shipyard_id'].strip():
-                try:
-                    shipyard_id = int(filters['shipyard_id'])
-                    filter_conditions += " AND ute.shipyard_id = %s"
-                    params.append(shipyard_id)
-                except ValueError:
-                    pass  # Skip invalid filter
-            
-            if filters.get('tag_name') and filters['tag_name'].strip():
-                filter_conditions += " AND LOWER(t.mac_address) LIKE LOWER(%s)"
-                params.append(f"%{filters['tag_name'].strip()}%")
+        elif table_type in ("unassigned_tag_entry", "daily_attendance"):
+            select_fields, from_where, filter_conditions, params = filter_query(table_type, filters)
             
             # Count total
-            count_query = f"SELECT COUNT(*) as count {from_where} {filter_conditions}"
-            curs.execute(count_query, params)
-            result = curs.fetchone()
-            total = result['count'] if result else 0
+            total = count_rows(curs, from_where, filter_conditions, params)
             
             # Get data with pagination
-            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} ORDER BY ute.advertisement_timestamp DESC LIMIT %s OFFSET %s"
-            params.extend([page_size, (page - 1) * page_size])
+            keyset_conditions, keyset_params = keyset_condition(table_type, cursor_values)
+            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} {keyset_conditions} {keyset_order(table_type)} LIMIT %s"
+            params.extend(keyset_params + [page_size + 1])
             
             curs.execute(data_query, params)
             items = curs.fetchall()
@@ -357,103 +675,21 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
             return items, total
             
         elif table_type == "permanence_log":
-            # Base query parts
-            select_fields = """
-                pl.id,
-                s.name as shipyard_name,
-                current_tag.mac_address as current_tag_name,
-                current_tag.remaining_battery as current_battery_level,
-                ship.name as ship_name,
-                cm.name as crew_member_name,
-                cr.role_name,
-                pl.entry_timestamp,
-                pl.leave_timestamp
-            """
-            
-            from_where = """
-                FROM permanence_log pl
-                JOIN crew_member cm ON pl.crew_member_id = cm.id
-                JOIN shipyard s ON pl.shipyard_id = s.id
-                LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
-                LEFT JOIN ship ship ON cm.ship_id = ship.id
-                LEFT JOIN tag current_tag ON cm.tag_id = current_tag.id
-                WHERE 1=1
-            """
-            
-            params = []
-            filter_conditions = ""
-            
-            # Convert string timestamps to datetime objects and apply time filters
-            if filters.get('start_timestamp') and filters.get('end_timestamp'):
-                start_ts = filters['start_timestamp']
-                end_ts = filters['end_timestamp']
-                
-                if isinstance(start_ts, str):
-                    try:
-                        timestamp_str = start_ts.replace('T', ' ')
-                        # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
-                        # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
-                        if timestamp_str.count(':') == 1:
-                            timestamp_str += ':00'
-                        start_ts = datetime.fromisoformat(timestamp_str)
-                    except:
-                        start_ts = datetime.now() - timedelta(hours=24)
-                        
-                if isinstance(end_ts, str):
-                    try:
-                        timestamp_str = end_ts.replace('T', ' ')
-                        # datetime-local inputs give 'YYYY-MM-DD HH:MM' without seconds
-                        # fromisoformat needs 'YYYY-MM-DD HH:MM:SS'
-                        if timestamp_str.count(':') == 1:
-                            timestamp_str += ':00'
-                        end_ts = datetime.fromisoformat(timestamp_str)
-                    except:
-                        end_ts = datetime.now()
-                
-                # Show log if entry OR exit is within the date range
-                filter_conditions += """
-                    AND (
-                        (pl.entry_timestamp >= %s AND pl.entry_timestamp <= %s)
-                        OR (pl.leave_timestamp >= %s AND pl.leave_timestamp <= %s)
-                    )
-                """
-                params.extend([start_ts, end_ts, start_ts, end_ts])
-            
-            if filters.get('shipyard_id') and filters['shipyard_id'].strip():
-                try:
-                    shipyard_id = int(filters['shipyard_id'])
-                    filter_conditions += " AND pl.shipyard_id = %s"
-                    params.append(shipyard_id)
-                except ValueError:
-                    pass  # Skip invalid filter
-            
-            if filters.get('ship_id') and filters['ship_id'].strip():
-                try:
-                    ship_id = int(filters['ship_id'])
-                    filter_conditions += " AND cm.ship_id = %s"
-                    params.append(ship_id)
-                except ValueError:
-                    pass  # Skip invalid filter
-            
-            if filters.get('crew_name') and filters['crew_name'].strip():
-                filter_conditions += " AND LOWER(cm.name) LIKE LOWER(%s)"
-                params.append(f"%{filters['crew_name'].strip()}%")
+            select_fields, from_where, filter_conditions, params = filter_query(table_type, filters)
             
             # Count total
-            count_query = f"SELECT COUNT(*) as count {from_where} {filter_conditions}"
             try:
-                curs.execute(count_query, params)
-                result = curs.fetchone()
-                total = result['count'] if result else 0
+                total = count_rows(curs, from_where, filter_conditions, params)
             except Exception as e:
                 print(f"Error in count query: {e}")
-                print(f"Query: {count_query}")
+                print(f"Query: SELECT COUNT(*) {from_where} {filter_conditions}")
                 print(f"Params: {params}")
-                total = 0
+                total = RowCount(0)
             
             # Get data with pagination
-            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} ORDER BY cm.name ASC LIMIT %s OFFSET %s"
-            params_with_pagination = params + [page_size, (page - 1) * page_size]
+            keyset_conditions, keyset_params = keyset_condition(table_type, cursor_values)
+            data_query = f"SELECT {select_fields} {from_where} {filter_conditions} {keyset_conditions} {keyset_order(table_type)} LIMIT %s"
+            params_with_pagination = params + keyset_params + [page_size + 1]
             
             try:
                 curs.execute(data_query, params_with_pagination)
@@ -466,15 +702,33 @@ def get_filtered_data(table_type, filters, page=1, page_size=50):
             
             return items, total
             
-        return [], 0
+        return [], RowCount(0)
     
-    return fetch_data()
+    items, total = fetch_data()
+    # One row more than a page is fetched to know if there is a next one
+    next_cursor = None
+    if len(items) > page_size:
+        items = items[:page_size]
+        sort_key = TABLE_KEYSET[table_type][2]
+        next_cursor = encode_cursor(items[-1][sort_key], items[-1]['id'])
+    return items, total, next_cursor
 
 # ===== HTMX TABLE CONFIG HELPER =====
 
-def create_table_config(table_type, filters, page, request_path):
+def create_table_config(table_type, filters, cursor, request_path, fetch_data=True):
     """Helper function to create table configuration for both full and partial requests"""
-    data, total_count = get_filtered_data(table_type, filters, page)
+    if fetch_data:
+        data, total_count, next_cursor = get_filtered_data(table_type, filters, cursor)
+    else:
+        # Only the columns and the actions are needed, e.g. to render live rows
+        data, total_count, next_cursor = [], RowCount(0), None
+
+    # The next rows of the infinite scroll come from the partial, with the same filters and the cursor
+    next_url = None
+    if next_cursor:
+        args = {key: value for key, value in filters.items() if value}
+        args['cursor'] = next_cursor
+        next_url = f"{request_path.split('/partial')[0]}/partial?{urlencode(args)}"
     
     if table_type == "crew_member":
         return {
@@ -505,7 +759,7 @@ def create_table_config(table_type, filters, page, request_path):
             "delete_url": "/api/crew/delete/{id}",
             "data": data,
             "total_count": total_count,
-            "page": page
+            "next_url": next_url
         }
     
     elif table_type == "ship":
@@ -528,7 +782,7 @@ def create_table_config(table_type, filters, page, request_path):
             "delete_url": "/api/ships/delete/{id}",
             "data": data,
             "total_count": total_count,
-            "page": page
+            "next_url": next_url
         }
     
     elif table_type == "tag":
@@ -557,7 +811,7 @@ def create_table_config(table_type, filters, page, request_path):
             "delete_url": "/api/tags/delete/{id}",
             "data": data,
             "total_count": total_count,
-            "page": page
+            "next_url": next_url
         }
     
     elif table_type == "unassigned_tag_entry":
@@ -596,9 +850,10 @@ def create_table_config(table_type, filters, page, request_path):
             "empty_message": "Nessuna entry trovata nel periodo selezionato.",
             "delete_url": "/api/entries/delete/{id}",
             "export_url": "/entry/export",  # ADD THIS LINE
+            "live_url": "/entry/stream" if presence_feed is not None else None,
             "data": data,
             "total_count": total_count,
-            "page": page
+            "next_url": next_url
         }
 
     elif table_type == "permanence_log":
@@ -644,9 +899,57 @@ def create_table_config(table_type, filters, page, request_path):
             "edit_url": "/log/edit/{id}",
             "delete_url": "/api/logs/delete/{id}",
             "export_url": "/log/export",
+            "live_url": "/log/stream" if presence_feed is not None else None,
+            "data": data,
+            "total_count": total_count,
+            "next_url": next_url
+        }
+
+    elif table_type == "daily_attendance":
+        return {
+            "title": "Presenze Giornaliere",
+            "description": "Ore di presenza per giorno, cantiere e membro dell'equipaggio, dai log chiusi",
+            "columns": [
+                {"key": "day", "label": "Giorno", "type": "date"},
+                {"key": "shipyard_name", "label": "Cantiere", "type": "text"},
+                {"key": "ship_name", "label": "Barca", "type": "text"},
+                {"key": "crew_member_name", "label": "Equipaggio", "type": "text"},
+                {"key": "role_name", "label": "Ruolo", "type": "text"},
+                {"key": "hours", "label": "Ore", "type": "text"},
+                {"key": "visits", "label": "Accessi", "type": "text"},
+                {"key": "first_entry", "label": "Prima Entrata", "type": "datetime"},
+                {"key": "last_leave", "label": "Ultima Uscita", "type": "datetime"}
+            ],
+            "date_filters": [
+                {
+                    "key": "start_day",
+                    "label": "Dal Giorno",
+                    "input_type": "date",
+                    "default_value": (date.today() - timedelta(days=30)).isoformat()
+                },
+                {
+                    "key": "end_day",
+                    "label": "Al Giorno",
+                    "input_type": "date",
+                    "default_value": date.today().isoformat()
+                }
+            ],
+            "searchable_select_filters": [
+                {"key": "shipyard_id", "label": "Cantiere", "placeholder": "Cerca cantiere...", "search_endpoint": "/api/shipyards/filter"},
+                {"key": "ship_id", "label": "Barca", "placeholder": "Cerca barca...", "search_endpoint": "/api/ships/filter"}
+            ],
+            "text_filters": [
+                {"key": "crew_name", "label": "Nominativo", "placeholder": "Cerca per nome..."}
+            ],
+            "allow_add": False,
+            "allow_edit": False,
+            "allow_delete": False,
+            "allow_export": True,
+            "empty_message": "Nessuna presenza nel periodo selezionato.",
+            "export_url": "/presenze/export",
             "data": data,
             "total_count": total_count,
-            "page": page
+            "next_url": next_url
         }
 
     return {
@@ -655,7 +958,7 @@ def create_table_config(table_type, filters, page, request_path):
         "columns": [],
         "data": data,
         "total_count": total_count,
-        "page": page
+        "next_url": next_url
     }
 
 # ===== MAIN ROUTES =====
@@ -710,16 +1013,18 @@ def crew_page():
         'ship_id': request.args.get('ship_id', '')
     }
     
-    page = int(request.args.get('page', 1))
+    cursor = request.args.get('cursor')
     
     try:
-        table_config = create_table_config("crew_member", filters, page, request.path)
+        table_config = create_table_config("crew_member", filters, cursor, request.path)
     except Exception as e:
         print(f"Error in crew_page: {e}")
-        table_config = create_table_config("crew_member", {}, 1, request.path)
+        table_config = create_table_config("crew_member", {}, None, request.path)
     
-    # Return partial template for HTMX requests
+    # Return partial template for HTMX requests, only the next rows when scrolling
     if request.path.endswith('/partial'):
+        if cursor:
+            return render_template('table_rows_partial.html', table_config=table_config)
         return render_template('table_content_partial.html', table_config=table_config)
     
     # Return full page for regular requests
@@ -830,16 +1135,18 @@ def ships_page():
         'ship_name': request.args.get('ship_name', '')
     }
     
-    page = int(request.args.get('page', 1))
+    cursor = request.args.get('cursor')
     
     try:
-        table_config = create_table_config("ship", filters, page, request.path)
+        table_config = create_table_config("ship", filters, cursor, request.path)
     except Exception as e:
         print(f"Error in ships_page: {e}")
-        table_config = create_table_config("ship", {}, 1, request.path)
+        table_config = create_table_config("ship", {}, None, request.path)
     
-    # Return partial template for HTMX requests
+    # Return partial template for HTMX requests, only the next rows when scrolling
     if request.path.endswith('/partial'):
+        if cursor:
+            return render_template('table_rows_partial.html', table_config=table_config)
         return render_template('table_content_partial.html', table_config=table_config)
     
     # Return full page for regular requests
@@ -921,16 +1228,18 @@ def tags_page():
         'tag_name': request.args.get('tag_name', '').strip()
     }
     
-    page = int(request.args.get('page', 1))
+    cursor = request.args.get('cursor')
     
     try:
-        table_config = create_table_config("tag", filters, page, request.path)
+        table_config = create_table_config("tag", filters, cursor, request.path)
     except Exception as e:
         print(f"Error in tags_page: {e}")
-        table_config = create_table_config("tag", {}, 1, request.path)
+        table_config = create_table_config("tag", {}, None, request.path)
     
-    # Return partial template for HTMX requests
+    # Return partial template for HTMX requests, only the next rows when scrolling
     if request.path.endswith('/partial'):
+        if cursor:
+            return render_template('table_rows_partial.html', table_config=table_config)
         return render_template('table_content_partial.html', table_config=table_config)
     
     # Return full page for regular requests
@@ -954,16 +1263,18 @@ def entries_page():
         'tag_name': request.args.get('tag_name', '')
     }
     
-    page = int(request.args.get('page', 1))
+    cursor = request.args.get('cursor')
     
     try:
-        table_config = create_table_config("unassigned_tag_entry", filters, page, request.path)
+        table_config = create_table_config("unassigned_tag_entry", filters, cursor, request.path)
     except Exception as e:
         print(f"Error in entries_page: {e}")
-        table_config = create_table_config("unassigned_tag_entry", {}, 1, request.path)
+        table_config = create_table_config("unassigned_tag_entry", {}, None, request.path)
     
-    # Return partial template for HTMX requests
+    # Return partial template for HTMX requests, only the next rows when scrolling
     if request.path.endswith('/partial'):
+        if cursor:
+            return render_template('table_rows_partial.html', table_config=table_config)
         return render_template('table_content_partial.html', table_config=table_config)
     
     # Return full page for regular requests
@@ -1000,26 +1311,229 @@ def logs_page():
         'crew_name': request.args.get('crew_name', '')
     }
     
-    page = int(request.args.get('page', 1))
+    cursor = request.args.get('cursor')
     
     try:
-        table_config = create_table_config("permanence_log", filters, page, request.path)
+        table_config = create_table_config("permanence_log", filters, cursor, request.path)
     except Exception as e:
         print(f"Error in logs_page: {e}")
-        table_config = create_table_config("permanence_log", {}, 1, request.path)
+        table_config = create_table_config("permanence_log", {}, None, request.path)
     
-    # Return partial template for HTMX requests
+    # Return partial template for HTMX requests, only the next rows when scrolling
     if request.path.endswith('/partial'):
+        if cursor:
+            return render_template('table_rows_partial.html', table_config=table_config)
         return render_template('table_content_partial.html', table_config=table_config)
     
     # Return full page for regular requests
     return render_template('logs.html', table_config=table_config)
 
+# ===== DAILY ATTENDANCE =====
+
+# The days of the logs changed by hand are counted again right after the change, every other day that was marked
+# dirty at ATTENDANCE_REFRESH_HOUR every night
+attendance_rollup = AttendanceRollup(db_pool, refresh_hour=int(os.getenv("ATTENDANCE_REFRESH_HOUR", "3")))
+# Routes whose writes change the logs
+ATTENDANCE_WRITE_PATHS = ('/log/', '/api/logs/')
+
+@app.route('/presenze')
+@app.route('/presenze/partial')
+@auth_required
+def attendance_page():
+    # Default to the last 30 days
+    today = date.today()
+    filters = {
+        'start_day': request.args.get('start_day', (today - timedelta(days=30)).isoformat()),
+        'end_day': request.args.get('end_day', today.isoformat()),
+        'shipyard_id': request.args.get('shipyard_id', ''),
+        'ship_id': request.args.get('ship_id', ''),
+        'crew_name': request.args.get('crew_name', '')
+    }
+
+    cursor = request.args.get('cursor')
+
+    try:
+        table_config = create_table_config("daily_attendance", filters, cursor, request.path)
+    except Exception as e:
+        print(f"Error in attendance_page: {e}")
+        table_config = create_table_config("daily_attendance", {}, None, request.path)
+
+    if request.path.endswith('/partial'):
+        if cursor:
+            return render_template('table_rows_partial.html', table_config=table_config)
+        return render_template('table_content_partial.html', table_config=table_config)
+
+    return render_template('attendance.html', table_config=table_config)
+
+
+# ===== OCCUPANCY =====
+
+# The headcount of every shipyard is kept in memory by the ingest, and sampled every OCCUPANCY_SAMPLE_SECONDS into the
+# minute, hour and day buckets of occupancy_sample
+occupancy_tracker = OccupancyTracker(
+    db_pool,
+    sample_interval=float(os.getenv("OCCUPANCY_SAMPLE_SECONDS", "60")),
+    reconcile_interval=float(os.getenv("OCCUPANCY_RECONCILE_SECONDS", "300")),
+    minute_days=int(os.getenv("OCCUPANCY_MINUTE_DAYS", "7")),
+    hour_days=int(os.getenv("OCCUPANCY_HOUR_DAYS", "366"))
+)
+# Buckets of a series at most, the resolution is the finest that stays below
+OCCUPANCY_MAX_POINTS = int(os.getenv("OCCUPANCY_MAX_POINTS", "1500"))
+# Routes whose writes open or close logs, crew members are deleted with their logs
+OCCUPANCY_WRITE_PATHS = ATTENDANCE_WRITE_PATHS + ('/api/crew/delete/',)
+
+@app.route('/api/occupancy')
+@auth_required
+@connected_to_database
+def occupancy_series(curs):
+    """
+    Headcount of the shipyards from start to end (the last 24 hours by default), a point per bucket with the
+    average, minimum and maximum of the samples in it, and the current headcount. Without a resolution, the finest
+    one with at most OCCUPANCY_MAX_POINTS buckets that is still kept for start.
+    """
+    end = parse_filter_timestamp(request.args.get('end')) or datetime.now()
+    start = parse_filter_timestamp(request.args.get('start')) or end - timedelta(days=1)
+    if start > end:
+        return jsonify({"error": "L'inizio deve precedere la fine"}), 400
+    resolution = request.args.get('resolution') or occupancy_tracker.resolution(start, end, OCCUPANCY_MAX_POINTS)
+    if resolution not in RESOLUTIONS:
+        return jsonify({"error": "Risoluzione non valida"}), 400
+    if (end - start) / RESOLUTIONS[resolution] > OCCUPANCY_MAX_POINTS:
+        return jsonify({"error": "Intervallo troppo ampio per la risoluzione"}), 400
+    shipyard_id = request.args.get('shipyard_id', type=int)
+
+    series = {}
+    for row in occupancy_tracker.series(curs, resolution, start, end, shipyard_id):
+        shipyard = series.setdefault(row['shipyard_id'], {
+            "shipyard_id": row['shipyard_id'],
+            "shipyard_name": row['shipyard_name'],
+            "points": []
+        })
+        shipyard["points"].append([
+            row['bucket'].isoformat(), round(row['headcount_avg'], 2), row['headcount_min'], row['headcount_max']
+        ])
+    current = {
+        str(key): count for key, count in occupancy_tracker.current().items()
+        if shipyard_id is None or key == shipyard_id
+    }
+    return jsonify({
+        "resolution": resolution,
+        "start": start.isoformat(),
+        "end": end.isoformat(),
+        "columns": ["bucket", "avg", "min", "max"],
+        "current": current,
+        "series": list(series.values())
+    })
+
+
+# Columns of the exports, in the order of the tables
+LOG_EXPORT_COLUMNS = (
+    ExportColumn('Cantiere', 'shipyard_name', 15),
+    ExportColumn('Tag', 'current_tag_name', 15),
+    ExportColumn('🔋%', 'current_battery_level', 8, "center"),
+    ExportColumn('Barca', 'ship_name', 15),
+    ExportColumn('Equipaggio', 'crew_member_name', 20, "bold"),
+    ExportColumn('Ruolo', 'role_name', 15),
+    ExportColumn('Entrata', 'entry_timestamp', 20, "center", timestamp=True),
+    ExportColumn('Uscita', 'leave_timestamp', 20, "center", timestamp=True)
+)
+
+ATTENDANCE_EXPORT_COLUMNS = (
+    ExportColumn('Giorno', 'day', 12, "center", date=True),
+    ExportColumn('Cantiere', 'shipyard_name', 15),
+    ExportColumn('Barca', 'ship_name', 15),
+    ExportColumn('Equipaggio', 'crew_member_name', 20, "bold"),
+    ExportColumn('Ruolo', 'role_name', 15),
+    ExportColumn('Ore', 'hours', 8, "center"),
+    ExportColumn('Accessi', 'visits', 8, "center"),
+    ExportColumn('Prima Entrata', 'first_entry', 20, "center", timestamp=True),
+    ExportColumn('Ultima Uscita', 'last_leave', 20, "center", timestamp=True)
+)
+
+ENTRY_EXPORT_COLUMNS = (
+    ExportColumn('Cantiere', 'shipyard_name', 15),
+    ExportColumn('Tag', 'tag_name', 15),
+    ExportColumn('🔋%', 'battery_level', 8, "center"),
+    ExportColumn('Passaggio', 'advertisement_timestamp', 20, "center", timestamp=True),
+    ExportColumn('Tipologia', 'entry_type', 12, "center")
+)
+
+# Rows read from the database at a time by the exports
+EXPORT_FETCH_ROWS = int(os.getenv("EXPORT_FETCH_ROWS", "2000"))
+# Bytes sent at a time by the export responses
+EXPORT_CHUNK_BYTES = 64 * 1024
+
+def export_rows(table_type, filters):
+    """Every row matching the filters, in the order of the table, read from a server-side cursor"""
+    select_fields, from_where, filter_conditions, params = filter_query(table_type, filters)
+    with db_pool.connection() as conn:
+        with conn.cursor(name=f"export_{table_type}") as curs:
+            curs.itersize = EXPORT_FETCH_ROWS
+            curs.execute(f"SELECT {select_fields} {from_where} {filter_conditions} {keyset_order(table_type)}", params)
+            yield from curs
+
+def stream_file(path, chunk_size=EXPORT_CHUNK_BYTES):
+    """Response body sending a temporary file in chunks, removed once sent or when the client goes away"""
+    try:
+        with open(path, 'rb') as f:
+            while chunk := f.read(chunk_size):
+                yield chunk
+    finally:
+        os.remove(path)
+
+def xlsx_export(table_type, filters, columns, title, download_name):
+    """Every row matching the filters as an XLSX download, written to a temporary file and then streamed"""
+    fd, path = tempfile.mkstemp(prefix='export_', suffix='.xlsx')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            write_xlsx(export_rows(table_type, filters), columns, title, f)
+    except Exception:
+        os.remove(path)
+        raise
+    return Response(
+        stream_file(path),
+        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
+
+# Delimiters of the text formats of the exports, sent as they come out of COPY
+EXPORT_DELIMITERS = {"csv": ",", "tsv": "\t"}
+EXPORT_MIMETYPES = {"csv": "text/csv", "tsv": "text/tab-separated-values"}
+
+def copy_chunks(table_type, filters, columns, delimiter):
+    """Blocks of the delimited text of every row matching the filters, in the order of the table"""
+    select_fields, from_where, filter_conditions, params = filter_query(table_type, filters)
+    _, _, sort_key, descending, _ = TABLE_KEYSET[table_type]
+    direction = "DESC" if descending else "ASC"
+    with db_pool.connection() as conn:
+        # COPY takes no parameters, they are bound on this side
+        rows_query = psycopg.ClientCursor(conn).mogrify(f"SELECT {select_fields} {from_where} {filter_conditions}", params)
+        statement = copy_statement(columns, rows_query, f"{sort_key} {direction} NULLS LAST, id {direction}", delimiter)
+        with conn.cursor().copy(statement) as copy:
+            # COPY sends a block per row, the response gets them in larger pieces
+            buffer = bytearray()
+            for data in copy:
+                buffer += data
+                if len(buffer) >= EXPORT_CHUNK_BYTES:
+                    yield bytes(buffer)
+                    buffer.clear()
+            yield bytes(buffer)
+
+def text_export(table_type, filters, columns, export_format, download_name):
+    """Every row matching the filters as a CSV or TSV download, streamed while the database writes it"""
+    chunks = copy_chunks(table_type, filters, columns, EXPORT_DELIMITERS[export_format])
+    # The COPY starts before the response does, so that its errors still redirect with a message
+    first = next(chunks, b'')
+    return Response(
+        itertools.chain([first], chunks),
+        mimetype=EXPORT_MIMETYPES[export_format],
+        headers={'Content-Disposition': f'attachment; filename="{download_name}"'}
+    )
 
 @app.route('/log/export')
 @auth_required
 def export_logs():
-    """Export filtered logs to Excel file"""
+    """Export filtered logs to Excel file, or to CSV or TSV with format=csv or format=tsv"""
     try:
         # Get filters from URL parameters (no defaults - use what's in URL)
         filters = {
@@ -1030,121 +1544,10 @@ def export_logs():
             'crew_name': request.args.get('crew_name', '')
         }
         
-        # Fetch up to 10,000 rows matching the filters
-        data, total_count = get_filtered_data('permanence_log', filters, page=1, page_size=10000)
-        
-        # Create Excel workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Permanenze"
-        
-        # Define headers (exact order from the table)
-        headers = ['Cantiere', 'Tag', '🔋%', 'Barca', 'Equipaggio', 'Ruolo', 'Entrata', 'Uscita']
-        
-        # Define styles
-        header_fill = PatternFill(start_color="1E40AF", end_color="1E40AF", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        header_alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Border style
-        thin_border = Border(
-            left=Side(style='thin', color='E5E7EB'),
-            right=Side(style='thin', color='E5E7EB'),
-            top=Side(style='thin', color='E5E7EB'),
-            bottom=Side(style='thin', color='E5E7EB')
-        )
-        
-        # Cell alignment
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        left_alignment = Alignment(horizontal='left', vertical='center')
-        
-        # Write headers with formatting
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
-            cell.border = thin_border
-        
-        # Write data rows with minimal styling
-        for row_num, row_data in enumerate(data, 2):
-            # Cantiere
-            cell = ws.cell(row=row_num, column=1, value=row_data.get('shipyard_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            
-            # Tag
-            cell = ws.cell(row=row_num, column=2, value=row_data.get('current_tag_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            
-            # Battery percentage
-            battery = row_data.get('current_battery_level')
-            cell = ws.cell(row=row_num, column=3, value=battery if battery is not None else '')
-            cell.border = thin_border
-            cell.alignment = center_alignment
-            
-            # Barca
-            cell = ws.cell(row=row_num, column=4, value=row_data.get('ship_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            
-            # Equipaggio
-            cell = ws.cell(row=row_num, column=5, value=row_data.get('crew_member_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            cell.font = Font(bold=True)
-            
-            # Ruolo
-            cell = ws.cell(row=row_num, column=6, value=row_data.get('role_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            
-            # Entrata
-            entry_ts = row_data.get('entry_timestamp')
-            cell = ws.cell(row=row_num, column=7, value=entry_ts.strftime('%d/%m/%Y %H:%M:%S') if entry_ts else '')
-            cell.border = thin_border
-            cell.alignment = center_alignment
-            
-            # Uscita
-            leave_ts = row_data.get('leave_timestamp')
-            cell = ws.cell(row=row_num, column=8, value=leave_ts.strftime('%d/%m/%Y %H:%M:%S') if leave_ts else '')
-            cell.border = thin_border
-            cell.alignment = center_alignment
-        
-        # Auto-adjust column widths with better sizing
-        column_widths = {
-            'A': 15,  # Cantiere
-            'B': 15,  # Tag
-            'C': 8,   # Battery
-            'D': 15,  # Barca
-            'E': 20,  # Equipaggio
-            'F': 15,  # Ruolo
-            'G': 20,  # Entrata
-            'H': 20   # Uscita
-        }
-        
-        for col_letter, width in column_widths.items():
-            ws.column_dimensions[col_letter].width = width
-        
-        # Set row height for header
-        ws.row_dimensions[1].height = 25
-        
-        # Freeze header row
-        ws.freeze_panes = 'A2'
-        
-        # Save to BytesIO
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        # Return file for download
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name='Permanenze.xlsx'
-        )
+        export_format = request.args.get('format', 'xlsx')
+        if export_format in EXPORT_DELIMITERS:
+            return text_export('permanence_log', filters, LOG_EXPORT_COLUMNS, export_format, f'Permanenze.{export_format}')
+        return xlsx_export('permanence_log', filters, LOG_EXPORT_COLUMNS, "Permanenze", 'Permanenze.xlsx')
         
     except Exception as e:
         print(f"Error in export_logs: {e}")
@@ -1155,7 +1558,7 @@ def export_logs():
 @app.route('/entry/export')
 @auth_required
 def export_entries():
-    """Export filtered entries to Excel file"""
+    """Export filtered entries to Excel file, or to CSV or TSV with format=csv or format=tsv"""
     try:
         # Get filters from URL parameters (no defaults - use what's in URL)
         filters = {
@@ -1165,101 +1568,12 @@ def export_entries():
             'tag_name': request.args.get('tag_name', '')
         }
         
-        # Fetch up to 10,000 rows matching the filters
-        data, total_count = get_filtered_data('unassigned_tag_entry', filters, page=1, page_size=10000)
-        
-        # Create Excel workbook
-        wb = Workbook()
-        ws = wb.active
-        ws.title = "Tag Entries"
-        
-        # Define headers (exact order from the table)
-        headers = ['Cantiere', 'Tag', '🔋%', 'Passaggio', 'Tipologia']
-        
-        # Define styles
-        header_fill = PatternFill(start_color="1E40AF", end_color="1E40AF", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF", size=12)
-        header_alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Border style
-        thin_border = Border(
-            left=Side(style='thin', color='E5E7EB'),
-            right=Side(style='thin', color='E5E7EB'),
-            top=Side(style='thin', color='E5E7EB'),
-            bottom=Side(style='thin', color='E5E7EB')
-        )
-        
-        # Cell alignment
-        center_alignment = Alignment(horizontal='center', vertical='center')
-        left_alignment = Alignment(horizontal='left', vertical='center')
-        
-        # Write headers with formatting
-        for col_num, header in enumerate(headers, 1):
-            cell = ws.cell(row=1, column=col_num, value=header)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.alignment = header_alignment
-            cell.border = thin_border
-        
-        # Write data rows with minimal styling
-        for row_num, row_data in enumerate(data, 2):
-            # Cantiere
-            cell = ws.cell(row=row_num, column=1, value=row_data.get('shipyard_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            
-            # Tag
-            cell = ws.cell(row=row_num, column=2, value=row_data.get('tag_name', ''))
-            cell.border = thin_border
-            cell.alignment = left_alignment
-            
-            # Battery percentage
-            battery = row_data.get('battery_level')
-            cell = ws.cell(row=row_num, column=3, value=battery if battery is not None else '')
-            cell.border = thin_border
-            cell.alignment = center_alignment
-            
-            # Passaggio (advertisement_timestamp)
-            adv_ts = row_data.get('advertisement_timestamp')
-            cell = ws.cell(row=row_num, column=4, value=adv_ts.strftime('%d/%m/%Y %H:%M:%S') if adv_ts else '')
-            cell.border = thin_border
-            cell.alignment = center_alignment
-            
-            # Tipologia (entry_type: "Ingresso" or "Uscita")
-            cell = ws.cell(row=row_num, column=5, value=row_data.get('entry_type', ''))
-            cell.border = thin_border
-            cell.alignment = center_alignment
-        
-        # Auto-adjust column widths
-        column_widths = {
-            'A': 15,  # Cantiere
-            'B': 15,  # Tag
-            'C': 8,   # Battery
-            'D': 20,  # Passaggio
-            'E': 12   # Tipologia
-        }
-        
-        for col_letter, width in column_widths.items():
-            ws.column_dimensions[col_letter].width = width
-        
-        # Set row height for header
-        ws.row_dimensions[1].height = 25
-        
-        # Freeze header row
-        ws.freeze_panes = 'A2'
-        
-        # Save to BytesIO
-        output = BytesIO()
-        wb.save(output)
-        output.seek(0)
-        
-        # Return file for download
-        return send_file(
-            output,
-            mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-            as_attachment=True,
-            download_name='Tag_Entries.xlsx'
-        )
+        export_format = request.args.get('format', 'xlsx')
+        if export_format in EXPORT_DELIMITERS:
+            return text_export(
+                'unassigned_tag_entry', filters, ENTRY_EXPORT_COLUMNS, export_format, f'Tag_Entries.{export_format}'
+            )
+        return xlsx_export('unassigned_tag_entry', filters, ENTRY_EXPORT_COLUMNS, "Tag Entries", 'Tag_Entries.xlsx')
         
     except Exception as e:
         print(f"Error in export_entries: {e}")
@@ -1267,6 +1581,157 @@ def export_entries():
         return redirect('/entry')
 
 
+@app.route('/presenze/export')
+@auth_required
+def export_attendance():
+    """Export the filtered daily attendance to Excel file, or to CSV or TSV with format=csv or format=tsv"""
+    try:
+        filters = {
+            'start_day': request.args.get('start_day'),
+            'end_day': request.args.get('end_day'),
+            'shipyard_id': request.args.get('shipyard_id', ''),
+            'ship_id': request.args.get('ship_id', ''),
+            'crew_name': request.args.get('crew_name', '')
+        }
+
+        export_format = request.args.get('format', 'xlsx')
+        if export_format in EXPORT_DELIMITERS:
+            return text_export(
+                'daily_attendance', filters, ATTENDANCE_EXPORT_COLUMNS, export_format, f'Presenze.{export_format}'
+            )
+        return xlsx_export('daily_attendance', filters, ATTENDANCE_EXPORT_COLUMNS, "Presenze", 'Presenze.xlsx')
+
+    except Exception as e:
+        print(f"Error in export_attendance: {e}")
+        flash(f'Errore durante l\'esportazione: {str(e)}', 'error')
+        return redirect('/presenze')
+
+# ===== EXPORT JOBS =====
+
+# Exports run in the background by worker processes with connections of their own, and the files of the ranges that
+# are over are kept as a cache, emptied by the web writes and the renames
+export_jobs = ExportJobs(
+    db_url,
+    os.getenv("EXPORT_CACHE_DIR") or os.path.join(tempfile.gettempdir(), "gatekeeper_exports"),
+    workers=int(os.getenv("EXPORT_WORKERS", "2")),
+    max_age=float(os.getenv("EXPORT_CACHE_HOURS", "24")) * 3600,
+    max_files=int(os.getenv("EXPORT_CACHE_MAX_FILES", "20")),
+    fetch_rows=EXPORT_FETCH_ROWS
+)
+atexit.register(export_jobs.stop)
+
+# Columns, sheet title, download name and rows that may still change of the tables with export jobs
+EXPORT_JOB_TABLES = {
+    "permanence_log": (LOG_EXPORT_COLUMNS, "Permanenze", "Permanenze", "leave_timestamp IS NULL"),
+    "unassigned_tag_entry": (ENTRY_EXPORT_COLUMNS, "Tag Entries", "Tag_Entries", None),
+    "daily_attendance": (ATTENDANCE_EXPORT_COLUMNS, "Presenze", "Presenze", None)
+}
+
+def export_range_closed(table_type, filters):
+    """Whether the time range of the filters is over, so that no row written from now on can match them"""
+    if table_type == "daily_attendance":
+        # A log closing now adds to every day it spans, however long ago it opened
+        return False
+    end_ts = parse_filter_timestamp(filters.get('end_timestamp'))
+    if end_ts is None or end_ts >= datetime.now():
+        return False
+    # The logs are filtered by time only when both ends are set
+    return table_type != "permanence_log" or parse_filter_timestamp(filters.get('start_timestamp')) is not None
+
+def submit_export_job(table_type, filters):
+    """Job exporting the rows matching the filters in the format of the request, 400 for an unknown format"""
+    export_format = request.values.get('format', 'xlsx')
+    if export_format != 'xlsx' and export_format not in EXPORT_DELIMITERS:
+        return jsonify({"error": f"Formato {export_format} non supportato"}), 400
+    columns, title, download_name, open_condition = EXPORT_JOB_TABLES[table_type]
+    select_fields, from_where, filter_conditions, params = filter_query(table_type, filters)
+    _, _, sort_key, descending, _ = TABLE_KEYSET[table_type]
+    direction = "DESC" if descending else "ASC"
+    job = export_jobs.submit(
+        export_format,
+        f"SELECT {select_fields} {from_where} {filter_conditions}",
+        params,
+        f"{sort_key} {direction} NULLS LAST, id {direction}",
+        columns,
+        title,
+        f"{download_name}.{export_format}",
+        closed=export_range_closed(table_type, filters),
+        open_condition=open_condition
+    )
+    return jsonify(job.to_dict()), 202
+
+@app.route('/log/export/job', methods=['POST'])
+@auth_required
+def export_logs_job():
+    """Start exporting the filtered logs in the background, same filters and format as /log/export"""
+    try:
+        filters = {
+            'start_timestamp': request.values.get('start_timestamp'),
+            'end_timestamp': request.values.get('end_timestamp'),
+            'shipyard_id': request.values.get('shipyard_id', ''),
+            'ship_id': request.values.get('ship_id', ''),
+            'crew_name': request.values.get('crew_name', '')
+        }
+        return submit_export_job('permanence_log', filters)
+    except Exception as e:
+        print(f"Error in export_logs_job: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/entry/export/job', methods=['POST'])
+@auth_required
+def export_entries_job():
+    """Start exporting the filtered entries in the background, same filters and format as /entry/export"""
+    try:
+        filters = {
+            'start_timestamp': request.values.get('start_timestamp'),
+            'end_timestamp': request.values.get('end_timestamp'),
+            'shipyard_id': request.values.get('shipyard_id', ''),
+            'tag_name': request.values.get('tag_name', '')
+        }
+        return submit_export_job('unassigned_tag_entry', filters)
+    except Exception as e:
+        print(f"Error in export_entries_job: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/presenze/export/job', methods=['POST'])
+@auth_required
+def export_attendance_job():
+    """Start exporting the filtered daily attendance in the background, same filters and format as /presenze/export"""
+    try:
+        filters = {
+            'start_day': request.values.get('start_day'),
+            'end_day': request.values.get('end_day'),
+            'shipyard_id': request.values.get('shipyard_id', ''),
+            'ship_id': request.values.get('ship_id', ''),
+            'crew_name': request.values.get('crew_name', '')
+        }
+        return submit_export_job('daily_attendance', filters)
+    except Exception as e:
+        print(f"Error in export_attendance_job: {e}")
+        return jsonify({"error": str(e)}), 500
+
+@app.route('/api/exports/<job_id>')
+@auth_required
+def export_job_status(job_id):
+    """Status of an export job: queued, running, done or failed, with the rows written out of the total"""
+    job = export_jobs.job(job_id)
+    if job is None:
+        return jsonify({"error": "Esportazione non trovata"}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/api/exports/<job_id>/download')
+@auth_required
+def export_job_download(job_id):
+    job = export_jobs.job(job_id)
+    if job is None or job.status != "done":
+        return jsonify({"error": "Esportazione non disponibile"}), 404
+    try:
+        return send_file(job.path, as_attachment=True, download_name=job.download_name)
+    except FileNotFoundError:
+        # Removed by an expiry between the status and the download
+        return jsonify({"error": "Esportazione non disponibile"}), 404
+
+
 @app.route('/log/add', methods=['GET', 'POST'])
 @auth_required
 @connected_to_database
@@ -1381,43 +1846,194 @@ def delete_log(curs, log_id):
     except Exception as e:
         return jsonify({"success": False, "error": str(e)}), 500
 
+# ===== LIVE TABLES =====
+
+# Built in production, where the database notifications are listened to
+presence_feed = None
+
+LIVE_KEEPALIVE_SECONDS = 15
+
+@connected_to_database
+def get_live_row(curs, table_type, row_id):
+    """A single log or entry, with the same columns as the table rows plus the ones the live filters need"""
+    if table_type == "permanence_log":
+        curs.execute("""
+            SELECT
+                pl.id,
+                pl.shipyard_id,
+                cm.ship_id,
+                s.name as shipyard_name,
+                current_tag.mac_address as current_tag_name,
+                current_tag.remaining_battery as current_battery_level,
+                ship.name as ship_name,
+                cm.name as crew_member_name,
+                cr.role_name,
+                pl.entry_timestamp,
+                pl.leave_timestamp
+            FROM permanence_log pl
+            JOIN crew_member cm ON pl.crew_member_id = cm.id
+            JOIN shipyard s ON pl.shipyard_id = s.id
+            LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+            LEFT JOIN ship ship ON cm.ship_id = ship.id
+            LEFT JOIN tag current_tag ON cm.tag_id = current_tag.id
+            WHERE pl.id = %s
+        """, (row_id,))
+    elif table_type == "unassigned_tag_entry":
+        curs.execute("""
+            SELECT
+                ute.id,
+                ute.shipyard_id,
+                s.name as shipyard_name,
+                t.mac_address as tag_name,
+                t.remaining_battery as battery_level,
+                ute.advertisement_timestamp,
+                CASE WHEN ute.is_entering THEN 'Ingresso' ELSE 'Uscita' END as entry_type
+            FROM unassigned_tag_entry ute
+            JOIN tag t ON ute.tag_id = t.id
+            JOIN shipyard s ON ute.shipyard_id = s.id
+            WHERE ute.id = %s
+        """, (row_id,))
+    else:
+        return None
+    return curs.fetchone()
+
+def parse_filter_timestamp(value):
+    """datetime-local filter value to datetime, None if missing or invalid"""
+    if not value:
+        return None
+    try:
+        timestamp_str = value.replace('T', ' ')
+        if timestamp_str.count(':') == 1:
+            timestamp_str += ':00'
+        return datetime.fromisoformat(timestamp_str)
+    except ValueError:
+        return None
+
+def parse_filter_day(value):
+    """date filter value to date, None if missing or invalid"""
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value[:10])
+    except ValueError:
+        return None
+
+def live_row_matches(table_type, row, filters, opened_at):
+    """
+    Whether a live row belongs to the table the client is looking at, with the same filters as get_filtered_data.
+    An end date from the minute the page was opened or later counts as "until now", otherwise the default filter
+    would hide every row that comes after the page load.
+    """
+    for key in ("shipyard_id", "ship_id"):
+        if filters.get(key) and filters[key].strip() and key in row:
+            try:
+                if row[key] != int(filters[key]):
+                    return False
+            except ValueError:
+                pass  # Skip invalid filter
+
+    if table_type == "permanence_log":
+        if filters.get('crew_name') and filters['crew_name'].strip():
+            if filters['crew_name'].strip().lower() not in (row['crew_member_name'] or '').lower():
+                return False
+        # Same span as the permanence_period database function
+        timestamps = [ts for ts in (row['entry_timestamp'], row['leave_timestamp']) if ts is not None]
+        first_ts = min(timestamps, default=None)
+        last_ts = max(timestamps, default=None) if row['leave_timestamp'] is not None else None
+    else:
+        if filters.get('tag_name') and filters['tag_name'].strip():
+            if filters['tag_name'].strip().lower() not in (row['tag_name'] or '').lower():
+                return False
+        first_ts = last_ts = row['advertisement_timestamp']
+
+    start_ts = parse_filter_timestamp(filters.get('start_timestamp'))
+    end_ts = parse_filter_timestamp(filters.get('end_timestamp'))
+    if end_ts is not None and end_ts >= opened_at.replace(second=0, microsecond=0):
+        end_ts = None
+    return (
+        (end_ts is None or first_ts is None or first_ts <= end_ts)
+        and (start_ts is None or last_ts is None or last_ts >= start_ts)
+    )
+
+def live_stream(table_type, filters):
+    """Server-Sent Events with the rendered rows of the table that match the filters, as they are committed"""
+    if presence_feed is None:
+        return "Aggiornamento in tempo reale non disponibile", 404
+    client = presence_feed.subscribe()
+    if client is None:
+        return "Troppi client collegati", 503
+
+    table_config = create_table_config(table_type, filters, None, request.path, fetch_data=False)
+    base_path = request.path.rsplit('/stream', 1)[0]
+    opened_at = datetime.now()
+
+    def events():
+        try:
+            yield "retry: 5000\n\n"
+            while True:
+                try:
+                    event = client.get(timeout=LIVE_KEEPALIVE_SECONDS)
+                except queue.Empty:
+                    # Also how a closed connection is noticed, the write fails
+                    yield ": keepalive\n\n"
+                    continue
+                if event == RESYNC:
+                    yield "event: resync\ndata: \n\n"
+                    continue
+                event_table, row = event
+                if event_table != table_type or not live_row_matches(table_type, row, filters, opened_at):
+                    continue
+                html = render_template('table_row_partial.html', table_config=table_config, row=row,
+                                       base_path=base_path)
+                data = json.dumps({"id": row['id'], "html": html})
+                yield f"event: row\ndata: {data}\n\n"
+        finally:
+            presence_feed.unsubscribe(client)
+
+    return Response(
+        stream_with_context(events()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.route('/log/stream')
+@auth_required
+def logs_stream():
+    filters = {key: request.args.get(key, '') for key in
+               ('start_timestamp', 'end_timestamp', 'shipyard_id', 'ship_id', 'crew_name')}
+    return live_stream("permanence_log", filters)
+
+@app.route('/entry/stream')
+@auth_required
+def entries_stream():
+    filters = {key: request.args.get(key, '') for key in ('start_timestamp', 'end_timestamp', 'shipyard_id', 'tag_name')}
+    return live_stream("unassigned_tag_entry", filters)
+
 # ===== SEARCH ENDPOINTS (keep for add/edit forms) =====
 
 @app.route('/api/ships/search', methods=['POST'])
 @auth_required
-@connected_to_database
-def search_ships(curs):
+def search_ships():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
     query = data.get('query', '').strip()
     
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, name FROM ship WHERE LOWER(name) LIKE LOWER(%s) ORDER BY name LIMIT 10",
-        [f"%{query}%"]
-    )
-    ships = curs.fetchall()
+    ships = [{"id": row_id, "name": name} for row_id, name in typeahead_index.search("ship", query)]
     
     return jsonify({"ships": ships})
 
 @app.route('/api/roles/search', methods=['POST'])
 @auth_required
-@connected_to_database
-def search_roles(curs):
+def search_roles():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
     query = data.get('query', '').strip()
     
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, role_name FROM crew_member_roles WHERE LOWER(role_name) LIKE LOWER(%s) ORDER BY role_name LIMIT 10",
-        [f"%{query}%"]
-    )
-    roles = curs.fetchall()
+    roles = [{"id": row_id, "role_name": name} for row_id, name in typeahead_index.search("crew_member_roles", query)]
     
     return jsonify({"roles": roles})
 
@@ -1439,7 +2055,7 @@ def search_tags(curs):
         sql = (
             "SELECT t.id, t.mac_address as name "
             "FROM tag t "
-            "WHERE LOWER(t.mac_address) LIKE LOWER(%s) "
+            "WHERE t.mac_address ILIKE %s "
             "  AND (t.id = %s OR t.id NOT IN (" + subquery + ")) "
             "ORDER BY t.mac_address LIMIT 10"
         )
@@ -1448,7 +2064,7 @@ def search_tags(curs):
         sql = (
             "SELECT t.id, t.mac_address as name "
             "FROM tag t "
-            "WHERE LOWER(t.mac_address) LIKE LOWER(%s) "
+            "WHERE t.mac_address ILIKE %s "
             "  AND t.id NOT IN (" + subquery + ") "
             "ORDER BY t.mac_address LIMIT 10"
         )
@@ -1458,39 +2074,27 @@ def search_tags(curs):
 
 @app.route('/api/crew/search', methods=['POST'])
 @auth_required
-@connected_to_database
-def search_crew(curs):
+def search_crew():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
     query = data.get('query', '').strip()
     
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, name FROM crew_member WHERE LOWER(name) LIKE LOWER(%s) ORDER BY name LIMIT 10",
-        [f"%{query}%"]
-    )
-    crew_members = curs.fetchall()
+    crew_members = [{"id": row_id, "name": name} for row_id, name in typeahead_index.search("crew_member", query)]
     
     return jsonify({"crew_members": crew_members})
 
 @app.route('/api/shipyards/search', methods=['POST'])
 @auth_required
-@connected_to_database
-def search_shipyards(curs):
+def search_shipyards():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
         
     query = data.get('query', '').strip()
     
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, name FROM shipyard WHERE LOWER(name) LIKE LOWER(%s) ORDER BY name LIMIT 10",
-        [f"%{query}%"]
-    )
-    shipyards = curs.fetchall()
+    shipyards = [{"id": row_id, "name": name} for row_id, name in typeahead_index.search("shipyard", query)]
     
     return jsonify({"shipyards": shipyards})
 
@@ -1498,8 +2102,7 @@ def search_shipyards(curs):
 
 @app.route('/api/ships/filter', methods=['POST'])
 @auth_required
-@connected_to_database
-def filter_ships(curs):
+def filter_ships():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
@@ -1507,28 +2110,12 @@ def filter_ships(curs):
     query = data.get('query', '').strip()
     selected_id = data.get('selected_id')
     
-    # If we have a selected_id but no query, return just that item
-    if selected_id and not query:
-        curs.execute("SELECT id, name FROM ship WHERE id = %s", [selected_id])
-        ship = curs.fetchone()
-        if ship:
-            return jsonify({"options": [{"value": ship["id"], "label": ship["name"]}]})
-        return jsonify({"options": []})
-    
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, name FROM ship WHERE LOWER(name) LIKE LOWER(%s) ORDER BY name LIMIT 10",
-        [f"%{query}%"]
-    )
-    ships = curs.fetchall()
-    
-    options = [{"value": ship["id"], "label": ship["name"]} for ship in ships]
-    return jsonify({"options": options})
+    # With a selected_id but no query, just that item
+    return jsonify({"options": typeahead_options("ship", query, selected_id)})
 
 @app.route('/api/roles/filter', methods=['POST'])
 @auth_required
-@connected_to_database
-def filter_roles(curs):
+def filter_roles():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
@@ -1536,28 +2123,12 @@ def filter_roles(curs):
     query = data.get('query', '').strip()
     selected_id = data.get('selected_id')
     
-    # If we have a selected_id but no query, return just that item
-    if selected_id and not query:
-        curs.execute("SELECT id, role_name FROM crew_member_roles WHERE id = %s", [selected_id])
-        role = curs.fetchone()
-        if role:
-            return jsonify({"options": [{"value": role["id"], "label": role["role_name"]}]})
-        return jsonify({"options": []})
-    
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, role_name FROM crew_member_roles WHERE LOWER(role_name) LIKE LOWER(%s) ORDER BY role_name LIMIT 10",
-        [f"%{query}%"]
-    )
-    roles = curs.fetchall()
-    
-    options = [{"value": role["id"], "label": role["role_name"]} for role in roles]
-    return jsonify({"options": options})
+    # With a selected_id but no query, just that item
+    return jsonify({"options": typeahead_options("crew_member_roles", query, selected_id)})
 
 @app.route('/api/shipyards/filter', methods=['POST'])
 @auth_required
-@connected_to_database
-def filter_shipyards(curs):
+def filter_shipyards():
     data = request.get_json()
     if not data:
         return jsonify({"error": "Invalid JSON"}), 400
@@ -1565,23 +2136,8 @@ def filter_shipyards(curs):
     query = data.get('query', '').strip()
     selected_id = data.get('selected_id')
     
-    # If we have a selected_id but no query, return just that item
-    if selected_id and not query:
-        curs.execute("SELECT id, name FROM shipyard WHERE id = %s", [selected_id])
-        shipyard = curs.fetchone()
-        if shipyard:
-            return jsonify({"options": [{"value": shipyard["id"], "label": shipyard["name"]}]})
-        return jsonify({"options": []})
-    
-    # Remove the 2-character minimum requirement
-    curs.execute(
-        "SELECT id, name FROM shipyard WHERE LOWER(name) LIKE LOWER(%s) ORDER BY name LIMIT 10",
-        [f"%{query}%"]
-    )
-    shipyards = curs.fetchall()
-    
-    options = [{"value": shipyard["id"], "label": shipyard["name"]} for shipyard in shipyards]
-    return jsonify({"options": options})
+    # With a selected_id but no query, just that item
+    return jsonify({"options": typeahead_options("shipyard", query, selected_id)})
 
 
 if flask_env == 'development':
@@ -1615,222 +2171,227 @@ if flask_env == 'development':
             return "Invalid gateway message", 400
         
         for device in device_list:
-            
-            device_data = device.get("data")
-            if not device_data:
-                return "Invalid gateway message", 400
-            
-            scan_time = device.get("scan_time")
-            if not scan_time:        
+            if not device.get("data") or not device.get("scan_time"):
                 return "Invalid gateway message", 400
-            
-            scan_time = str(scan_time)
-            
-            device_data = device_data[16:] # Skip header
-
-            unprocessed_echobeacon_id = device_data[:4]
-            packet_type = device_data[4:6]
-            packet_counter = device_data[6:8]
-            mac_address = device_data[8:20]
-            unprocessed_rssi = device_data[20:22]
 
+        for device, advertisement in zip(device_list, decode_device_list(device_list)):
             # Only consider echo packets
-            if packet_type != "03":
+            if advertisement is None or advertisement.packet_type != PRESENCE_PACKET:
                 continue
 
-            echobeacon_id = str(int(unprocessed_echobeacon_id, 16))
-            rssi_dbm = str(int(unprocessed_rssi, 16) - 256)
-
-            print_formatted_data(mac_address, echobeacon_id, rssi_dbm, packet_counter, scan_time)
+            print_formatted_data(
+                advertisement.mac_address,
+                str(advertisement.beacon_number),
+                str(advertisement.rssi),
+                f"{advertisement.packet_counter:02X}",
+                str(device.get("scan_time"))
+            )
         
         return "Processed correctly", 200
 
 
-# Used to determine remaining battery percentage
-
 if flask_env == 'production':  
-    BATTERY_MAX_MILLIVOLTS = 3600
-
-    @connected_to_database
-    def process_device(curs, device):
-        # Parse raw payload
-        device_data = device.get("data")
-        if not device_data:
-            return
-        device_data = device_data[16:]  # skip gateway header
-        if len(device_data) < 28:
-            return
-        if device_data[4:6] != "03":  # presence packets only
-            return
-        if not (int(device_data[22:24], 16) & 0x04):  # require Eddystone TLM flag
-            return
-
-        # Decode fields
-        beacon_mac_address = device_data[8:20]
-        packet_counter = int(device_data[6:8], 16)
-        eddy_volt = int(device_data[24:28], 16)
-        remaining_battery_percentage = round((eddy_volt / BATTERY_MAX_MILLIVOLTS) * 100, 1)
-        echobeacon_friendly = int(device_data[0:4], 16)
-
-        # Resolve tag
-        curs.execute("""
-            SELECT id, packet_counter, previous_echobeacon
-            FROM tag
-            WHERE mac_address = %s
-        """, (beacon_mac_address,))
-        tag = curs.fetchone()
-        if not tag:
-            return
-
-        tag_id = tag['id']
-        old_packet_counter = tag['packet_counter']
-        prev_echobeacon_before = tag['previous_echobeacon']
-
-        # Update telemetry; set previous_echobeacon to current beacon only when packet changes
-        curs.execute("""
-            UPDATE tag
-            SET remaining_battery = %s,
-                packet_counter = CASE
-                    WHEN packet_counter IS NULL OR %s <> packet_counter THEN %s
-                    ELSE packet_counter
-                END,
-                previous_echobeacon = CASE
-                    WHEN packet_counter IS NULL OR %s <> packet_counter
-                        THEN (SELECT id FROM activator_beacon WHERE friendly_number = %s)
-                    ELSE previous_echobeacon
-                END
-            WHERE id = %s
-        """, (
-            remaining_battery_percentage,
-            packet_counter, packet_counter,
-            packet_counter, echobeacon_friendly,
-            tag_id
-        ))
-
-        # Ignore duplicates and first-ever packets (need a pair)
-        if old_packet_counter == packet_counter:
-            return
-        if old_packet_counter is None:
-            return
-
-        # Need a prior beacon to compute direction
-        previous_echobeacon_id = prev_echobeacon_before
-        if not previous_echobeacon_id:
-            return
-
-        # Current beacon (by friendly number)
-        curs.execute("""
-            SELECT id, shipyard_id, is_first_when_entering
-            FROM activator_beacon
-            WHERE friendly_number = %s
-        """, (echobeacon_friendly,))
-        current_beacon = curs.fetchone()
-        if not current_beacon:
-            return
-        current_beacon_id = current_beacon['id']
-        current_shipyard_id = current_beacon['shipyard_id']
-        current_is_first_when_entering = current_beacon['is_first_when_entering']
+    # Activator beacons are read from memory, and reloaded when the table notifies a change
+    beacon_registry = BeaconRegistry(db_pool)
+    notification_listener = NotificationListener(db_url)
+    notification_listener.subscribe(BEACON_CHANNEL, beacon_registry.reload)
+
+    # Logs and unassigned tag entries are pushed to the live tables as they are committed, by the same listener
+    LIVE_MAX_CLIENTS = int(os.getenv("LIVE_MAX_CLIENTS", "8"))
+    presence_feed = PresenceFeed(
+        get_live_row,
+        max_clients=LIVE_MAX_CLIENTS,
+        max_pending=int(os.getenv("LIVE_MAX_PENDING", "100"))
+    )
+    notification_listener.subscribe(PRESENCE_CHANNEL, presence_feed.notify)
+    # New and closed logs and entries change the table counts too
+    notification_listener.subscribe(PRESENCE_CHANNEL, table_counts.notify)
+    # Names added, renamed or deleted anywhere are applied to the typeahead index one by one
+    notification_listener.subscribe(LOOKUP_CHANNEL, typeahead_index.notify)
+    # The exports show the names as they are now, so the cached files of the old names are dropped
+    notification_listener.subscribe(LOOKUP_CHANNEL, lambda payload: export_jobs.invalidate())
+
+    # Logs and unassigned tag entries are partitioned by month: the partitions of the coming months are created
+    # ahead, and with RETENTION_MONTHS set the older ones are detached to the event_archive schema
+    partition_maintainer = PartitionMaintainer(
+        db_pool,
+        months_ahead=int(os.getenv("PARTITION_MONTHS_AHEAD", "3")),
+        retention_months=int(os.getenv("RETENTION_MONTHS", "0")),
+        interval=float(os.getenv("PARTITION_CHECK_HOURS", "6")) * 3600
+    )
 
-        # No movement across same beacon
-        if previous_echobeacon_id == current_beacon_id:
-            return
+    # Tag battery, packet counter and pairing live in memory and are written back in bulk
+    TAG_STATE_FLUSH_SECONDS = float(os.getenv("TAG_STATE_FLUSH_SECONDS", "5"))
+    TAG_STATE_OPTIONS = {
+        "battery_delta": float(os.getenv("BATTERY_FLUSH_DELTA", "1.0")),
+        "battery_max_interval": float(os.getenv("BATTERY_FLUSH_MAX_SECONDS", "600"))
+    }
+    tag_state_engine = TagStateEngine(db_pool, beacon_registry, **TAG_STATE_OPTIONS)
 
-        # Previous beacon (by stored id)
-        curs.execute("""
-            SELECT shipyard_id, is_first_when_entering
-            FROM activator_beacon
-            WHERE id = %s
-        """, (previous_echobeacon_id,))
-        previous_beacon = curs.fetchone()
-        if not previous_beacon:
-            return
-        previous_shipyard_id = previous_beacon['shipyard_id']
-        previous_is_first_when_entering = previous_beacon['is_first_when_entering']
+    # Exact copies of recent advertisements are dropped before any database work
+    DEDUP_OPTIONS = {
+        "max_entries": int(os.getenv("DEDUP_MAX_ENTRIES", "20000")),
+        "ttl": float(os.getenv("DEDUP_TTL_SECONDS", "30"))
+    }
+    duplicate_cache = DuplicateCache(**DEDUP_OPTIONS)
+
+    # "memory" takes the ingest decisions with the in-memory tag state engine, "procedure" leaves them to the
+    # ingest_advertisements database function, one call per batch
+    INGEST_STRATEGY = os.getenv("INGEST_STRATEGY", "memory")
+    # With the memory strategy, the writes of a batch are sent together through a psycopg pipeline
+    INGEST_PIPELINE = os.getenv("INGEST_PIPELINE", "true").lower() == "true"
+    if INGEST_STRATEGY == "procedure":
+        ingestor = ProcedureIngestor(db_pool, duplicate_cache)
+    else:
+        ingestor = Ingestor(
+            db_pool, beacon_registry, tag_state_engine, duplicate_cache, INGEST_PIPELINE, occupancy_tracker
+        )
 
-        # Ignore cross-yard transitions
-        if current_shipyard_id != previous_shipyard_id:
-            return
+    # "sync" processes the device_list inside the gateway request, "async" queues it and answers 202 right away,
+    # "sharded" also answers 202 and hands every tag to one of INGEST_SHARDS worker processes
+    INGEST_MODE = os.getenv("INGEST_MODE", "sync")
+    INGEST_RETRY_AFTER_SECONDS = int(os.getenv("INGEST_RETRY_AFTER_SECONDS", "5"))
+    INGEST_QUEUE_HIGH_WATER = int(os.getenv("INGEST_QUEUE_HIGH_WATER", "5000"))
+    INGEST_BATCH_SIZE = int(os.getenv("INGEST_BATCH_SIZE", "200"))
+    # Limit on the gateway request body, after gzip or deflate decompression
+    GATEWAY_MAX_BODY_BYTES = int(os.getenv("GATEWAY_MAX_BODY_BYTES", str(16 * 1024 * 1024)))
+
+    # Every decoded advertisement is archived in ARCHIVE_DIR, if set, for reprocessing with tools.replay_archive
+    ARCHIVE_DIR = os.getenv("ARCHIVE_DIR")
+    gateway_archive = ArchiveWriter(
+        ARCHIVE_DIR,
+        segment_records=int(os.getenv("ARCHIVE_SEGMENT_RECORDS", "1000000")),
+        flush_interval=float(os.getenv("ARCHIVE_FLUSH_SECONDS", "1"))
+    ) if ARCHIVE_DIR else None
+
+    ingest_queue = IngestQueue(
+        ingestor.process_advertisements,
+        high_water_mark=INGEST_QUEUE_HIGH_WATER,
+        workers=int(os.getenv("INGEST_WORKERS", "4")),
+        batch_size=INGEST_BATCH_SIZE
+    )
+    sharded_ingest = ShardedIngest(
+        db_url,
+        shards=int(os.getenv("INGEST_SHARDS", str(os.cpu_count() or 1))),
+        pool_size=int(os.getenv("INGEST_SHARD_POOL_SIZE", "2")),
+        high_water_mark=INGEST_QUEUE_HIGH_WATER,
+        batch_size=INGEST_BATCH_SIZE,
+        flush_interval=TAG_STATE_FLUSH_SECONDS,
+        engine_options=TAG_STATE_OPTIONS,
+        dedup_options=DEDUP_OPTIONS,
+        strategy=INGEST_STRATEGY,
+        pipeline=INGEST_PIPELINE
+    )
 
-        # Direction from beacon pair
-        if previous_is_first_when_entering and not current_is_first_when_entering:
-            is_direction_entering = True
-        elif (not previous_is_first_when_entering) and current_is_first_when_entering:
-            is_direction_entering = False
+    def start_ingest():
+        if gateway_archive is not None:
+            gateway_archive.start()
+            atexit.register(gateway_archive.stop)
+        # Also needed by the live tables, whatever the ingest mode
+        notification_listener.start()
+        atexit.register(notification_listener.stop)
+        # The ingest of the shard processes and of the ingest_advertisements function doesn't move the headcounts,
+        # the open logs are counted again at every sample instead
+        if INGEST_MODE == "sharded" or INGEST_STRATEGY == "procedure":
+            occupancy_tracker.start(reconcile_interval=occupancy_tracker.sample_interval)
         else:
-            return  # invalid pair (e.g., two firsts or two seconds)
-
-        # Resolve assigned crew member (if any)
-        curs.execute("""
-            SELECT id
-            FROM crew_member
-            WHERE tag_id = %s
-        """, (tag_id,))
-        crew_member = curs.fetchone()
-
-        if not crew_member:
-            # Unassigned tag → record and reset pairing (prevents overlapping pairs)
-            curs.execute("""
-                INSERT INTO unassigned_tag_entry (tag_id, shipyard_id, is_entering)
-                VALUES (%s, %s, %s)
-            """, (tag_id, current_shipyard_id, is_direction_entering))
-            curs.execute("UPDATE tag SET previous_echobeacon = NULL WHERE id = %s", (tag_id,))
+            occupancy_tracker.start()
+        atexit.register(occupancy_tracker.stop)
+        if INGEST_MODE == "sharded":
+            # Every shard process runs its own beacon registry and tag state engine
+            sharded_ingest.start()
+            atexit.register(sharded_ingest.stop)
             return
+        if INGEST_STRATEGY != "procedure":
+            beacon_registry.load()
+            tag_state_engine.load()
+            tag_state_engine.start(TAG_STATE_FLUSH_SECONDS)
+            # Registered after the tag state engine, so that its final flush runs after the queue has drained
+            atexit.register(tag_state_engine.stop)
+        if INGEST_MODE == "async":
+            ingest_queue.start()
+            atexit.register(ingest_queue.stop)
+
+    def read_gateway_advertisements():
+        """
+        Decode the gateway request into advertisements and their scan times: either the JSON message with its
+        device_list of hex payloads, or the binary frames when the Content-Type is FRAMES_CONTENT_TYPE. Both may be
+        gzip or deflate compressed. Returns (None, None) if the message is invalid.
+        """
+        body = decompress_body(
+            request.get_data(cache=False), request.headers.get("Content-Encoding"), GATEWAY_MAX_BODY_BYTES
+        )
 
-        crew_member_id = crew_member['id']
-
-        if is_direction_entering:
-            # Open new log, then reset pairing
-            curs.execute("""
-                INSERT INTO permanence_log (crew_member_id, shipyard_id, entry_timestamp)
-                VALUES (%s, %s, NOW())
-            """, (crew_member_id, current_shipyard_id))
-            curs.execute("UPDATE tag SET previous_echobeacon = NULL WHERE id = %s", (tag_id,))
-        else:
-            # Close most recent open log (or create exit-only), then reset pairing
-            curs.execute("""
-                UPDATE permanence_log
-                SET leave_timestamp = NOW()
-                WHERE id = (
-                    SELECT id FROM permanence_log
-                    WHERE crew_member_id = %s
-                    AND shipyard_id = %s
-                    AND leave_timestamp IS NULL
-                    ORDER BY entry_timestamp DESC
-                    LIMIT 1
-                )
-            """, (crew_member_id, current_shipyard_id))
-            if curs.rowcount == 0:
-                curs.execute("""
-                    INSERT INTO permanence_log (crew_member_id, shipyard_id, leave_timestamp)
-                    VALUES (%s, %s, NOW())
-                """, (crew_member_id, current_shipyard_id))
-            curs.execute("UPDATE tag SET previous_echobeacon = NULL WHERE id = %s", (tag_id,))
-
-
-    @app.route('/gateway-endpoint', methods=['POST'])
-    def gateway_endpoint():
+        if request.mimetype == FRAMES_CONTENT_TYPE:
+            scan_times = []
+            return decode_frames(body, scan_times) or None, scan_times
 
-        json_data = request.json
+        try:
+            json_data = json.loads(body)
+        except ValueError:
+            return None, None
+        if not isinstance(json_data, dict):
+            return None, None
 
         data = json_data.get("data")
         if not data:
-            return "Invalid gateway message", 400
+            return None, None
 
         value = data.get("value")
         if not value:
-            return "Invalid gateway message", 400
+            return None, None
         
         device_list = value.get("device_list")
         if not device_list:
+            return None, None
+
+        scan_times = [device.get("scan_time") if isinstance(device, dict) else None for device in device_list]
+        return decode_device_list(device_list), scan_times
+
+    @app.route('/gateway-endpoint', methods=['POST'])
+    def gateway_endpoint():
+        try:
+            advertisements, scan_times = read_gateway_advertisements()
+        except FramingError as e:
+            print(f"Error in gateway_endpoint: {e}")
+            advertisements = None
+        if not advertisements:
             return "Invalid gateway message", 400
 
-        for device in device_list:
-            process_device(device)
+        if gateway_archive is not None:
+            gateway_archive.append(advertisements, scan_times, request.remote_addr)
 
-        return "Processed", 200
+        if INGEST_MODE in ("async", "sharded"):
+            target = ingest_queue if INGEST_MODE == "async" else sharded_ingest
+            if not target.submit(advertisements):
+                return "Ingest queue full", 503, {"Retry-After": str(INGEST_RETRY_AFTER_SECONDS)}
+            return jsonify({"queued": len(advertisements)}), 202
+
+        counts = ingestor.process_advertisements(advertisements)
+
+        return jsonify(counts), 200
+
+    @app.route('/gateway-endpoint/stats')
+    @auth_required
+    def gateway_endpoint_stats():
+        if INGEST_MODE == "async":
+            stats = {**ingest_queue.stats(), "dedup": duplicate_cache.stats()}
+        elif INGEST_MODE == "sharded":
+            stats = sharded_ingest.stats()
+        else:
+            stats = {"dedup": duplicate_cache.stats()}
+        if gateway_archive is not None:
+            stats["archive"] = gateway_archive.stats()
+        stats["live"] = presence_feed.stats()
+        stats["table_counts"] = table_counts.stats()
+        stats["partitions"] = partition_maintainer.stats()
+        stats["typeahead"] = typeahead_index.stats()
+        stats["export_jobs"] = export_jobs.stats()
+        stats["attendance"] = attendance_rollup.stats()
+        stats["occupancy"] = occupancy_tracker.stats()
+        return jsonify({"mode": INGEST_MODE, **stats})
 
 if flask_env == "json":
-    import json
     
     @app.route('/gateway-endpoint', methods=['POST'])
     def gateway_endpoint():
@@ -1850,6 +2411,13 @@ if __name__ == "__main__":
                 except SystemExit:
                     db_pool.close(timeout=0)
         case "production":
-            serve(app, port=flask_port, host="0.0.0.0")
+            typeahead_index.load()
+            partition_maintainer.start()
+            atexit.register(partition_maintainer.stop)
+            attendance_rollup.start()
+            atexit.register(attendance_rollup.stop)
+            start_ingest()
+            # Every live table keeps a thread busy, on top of the ones serving the other requests
+            serve(app, port=flask_port, host="0.0.0.0", threads=int(os.getenv("WAITRESS_THREADS", "4")) + LIVE_MAX_CLIENTS)
         case _:
             raise Exception(f"{flask_env} must be either \"development\" or \"production\"")
\ No newline at end of file
@@ -0,0 +1,68 @@
+"""Gateway payload decoder micro-benchmark
+Purpose: compares decode_device_list against the hex slicing that process_device used before it, on a synthetic
+device_list of gateway payloads, and checks that both decode the same fields.
+
+Usage: python -m tools.bench_decoder [devices] [repetitions]
+"""
+
+import random
+import sys
+import timeit
+
+from gatekeeper.decoder import decode_device_list
+
+
+def slicing_decode_device_list(device_list):
+    """The field by field slicing of the hex string that process_device used to do."""
+    decoded = []
+    for device in device_list:
+        device_data = device.get("data")
+        if not device_data:
+            decoded.append(None)
+            continue
+        device_data = device_data[16:]  # skip gateway header
+        if len(device_data) < 28:
+            decoded.append(None)
+            continue
+        decoded.append((
+            int(device_data[0:4], 16),
+            int(device_data[4:6], 16),
+            int(device_data[6:8], 16),
+            device_data[8:20],
+            int(device_data[20:22], 16) - 256,
+            bool(int(device_data[22:24], 16) & 0x04),
+            int(device_data[24:28], 16)
+        ))
+    return decoded
+
+
+def synthetic_device_list(size):
+    rng = random.Random(42)
+    return [
+        {
+            "data": "0201061AFF4C0001"
+                    f"{rng.randint(1, 40):04X}03{rng.randint(0, 255):02X}"
+                    f"{rng.randint(0, 0xFFFFFFFFFFFF):012X}{rng.randint(0xA0, 0xD0):02X}04{rng.randint(2000, 3600):04X}",
+            "scan_time": 1700000000 + i
+        }
+        for i in range(size)
+    ]
+
+
+def main(argv):
+    size = int(argv[0]) if len(argv) > 0 else 500
+    repetitions = int(argv[1]) if len(argv) > 1 else 200
+    device_list = synthetic_device_list(size)
+
+    if [tuple(a) for a in decode_device_list(device_list)] != slicing_decode_device_list(device_list):
+        raise Exception("decode_device_list and the slicing decoder disagree")
+
+    print(f"{size} devices x {repetitions} repetitions")
+    for name, fn in (("slicing", slicing_decode_device_list), ("decode_device_list", decode_device_list)):
+        seconds = min(timeit.repeat(lambda: fn(device_list), number=repetitions, repeat=3))
+        per_device = seconds / (size * repetitions) * 1e9
+        print(f"{name.ljust(18)} {per_device:8.1f} ns/device")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
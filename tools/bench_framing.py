@@ -0,0 +1,61 @@
+"""Gateway wire format benchmark
+Purpose: compares the JSON gateway message with hex payloads against the binary frames, plain and gzip compressed,
+on a synthetic device_list: size on the wire and CPU spent turning the body into advertisements. Also checks that
+both formats decode to the same advertisements.
+
+Usage: python -m tools.bench_framing [devices] [repetitions]
+"""
+
+import gzip
+import json
+import sys
+import timeit
+
+from gatekeeper.decoder import decode_device_list, GATEWAY_HEADER_SIZE
+from gatekeeper.framing import decompress_body, decode_frames, encode_frames
+from tools.bench_decoder import synthetic_device_list
+
+MAX_BODY_BYTES = 64 * 1024 * 1024
+
+
+def json_body(device_list):
+    return json.dumps({"data": {"value": {"device_list": device_list}}}).encode()
+
+
+def frames_body(device_list):
+    return encode_frames(
+        (device["scan_time"], bytes.fromhex(device["data"])[GATEWAY_HEADER_SIZE:]) for device in device_list
+    )
+
+
+def parse_json(body, encoding):
+    return decode_device_list(json.loads(decompress_body(body, encoding, MAX_BODY_BYTES))["data"]["value"]["device_list"])
+
+
+def parse_frames(body, encoding):
+    return decode_frames(decompress_body(body, encoding, MAX_BODY_BYTES))
+
+
+def main(argv):
+    size = int(argv[0]) if len(argv) > 0 else 500
+    repetitions = int(argv[1]) if len(argv) > 1 else 200
+    device_list = synthetic_device_list(size)
+
+    cases = []
+    for name, build, parse in (("json", json_body, parse_json), ("frames", frames_body, parse_frames)):
+        body = build(device_list)
+        cases.append((name, body, None, parse))
+        cases.append((f"{name}+gzip", gzip.compress(body), "gzip", parse))
+
+    if parse_json(cases[0][1], None) != parse_frames(cases[2][1], None):
+        raise Exception("JSON and frames decode to different advertisements")
+
+    print(f"{size} devices x {repetitions} repetitions")
+    for name, body, encoding, parse in cases:
+        seconds = min(timeit.repeat(lambda: parse(body, encoding), number=repetitions, repeat=3))
+        per_device = seconds / (size * repetitions) * 1e9
+        print(f"{name.ljust(12)} {len(body) / size:7.1f} bytes/device {per_device:8.1f} ns/device")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,263 @@
+"""Log time window benchmark
+Purpose: measures the time filter of the logs on a permanence_log of millions of rows, comparing the overlap
+condition on permanence_period, served by idx_permanence_log_period, with the two BETWEEN conditions it replaced.
+Both are run as the log table runs them: the count of the matching rows and the first page, ordered by crew member
+name, for windows of an hour, a day (the default filter) and a week at random points of the logged period. For every
+window length it also checks that the overlap condition finds every log the old one found; the ones it finds on top
+are the logs spanning the whole window.
+
+Usage:
+    python -m tools.bench_log_window --setup [--rows N] [--days N] [--open P] [--exit-only P]
+    python -m tools.bench_log_window [--samples N]
+    python -m tools.bench_log_window --cleanup
+DATABASE_URL has to point to a scratch database with the loadgen dataset (python -m tools.loadgen --setup) and the
+migrations applied. --setup creates the month partitions of the period and adds the synthetic logs to the loadgen
+crew members and shipyards, with the triggers disabled (session_replication_role, so the user has to be a
+superuser) so that millions of rows don't go through the live tables notifications; --cleanup deletes every log of
+the loadgen shipyards.
+"""
+
+import argparse
+import random
+import statistics
+import sys
+import time
+from datetime import timedelta
+
+import psycopg
+
+from tools.loadgen import get_env, percentile, NAME_PREFIX
+
+# Rows inserted per statement by --setup
+CHUNK_ROWS = 500000
+
+PAGE_SIZE = 50
+
+FROM_WHERE = """
+    FROM permanence_log pl
+    JOIN crew_member cm ON pl.crew_member_id = cm.id
+    JOIN shipyard s ON pl.shipyard_id = s.id
+    LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+    LEFT JOIN ship ship ON cm.ship_id = ship.id
+    LEFT JOIN tag current_tag ON cm.tag_id = current_tag.id
+    WHERE 1=1
+"""
+
+SELECT_FIELDS = """
+    pl.id,
+    s.name as shipyard_name,
+    current_tag.mac_address as current_tag_name,
+    current_tag.remaining_battery as current_battery_level,
+    ship.name as ship_name,
+    cm.name as crew_member_name,
+    cr.role_name,
+    pl.entry_timestamp,
+    pl.leave_timestamp
+"""
+
+# The time filter before idx_permanence_log_period, with its parameters from (start, end)
+OLD_CONDITION = """
+    AND (
+        (pl.entry_timestamp >= %(start)s AND pl.entry_timestamp <= %(end)s)
+        OR (pl.leave_timestamp >= %(start)s AND pl.leave_timestamp <= %(end)s)
+    )
+"""
+
+NEW_CONDITION = """
+    AND permanence_period(pl.entry_timestamp, pl.leave_timestamp) && tsrange(%(start)s, %(end)s, '[]')
+    AND LEAST(pl.entry_timestamp, pl.leave_timestamp) <= %(end)s
+"""
+
+WINDOWS = (("hour", timedelta(hours=1)), ("day", timedelta(days=1)), ("week", timedelta(days=7)))
+
+
+# ===== DATASET =====
+
+def loadgen_ids(conn):
+    crew_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM crew_member WHERE name LIKE %s ORDER BY id", (f"{NAME_PREFIX} %",)
+    ).fetchall()]
+    shipyard_ids = [row[0] for row in conn.execute(
+        "SELECT id FROM shipyard WHERE name LIKE %s ORDER BY id", (f"{NAME_PREFIX} %",)
+    ).fetchall()]
+    return crew_ids, shipyard_ids
+
+
+def setup(conn, args):
+    crew_ids, shipyard_ids = loadgen_ids(conn)
+    if not crew_ids or not shipyard_ids:
+        raise Exception("No loadgen dataset, run python -m tools.loadgen --setup first")
+
+    started = time.perf_counter()
+    # Every month of the period gets its partition first, the backend only creates the coming ones
+    conn.execute("""
+        SELECT create_event_partition('permanence_log', month::date)
+        FROM generate_series(
+            date_trunc('month', LOCALTIMESTAMP - %s * interval '1 day'), date_trunc('month', LOCALTIMESTAMP),
+            interval '1 month'
+        ) month
+    """, (args.days,))
+    inserted = 0
+    while inserted < args.rows:
+        rows = min(CHUNK_ROWS, args.rows - inserted)
+        with conn.transaction():
+            conn.execute("SET LOCAL session_replication_role = replica")
+            # Closed logs of 1 to 12 hours anywhere in the period, a few exit-only ones, and open ones that started
+            # in the last 12 hours (crew members still inside)
+            conn.execute("""
+                INSERT INTO permanence_log (crew_member_id, shipyard_id, entry_timestamp, leave_timestamp)
+                SELECT
+                    (%(crew_ids)s::int[])[1 + floor(random() * %(crew_count)s)::int],
+                    (%(shipyard_ids)s::int[])[1 + floor(random() * %(shipyard_count)s)::int],
+                    CASE WHEN r < %(exit_only)s THEN NULL ELSE entered END,
+                    CASE WHEN r < %(exit_only)s THEN entered + duration
+                         WHEN r < %(exit_only)s + %(open)s THEN NULL
+                         ELSE entered + duration END
+                FROM (
+                    SELECT
+                        r,
+                        CASE WHEN r >= %(exit_only)s AND r < %(exit_only)s + %(open)s
+                             THEN LOCALTIMESTAMP - random() * interval '12 hours'
+                             ELSE LOCALTIMESTAMP - random() * %(days)s * interval '1 day' END AS entered,
+                        interval '1 hour' + random() * interval '11 hours' AS duration
+                    FROM (SELECT random() AS r FROM generate_series(1, %(rows)s)) numbers
+                ) logs
+            """, {
+                "crew_ids": crew_ids,
+                "crew_count": len(crew_ids),
+                "shipyard_ids": shipyard_ids,
+                "shipyard_count": len(shipyard_ids),
+                "exit_only": args.exit_only,
+                "open": args.open,
+                "days": args.days,
+                "rows": rows
+            })
+        inserted += rows
+        print(f"{inserted} logs inserted")
+    conn.execute("ANALYZE permanence_log")
+    total = conn.execute("SELECT COUNT(*) FROM permanence_log").fetchone()[0]
+    print(f"{inserted} logs inserted in {time.perf_counter() - started:.1f} s, {total} in permanence_log")
+
+
+def cleanup(conn):
+    _, shipyard_ids = loadgen_ids(conn)
+    with conn.transaction():
+        conn.execute("SET LOCAL session_replication_role = replica")
+        deleted = conn.execute("DELETE FROM permanence_log WHERE shipyard_id = ANY(%s)", (shipyard_ids,)).rowcount
+    conn.execute("ANALYZE permanence_log")
+    print(f"{deleted} logs deleted")
+
+
+# ===== QUERIES =====
+
+def timed(conn, query, params):
+    started = time.perf_counter()
+    rows = conn.execute(query, params).fetchall()
+    return time.perf_counter() - started, rows
+
+
+def run_window(conn, condition, window):
+    """Count and first page of a window, as the log table asks for them"""
+    count_time, count = timed(conn, f"SELECT COUNT(*) {FROM_WHERE} {condition}", window)
+    page_time, _ = timed(
+        conn,
+        f"SELECT {SELECT_FIELDS} {FROM_WHERE} {condition} ORDER BY cm.name ASC NULLS LAST, pl.id ASC LIMIT %(limit)s",
+        {**window, "limit": PAGE_SIZE + 1}
+    )
+    return count_time + page_time, count[0][0]
+
+
+def uses_index(conn, window):
+    plan = conn.execute(f"EXPLAIN (FORMAT JSON) SELECT COUNT(*) {FROM_WHERE} {NEW_CONDITION}", window).fetchone()[0]
+
+    def index_names(node):
+        names = {node["Index Name"]} if "Index Name" in node else set()
+        for child in node.get("Plans", []):
+            names |= index_names(child)
+        return names
+
+    # Every partition has its own copy of the index
+    period_indexes = {row[0] for row in conn.execute("""
+        SELECT 'idx_permanence_log_period'
+        UNION ALL
+        SELECT inhrelid::regclass::text FROM pg_inherits WHERE inhparent = 'idx_permanence_log_period'::regclass
+    """).fetchall()}
+    return bool(period_indexes & index_names(plan[0]["Plan"]))
+
+
+def missed_rows(conn, window):
+    """Logs the old condition finds and the overlap condition doesn't, has to be 0"""
+    return conn.execute(f"""
+        SELECT COUNT(*) FROM permanence_log pl
+        WHERE 1=1 {OLD_CONDITION}
+        AND NOT (permanence_period(pl.entry_timestamp, pl.leave_timestamp) && tsrange(%(start)s, %(end)s, '[]'))
+    """, window).fetchone()[0]
+
+
+def run(conn, args):
+    first, last = conn.execute("""
+        SELECT MIN(COALESCE(entry_timestamp, leave_timestamp)), MAX(COALESCE(leave_timestamp, entry_timestamp))
+        FROM permanence_log
+    """).fetchone()
+    if first is None:
+        raise Exception("permanence_log is empty, run python -m tools.bench_log_window --setup first")
+    total = conn.execute("SELECT COUNT(*) FROM permanence_log").fetchone()[0]
+    print(f"{total} logs from {first:%Y-%m-%d} to {last:%Y-%m-%d}, {args.samples} windows of every length")
+
+    rng = random.Random(args.seed)
+    failed = False
+    for name, length in WINDOWS:
+        windows = []
+        for _ in range(args.samples):
+            start = first + (last - length - first) * rng.random()
+            windows.append({"start": start, "end": start + length})
+
+        # Warm the cache once, so that both conditions are timed on the same pages in memory
+        run_window(conn, NEW_CONDITION, windows[0])
+        results = {}
+        for label, condition in (("between", OLD_CONDITION), ("overlap", NEW_CONDITION)):
+            times = []
+            counts = []
+            for window in windows:
+                elapsed, count = run_window(conn, condition, window)
+                times.append(elapsed)
+                counts.append(count)
+            results[label] = counts
+            print(
+                f"{name:<5} {label:<8} median {statistics.median(times) * 1000:9.1f} ms"
+                f"   p95 {percentile(times, 95) * 1000:9.1f} ms   rows {statistics.mean(counts):10.1f}"
+            )
+
+        missed = missed_rows(conn, windows[0])
+        spanning = statistics.mean(new - old for old, new in zip(results["between"], results["overlap"]))
+        index = "used" if uses_index(conn, windows[0]) else "NOT used"
+        print(f"{name:<5} index {index}, {spanning:.1f} spanning logs found on top, {missed} missed")
+        if missed or any(new < old for old, new in zip(results["between"], results["overlap"])):
+            failed = True
+    return 1 if failed else 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Log time window benchmark")
+    parser.add_argument("--setup", action="store_true", help="add the synthetic logs")
+    parser.add_argument("--cleanup", action="store_true", help="delete the logs of the loadgen shipyards")
+    parser.add_argument("--rows", type=int, default=2000000)
+    parser.add_argument("--days", type=float, default=730, help="period the closed logs are spread over")
+    parser.add_argument("--open", type=float, default=0.001, help="fraction of logs without an exit")
+    parser.add_argument("--exit-only", type=float, default=0.01, help="fraction of logs without an entry")
+    parser.add_argument("--samples", type=int, default=20, help="windows timed for every length")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(get_env("DATABASE_URL"), autocommit=True) as conn:
+        if args.setup:
+            setup(conn, args)
+            return 0
+        if args.cleanup:
+            cleanup(conn)
+            return 0
+        return run(conn, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
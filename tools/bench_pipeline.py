@@ -0,0 +1,236 @@
+"""Ingest round trip benchmark
+Purpose: measures what the database round trips cost the ingest path when the database is not on the same machine.
+The same batches of advertisements are applied by the in-memory Ingestor writing one statement at a time, by the
+in-memory Ingestor with pipelined writes and by the ProcedureIngestor, through a local TCP proxy that holds every
+message for a fixed delay in each direction, and the time spent on every batch is compared.
+Every tag walks its shipyard beacon pair as first, second, second, first, so that half of the advertisements open or
+close a log or an unassigned tag entry.
+
+Usage: python -m tools.bench_pipeline [--delay-ms MS] [--batches N] [--batch N]
+DATABASE_URL has to point to a scratch database with the loadgen dataset (python -m tools.loadgen --setup). The
+packet counters and previous beacons of the synthetic tags are reset before every strategy, and the logs and
+unassigned tag entries of the synthetic shipyards are deleted.
+"""
+
+import argparse
+import heapq
+import itertools
+import socket
+import statistics
+import sys
+import threading
+import time
+
+import psycopg
+from psycopg.conninfo import conninfo_to_dict, make_conninfo
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+from gatekeeper.beacons import BeaconRegistry
+from gatekeeper.decoder import Advertisement, PRESENCE_PACKET
+from gatekeeper.ingest import Ingestor, ProcedureIngestor
+from gatekeeper.tag_state import TagStateEngine
+from tools.loadgen import get_env, load_dataset, percentile, MAC_PREFIX
+
+# Beacons of the shipyard pair heard by a tag, in order: enter, nothing (pairing reset), leave
+WALK = ("first", "second", "second", "first")
+
+
+# ===== PROXY =====
+
+class DelayProxy:
+    """Forwards TCP connections to the database, delivering every chunk delay seconds after it was received."""
+
+    def __init__(self, upstream, delay):
+        self.upstream = upstream
+        self.delay = delay
+        self.listener = socket.create_server(("127.0.0.1", 0))
+        self.port = self.listener.getsockname()[1]
+
+    def start(self):
+        threading.Thread(target=self.accept, name="delay-proxy", daemon=True).start()
+
+    def accept(self):
+        while True:
+            client, _ = self.listener.accept()
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            family, address = self.upstream
+            server = socket.socket(family, socket.SOCK_STREAM)
+            server.connect(address)
+            if family == socket.AF_INET:
+                server.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.forward(client, server)
+            self.forward(server, client)
+
+    def forward(self, source, destination):
+        # One thread receives and timestamps, the other sends when the time has come, so that back to back chunks
+        # are delayed once each and not once more for every chunk queued before them
+        chunks = []
+        ready = threading.Condition()
+        sequence = itertools.count()
+
+        def receive():
+            while True:
+                try:
+                    chunk = source.recv(65536)
+                except OSError:
+                    chunk = b""
+                with ready:
+                    heapq.heappush(chunks, (time.monotonic() + self.delay, next(sequence), chunk))
+                    ready.notify()
+                if not chunk:
+                    return
+
+        def send():
+            while True:
+                with ready:
+                    while not chunks:
+                        ready.wait()
+                    due, _, chunk = chunks[0]
+                    wait = due - time.monotonic()
+                    if wait > 0:
+                        ready.wait(wait)
+                        continue
+                    heapq.heappop(chunks)
+                try:
+                    if not chunk:
+                        destination.shutdown(socket.SHUT_WR)
+                        return
+                    destination.sendall(chunk)
+                except OSError:
+                    return
+
+        threading.Thread(target=receive, daemon=True).start()
+        threading.Thread(target=send, daemon=True).start()
+
+
+def upstream_address(conninfo):
+    params = conninfo_to_dict(conninfo)
+    host = params.get("host") or "localhost"
+    port = int(params.get("port") or 5432)
+    if host.startswith("/"):
+        return socket.AF_UNIX, f"{host}/.s.PGSQL.{port}"
+    return socket.AF_INET, (socket.gethostbyname(host), port)
+
+
+def proxied_conninfo(conninfo, proxy):
+    params = conninfo_to_dict(conninfo)
+    params.pop("hostaddr", None)
+    params.update(host="127.0.0.1", port=str(proxy.port))
+    return make_conninfo(**params)
+
+
+# ===== BATCHES =====
+
+def build_batches(pairs, tags, batches, batch_size):
+    """Every batch holds batch_size tags, each one hearing its next beacon of WALK"""
+    shipyard_ids = sorted(pairs)
+    steps = {}
+    counters = {}
+    advertisements = []
+    for i in range(batches * batch_size):
+        mac_address = tags[i % len(tags)][0]
+        pair = pairs[shipyard_ids[i % len(tags) % len(shipyard_ids)]]
+        step = steps.get(mac_address, 0)
+        steps[mac_address] = step + 1
+        counters[mac_address] = (counters.get(mac_address, 0) + 1) % 256
+        advertisements.append(Advertisement(
+            pair[WALK[step % len(WALK)]], PRESENCE_PACKET, counters[mac_address], mac_address, -60, True, 3000
+        ))
+    return [advertisements[i:i + batch_size] for i in range(0, len(advertisements), batch_size)]
+
+
+def reset_state(conn, shipyard_ids):
+    with conn.transaction():
+        conn.execute("""
+            UPDATE tag SET packet_counter = NULL, previous_echobeacon = NULL
+            WHERE mac_address LIKE %s
+        """, (f"{MAC_PREFIX}%",))
+        conn.execute("DELETE FROM permanence_log WHERE shipyard_id = ANY(%s)", (shipyard_ids,))
+        conn.execute("DELETE FROM unassigned_tag_entry WHERE shipyard_id = ANY(%s)", (shipyard_ids,))
+
+
+def written_rows(conn, shipyard_ids):
+    return conn.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM permanence_log WHERE shipyard_id = ANY(%(ids)s)),
+            (SELECT COUNT(*) FROM unassigned_tag_entry WHERE shipyard_id = ANY(%(ids)s))
+    """, {"ids": shipyard_ids}).fetchone()
+
+
+# ===== RUNS =====
+
+def run(name, pool, batches, strategy):
+    tag_state_engine = None
+    if strategy == "procedure":
+        ingestor = ProcedureIngestor(pool)
+    else:
+        beacon_registry = BeaconRegistry(pool)
+        beacon_registry.load()
+        tag_state_engine = TagStateEngine(pool, beacon_registry)
+        tag_state_engine.load()
+        ingestor = Ingestor(pool, beacon_registry, tag_state_engine, pipeline=strategy == "pipeline")
+
+    latencies = []
+    for batch in batches:
+        started = time.perf_counter()
+        ingestor.process_advertisements(batch)
+        latencies.append(time.perf_counter() - started)
+    if tag_state_engine is not None:
+        tag_state_engine.flush(force=True)
+
+    advertisements = sum(len(batch) for batch in batches)
+    total = sum(latencies)
+    print(
+        f"{name:<12} {advertisements / total:10.1f} ads/s   batch mean {statistics.mean(latencies) * 1000:8.1f} ms"
+        f"   p50 {percentile(latencies, 50) * 1000:8.1f} ms   p95 {percentile(latencies, 95) * 1000:8.1f} ms"
+    )
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Compare the ingest strategies over a delayed database connection")
+    parser.add_argument("--delay-ms", type=float, default=2.0, help="delay added in each direction")
+    parser.add_argument("--batches", type=int, default=20)
+    parser.add_argument("--batch", type=int, default=200, help="advertisements per batch")
+    args = parser.parse_args(argv)
+
+    conninfo = get_env("DATABASE_URL")
+    with psycopg.connect(conninfo, autocommit=True) as conn:
+        pairs, tags = load_dataset(conn)
+    if not pairs or not tags:
+        raise Exception("No loadgen dataset, run python -m tools.loadgen --setup first")
+    shipyard_ids = sorted(pairs)
+    batches = build_batches(pairs, tags, args.batches, args.batch)
+
+    proxy = DelayProxy(upstream_address(conninfo), args.delay_ms / 1000)
+    proxy.start()
+    pool = ConnectionPool(
+        conninfo=proxied_conninfo(conninfo, proxy),
+        min_size=1,
+        max_size=1,
+        timeout=30.0,
+        configure=lambda conn: setattr(conn, 'row_factory', dict_row)
+    )
+    pool.wait()
+
+    print(f"{len(batches)} batches of {args.batch} advertisements, {args.delay_ms} ms added in each direction")
+    expected = None
+    for name, strategy in (("sequential", "memory"), ("pipeline", "pipeline"), ("procedure", "procedure")):
+        with psycopg.connect(conninfo, autocommit=True) as conn:
+            reset_state(conn, shipyard_ids)
+        run(name, pool, batches, strategy)
+        with psycopg.connect(conninfo, autocommit=True) as conn:
+            rows = written_rows(conn, shipyard_ids)
+        # All of them have to write the same rows for the comparison to mean anything
+        if expected is None:
+            expected = rows
+        elif rows != expected:
+            print(f"{name} wrote {rows[0]} logs and {rows[1]} entries, sequential {expected[0]} and {expected[1]}")
+            return 1
+    pool.close()
+    print(f"every strategy wrote {expected[0]} logs and {expected[1]} unassigned tag entries")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,284 @@
+"""Ingest strategies parity check
+Purpose: drives the in-memory Ingestor, with and without pipelined writes, and the ProcedureIngestor
+(ingest_advertisements database function) with the same advertisement sequences, and checks that all of them return the
+same outcome for every advertisement and leave the same tags, permanence logs and unassigned tag entries behind. The
+sequences are the scenarios of the API section of TESTS.md, plus random sequences with duplicates, unknown tags and
+beacons, cross-yard noise and invalid packets.
+
+Usage: python -m tools.check_ingest_parity [--random N] [--length N] [--seed N]
+DATABASE_URL has to point to a scratch database with the schema and the migrations applied. The check creates its
+own shipyards ("Parity ..."), beacons (friendly numbers from 8000) and tags (MAC addresses starting with BEEF), and
+resets them before every run.
+"""
+
+import argparse
+import os
+import random
+import sys
+
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+from gatekeeper.beacons import BeaconRegistry
+from gatekeeper.decoder import Advertisement, PRESENCE_PACKET
+from gatekeeper.ingest import Ingestor, ProcedureIngestor, BATTERY_MAX_MILLIVOLTS
+from gatekeeper.tag_state import TagStateEngine
+
+NAME_PREFIX = "Parity"
+MAC_PREFIX = "BEEF"
+# Yard 1 beacons: 8000 first, 8001 second. Yard 2 beacons: 8002 first, 8003 second. 8009 doesn't exist
+BEACONS = ((8000, 1, True), (8001, 1, False), (8002, 2, True), (8003, 2, False))
+UNKNOWN_BEACON = 8009
+# Tags 0 and 1 are assigned to a crew member, tag 2 isn't, tag 9 isn't registered
+ASSIGNED_TAGS = (0, 1)
+TAGS = (0, 1, 2)
+UNKNOWN_TAG = 9
+
+
+def get_env(env_var: str):
+    ret = os.getenv(env_var)
+    if not ret:
+        raise Exception(f"{env_var} not found")
+    return ret
+
+
+def mac(tag):
+    return f"{MAC_PREFIX}{tag:08X}"
+
+
+def advertisement(tag, beacon, counter, voltage=3000, packet_type=PRESENCE_PACKET, tlm=True):
+    return Advertisement(beacon, packet_type, counter, mac(tag), -60, tlm, voltage)
+
+
+# ===== FIXTURE =====
+
+def reset_fixture(pool):
+    with pool.connection() as conn:
+        conn.execute("""
+            DELETE FROM crew_member WHERE tag_id IN (SELECT id FROM tag WHERE mac_address LIKE %s)
+        """, (f"{MAC_PREFIX}%",))
+        conn.execute("DELETE FROM tag WHERE mac_address LIKE %s", (f"{MAC_PREFIX}%",))
+        conn.execute("DELETE FROM activator_beacon WHERE friendly_number BETWEEN 8000 AND 8099")
+        conn.execute("DELETE FROM shipyard WHERE name LIKE %s", (f"{NAME_PREFIX} %",))
+        conn.execute("DELETE FROM ship WHERE name = %s", (f"{NAME_PREFIX} ship",))
+
+        shipyard_ids = {
+            yard: conn.execute(
+                "INSERT INTO shipyard (name) VALUES (%s) RETURNING id", (f"{NAME_PREFIX} {yard}",)
+            ).fetchone()['id']
+            for yard in (1, 2)
+        }
+        for friendly_number, yard, is_first_when_entering in BEACONS:
+            conn.execute("""
+                INSERT INTO activator_beacon (friendly_number, shipyard_id, is_first_when_entering)
+                VALUES (%s, %s, %s)
+            """, (friendly_number, shipyard_ids[yard], is_first_when_entering))
+        ship_id = conn.execute(
+            "INSERT INTO ship (name) VALUES (%s) RETURNING id", (f"{NAME_PREFIX} ship",)
+        ).fetchone()['id']
+        for tag in TAGS:
+            tag_id = conn.execute(
+                "INSERT INTO tag (mac_address, remaining_battery) VALUES (%s, 100) RETURNING id", (mac(tag),)
+            ).fetchone()['id']
+            if tag in ASSIGNED_TAGS:
+                conn.execute(
+                    "INSERT INTO crew_member (name, ship_id, tag_id) VALUES (%s, %s, %s)",
+                    (f"{NAME_PREFIX} {tag}", ship_id, tag_id)
+                )
+
+
+def snapshot(pool):
+    """The fixture rows, without ids and timestamps, which differ between two runs"""
+    with pool.connection() as conn:
+        tags = conn.execute("""
+            SELECT t.mac_address, t.remaining_battery, t.packet_counter, ab.friendly_number AS previous_echobeacon
+            FROM tag t
+            LEFT JOIN activator_beacon ab ON ab.id = t.previous_echobeacon
+            WHERE t.mac_address LIKE %s
+            ORDER BY t.mac_address
+        """, (f"{MAC_PREFIX}%",)).fetchall()
+        logs = conn.execute("""
+            SELECT cm.name, s.name AS shipyard, pl.entry_timestamp IS NOT NULL AS entered,
+                pl.leave_timestamp IS NOT NULL AS left
+            FROM permanence_log pl
+            JOIN crew_member cm ON cm.id = pl.crew_member_id
+            JOIN shipyard s ON s.id = pl.shipyard_id
+            WHERE s.name LIKE %s
+            -- Not by id: the logs opened in the same transaction have the same entry timestamp, and which of them
+            -- an exit closes is up to the order the rows are found in
+            ORDER BY cm.name, s.name, entered, "left"
+        """, (f"{NAME_PREFIX} %",)).fetchall()
+        entries = conn.execute("""
+            SELECT t.mac_address, s.name AS shipyard, ute.is_entering
+            FROM unassigned_tag_entry ute
+            JOIN tag t ON t.id = ute.tag_id
+            JOIN shipyard s ON s.id = ute.shipyard_id
+            WHERE s.name LIKE %s
+            ORDER BY ute.id
+        """, (f"{NAME_PREFIX} %",)).fetchall()
+    return {"tags": tags, "logs": logs, "entries": entries}
+
+
+# ===== RUNS =====
+
+def run_memory(pool, sequence, batch_size, pipeline=False):
+    beacon_registry = BeaconRegistry(pool)
+    beacon_registry.load()
+    tag_state_engine = TagStateEngine(pool, beacon_registry)
+    tag_state_engine.load()
+    ingestor = Ingestor(pool, beacon_registry, tag_state_engine, pipeline=pipeline)
+    return run(ingestor, sequence, batch_size, tag_state_engine)
+
+
+def run_pipeline(pool, sequence, batch_size):
+    return run_memory(pool, sequence, batch_size, pipeline=True)
+
+
+def run_procedure(pool, sequence, batch_size):
+    return run(ProcedureIngestor(pool), sequence, batch_size)
+
+
+def run(ingestor, sequence, batch_size, tag_state_engine=None):
+    outcomes = []
+    for start in range(0, len(sequence), batch_size):
+        counts = ingestor.process_advertisements(sequence[start:start + batch_size])
+        outcomes.append({outcome: count for outcome, count in counts.items() if count})
+    if tag_state_engine is not None:
+        tag_state_engine.flush(force=True)
+    return outcomes
+
+
+def check(pool, name, sequence, batch_size=1):
+    reset_fixture(pool)
+    memory_outcomes = run_memory(pool, sequence, batch_size)
+    memory_state = snapshot(pool)
+
+    # Every other strategy is compared with the sequential in-memory one
+    differences = []
+    for strategy, run_strategy in (("pipeline", run_pipeline), ("procedure", run_procedure)):
+        reset_fixture(pool)
+        outcomes = run_strategy(pool, sequence, batch_size)
+        state = snapshot(pool)
+        for step, (memory, other) in enumerate(zip(memory_outcomes, outcomes)):
+            if memory != other:
+                differences.append(f"batch {step}: memory {memory}, {strategy} {other}")
+        for table in ("tags", "logs", "entries"):
+            if memory_state[table] != state[table]:
+                differences.append(f"{table}: memory {memory_state[table]}, {strategy} {state[table]}")
+
+    print(f"{'ok  ' if not differences else 'FAIL'} {name}")
+    for difference in differences:
+        print(f"     {difference}")
+    return not differences
+
+
+# ===== SEQUENCES =====
+
+def scenarios():
+    """The API scenarios of TESTS.md, as (name, sequence)"""
+    return [
+        ("first then second beacon of a shipyard enters", [
+            advertisement(0, 8000, 1), advertisement(0, 8000, 2), advertisement(0, 8001, 3)
+        ]),
+        ("second then first beacon of a shipyard exits", [
+            advertisement(0, 8000, 1), advertisement(0, 8000, 2), advertisement(0, 8001, 3),
+            advertisement(0, 8001, 4), advertisement(0, 8000, 5)
+        ]),
+        ("beacons of two shipyards are ignored", [
+            advertisement(0, 8000, 1), advertisement(0, 8000, 2), advertisement(0, 8003, 3)
+        ]),
+        ("same beacon twice is ignored", [
+            advertisement(0, 8000, 1), advertisement(0, 8000, 2), advertisement(0, 8000, 3)
+        ]),
+        ("unknown beacons are ignored", [
+            advertisement(0, 8000, 1), advertisement(0, UNKNOWN_BEACON, 2), advertisement(0, 8001, 3),
+            advertisement(0, 8000, 4), advertisement(0, UNKNOWN_BEACON, 5)
+        ]),
+        ("unknown tags are ignored", [
+            advertisement(UNKNOWN_TAG, 8000, 1), advertisement(UNKNOWN_TAG, 8001, 2)
+        ]),
+        ("every advertisement updates the battery", [
+            advertisement(0, 8000, 1, voltage=3500), advertisement(0, 8000, 1, voltage=3000),
+            advertisement(0, UNKNOWN_BEACON, 2, voltage=2500)
+        ]),
+        ("same packet counter is a duplicate", [
+            advertisement(0, 8000, 1), advertisement(0, 8000, 2), advertisement(0, 8001, 2), advertisement(0, 8001, 3)
+        ]),
+        ("enter then exit opens and closes a log", [
+            advertisement(1, 8000, 10), advertisement(1, 8000, 11), advertisement(1, 8001, 12),
+            advertisement(1, 8001, 13), advertisement(1, 8000, 14)
+        ]),
+        ("two entries then an exit close the most recent log", [
+            advertisement(1, 8000, 1), advertisement(1, 8000, 2), advertisement(1, 8001, 3),
+            advertisement(1, 8000, 4), advertisement(1, 8001, 5),
+            advertisement(1, 8001, 6), advertisement(1, 8000, 7),
+            advertisement(1, 8001, 8), advertisement(1, 8000, 9)
+        ]),
+        ("exit without an open log creates an exit-only log", [
+            advertisement(0, 8001, 1), advertisement(0, 8001, 2), advertisement(0, 8000, 3)
+        ]),
+        ("unassigned tags create entries", [
+            advertisement(2, 8000, 1), advertisement(2, 8000, 2), advertisement(2, 8001, 3),
+            advertisement(2, 8001, 4), advertisement(2, 8000, 5)
+        ]),
+        ("invalid packets are ignored", [
+            advertisement(0, 8000, 1, packet_type=0x02), advertisement(0, 8000, 2, tlm=False),
+            advertisement(0, 8000, 3, voltage=3700), None, advertisement(0, 8000, 4)
+        ]),
+    ]
+
+
+def random_sequence(rng, length):
+    beacons = [friendly_number for friendly_number, _, _ in BEACONS] + [UNKNOWN_BEACON]
+    tags = list(TAGS) + [UNKNOWN_TAG]
+    counters = {tag: rng.randrange(256) for tag in tags}
+    sequence = []
+    for _ in range(length):
+        tag = rng.choice(tags)
+        roll = rng.random()
+        if roll < 0.02:
+            sequence.append(None)
+            continue
+        if roll > 0.15:  # otherwise a duplicate of the last packet counter
+            counters[tag] = (counters[tag] + 1) % 256
+        sequence.append(advertisement(
+            tag, rng.choice(beacons), counters[tag],
+            voltage=rng.choice((rng.randrange(0, BATTERY_MAX_MILLIVOLTS + 1), 3700)) if roll < 0.05 else 3000,
+            packet_type=0x02 if roll < 0.03 else PRESENCE_PACKET,
+            tlm=not (0.03 <= roll < 0.04)
+        ))
+    return sequence
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Check that all ingest strategies take the same decisions")
+    parser.add_argument("--random", type=int, default=20, help="random sequences to check")
+    parser.add_argument("--length", type=int, default=300, help="advertisements per random sequence")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    pool = ConnectionPool(
+        conninfo=get_env("DATABASE_URL"),
+        min_size=1,
+        max_size=2,
+        timeout=30.0,
+        configure=lambda conn: setattr(conn, 'row_factory', dict_row)
+    )
+    rng = random.Random(args.seed)
+    results = []
+    for name, sequence in scenarios():
+        results.append(check(pool, name, sequence))
+    for i in range(args.random):
+        sequence = random_sequence(rng, args.length)
+        # Odd sequences are applied one advertisement per transaction, even ones in batches
+        batch_size = 1 if i % 2 else rng.choice((7, 50, args.length))
+        results.append(check(pool, f"random sequence {i + 1} (batches of {batch_size})", sequence, batch_size))
+    reset_fixture(pool)
+    pool.close()
+
+    print(f"{results.count(True)}/{len(results)} sequences match")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
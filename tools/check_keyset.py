@@ -0,0 +1,73 @@
+"""Keyset pagination check
+Purpose: pages the tag table through server.get_filtered_data, the way the infinite scroll does, with pages of every
+size from 1 to the number of fixture tags, and checks that every tag comes exactly once and in the order of the
+table. The fixture tags share fractional battery levels across the page boundaries, and some have none: a cursor
+whose sort value doesn't compare equal to the stored one (a float8 parameter against the REAL column) leaves out the
+tags after it with the same level.
+
+Usage: python -m tools.check_keyset
+Run it with the environment of the backend (FLASK_ENV, DATABASE_URL, SECRET_KEY), on a scratch database with the
+migrations applied. The check creates its own tags (MAC addresses starting with CA5E) and deletes them at the end.
+"""
+
+import sys
+
+import server
+
+MAC_PREFIX = "CA5E"
+
+# Battery levels of the fixture tags, in id order
+BATTERIES = [45.3, 45.3, 12.7, 45.3, None, 45.3, 12.7, 45.3, 99.9, None, 45.3, 12.7, 0.1]
+
+
+def create_fixture(pool):
+    with pool.connection() as conn:
+        conn.execute("DELETE FROM tag WHERE mac_address LIKE %s", (f"{MAC_PREFIX}%",))
+        return [
+            conn.execute(
+                "INSERT INTO tag (mac_address, remaining_battery) VALUES (%s, %s) RETURNING id",
+                (f"{MAC_PREFIX}{number:08X}", battery)
+            ).fetchone()["id"]
+            for number, battery in enumerate(BATTERIES)
+        ]
+
+
+def expected_order(ids):
+    # Battery ascending with no battery last, then id, like keyset_order
+    batteries = dict(zip(ids, BATTERIES))
+    return sorted(ids, key=lambda tag_id: (batteries[tag_id] is None, batteries[tag_id] or 0, tag_id))
+
+
+def page_through(page_size):
+    filters = {"vacant": "1", "tag_name": MAC_PREFIX}
+    ids = []
+    cursor = None
+    while True:
+        items, _, cursor = server.get_filtered_data("tag", filters, cursor, page_size=page_size)
+        ids.extend(item["id"] for item in items)
+        if cursor is None or len(ids) > len(BATTERIES):
+            return ids
+
+
+def main():
+    ids = create_fixture(server.db_pool)
+    try:
+        expected = expected_order(ids)
+        failures = 0
+        for page_size in range(1, len(BATTERIES) + 1):
+            paged = page_through(page_size)
+            if paged == expected:
+                print(f"ok   pages of {page_size}")
+            else:
+                failures += 1
+                missing = [tag_id for tag_id in expected if tag_id not in paged]
+                print(f"FAIL pages of {page_size}: {len(paged)} tags, missing {missing}")
+        print(f"{len(BATTERIES) - failures}/{len(BATTERIES)} page sizes match")
+        return 1 if failures else 0
+    finally:
+        with server.db_pool.connection() as conn:
+            conn.execute("DELETE FROM tag WHERE mac_address LIKE %s", (f"{MAC_PREFIX}%",))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
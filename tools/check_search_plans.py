@@ -0,0 +1,130 @@
+"""Substring search plans check
+Purpose: EXPLAINs the substring searches of the search and filter endpoints and of the table filters, written the
+way server.py runs them, and checks that each one is served by its trigram index from
+migrations/004_trigram_search_indexes.sql. Sequential scans are disabled while checking: on a small database the
+planner rightly prefers reading the whole table, what is checked here is that the query as written can use the
+index at all (a LOWER(name) LIKE condition, for instance, can't).
+
+Usage: python -m tools.check_search_plans [--query TEXT] [--verbose]
+DATABASE_URL has to point to a database with the migrations applied. The trigram indexes only help with queries of
+at least 3 characters, shorter ones read the whole index.
+"""
+
+import argparse
+import json
+import os
+import sys
+
+import psycopg
+
+# (what runs the query, query with one %s for the pattern, index expected in the plan)
+CHECKS = [
+    ("/api/ships/search, /api/ships/filter",
+     "SELECT id, name FROM ship WHERE name ILIKE %s ORDER BY name LIMIT 10",
+     "idx_ship_name_trgm"),
+    ("/api/roles/search, /api/roles/filter",
+     "SELECT id, role_name FROM crew_member_roles WHERE role_name ILIKE %s ORDER BY role_name LIMIT 10",
+     "idx_crew_member_roles_role_name_trgm"),
+    ("/api/crew/search",
+     "SELECT id, name FROM crew_member WHERE name ILIKE %s ORDER BY name LIMIT 10",
+     "idx_crew_member_name_trgm"),
+    ("/api/shipyards/search, /api/shipyards/filter",
+     "SELECT id, name FROM shipyard WHERE name ILIKE %s ORDER BY name LIMIT 10",
+     "idx_shipyard_name_trgm"),
+    ("/api/tags/search",
+     """SELECT t.id, t.mac_address as name
+        FROM tag t
+        WHERE t.mac_address ILIKE %s
+          AND t.id NOT IN (SELECT tag_id FROM crew_member WHERE tag_id IS NOT NULL)
+        ORDER BY t.mac_address LIMIT 10""",
+     "idx_tag_mac_address_trgm"),
+    ("/crew crew_name filter",
+     """SELECT COUNT(*)
+        FROM crew_member cm
+        LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+        LEFT JOIN ship s ON cm.ship_id = s.id
+        LEFT JOIN tag t ON cm.tag_id = t.id
+        WHERE 1=1 AND cm.name ILIKE %s""",
+     "idx_crew_member_name_trgm"),
+    ("/crew ship_name filter",
+     """SELECT COUNT(*)
+        FROM crew_member cm
+        LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+        LEFT JOIN ship s ON cm.ship_id = s.id
+        LEFT JOIN tag t ON cm.tag_id = t.id
+        WHERE 1=1 AND s.name ILIKE %s""",
+     "idx_ship_name_trgm"),
+    ("/navi ship_name filter",
+     "SELECT COUNT(*) FROM ship WHERE 1=1 AND name ILIKE %s",
+     "idx_ship_name_trgm"),
+    ("/tag tag_name filter",
+     """SELECT COUNT(*)
+        FROM tag t
+        LEFT JOIN crew_member cm ON t.id = cm.tag_id
+        WHERE 1=1 AND t.mac_address ILIKE %s""",
+     "idx_tag_mac_address_trgm"),
+    ("/entry tag_name filter",
+     """SELECT COUNT(*)
+        FROM unassigned_tag_entry ute
+        JOIN tag t ON ute.tag_id = t.id
+        JOIN shipyard s ON ute.shipyard_id = s.id
+        WHERE 1=1 AND t.mac_address ILIKE %s""",
+     "idx_tag_mac_address_trgm"),
+    ("/log crew_name filter",
+     """SELECT COUNT(*)
+        FROM permanence_log pl
+        JOIN crew_member cm ON pl.crew_member_id = cm.id
+        JOIN shipyard s ON pl.shipyard_id = s.id
+        LEFT JOIN crew_member_roles cr ON cm.role_id = cr.id
+        LEFT JOIN ship ship ON cm.ship_id = ship.id
+        LEFT JOIN tag current_tag ON cm.tag_id = current_tag.id
+        WHERE 1=1 AND cm.name ILIKE %s""",
+     "idx_crew_member_name_trgm"),
+]
+
+
+def get_env(env_var: str):
+    ret = os.getenv(env_var)
+    if not ret:
+        raise Exception(f"{env_var} not found")
+    return ret
+
+
+def plan_indexes(plan):
+    """Names of the indexes used anywhere in a JSON plan node"""
+    indexes = set()
+    if "Index Name" in plan:
+        indexes.add(plan["Index Name"])
+    for child in plan.get("Plans", []):
+        indexes |= plan_indexes(child)
+    return indexes
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Check that the substring searches use the trigram indexes")
+    parser.add_argument("--query", default="mar", help="text searched, as typed in a filter")
+    parser.add_argument("--verbose", action="store_true", help="print every plan")
+    args = parser.parse_args(argv)
+
+    results = []
+    with psycopg.connect(get_env("DATABASE_URL")) as conn:
+        conn.execute("SET enable_seqscan = off")
+        for name, query, index in CHECKS:
+            plan = conn.execute(f"EXPLAIN (FORMAT JSON) {query}", (f"%{args.query}%",)).fetchone()[0]
+            if isinstance(plan, str):
+                plan = json.loads(plan)
+            used = plan_indexes(plan[0]["Plan"])
+            ok = index in used
+            results.append(ok)
+            print(f"{'ok  ' if ok else 'FAIL'} {name}: {index} {'used' if ok else 'not used'}")
+            if args.verbose or not ok:
+                for line in conn.execute(f"EXPLAIN {query}", (f"%{args.query}%",)).fetchall():
+                    print(f"     {line[0]}")
+        conn.rollback()
+
+    print(f"{results.count(True)}/{len(results)} searches use their index")
+    return 0 if all(results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,402 @@
+"""Synthetic gateway load generator
+Purpose: produces realistic gateway traffic for /gateway-endpoint and measures how the ingest path copes with it.
+Tags belong to a shipyard and walk through its activator beacon pair (first beacon, then second beacon when entering
+and the other way around when leaving), most of them in bursts around the two shift changes and the rest at random
+times in between. On top of that, some advertisements are sent twice (gateway retries and repeated scans) and some
+are heard by a beacon of another shipyard (cross-yard noise). The traffic is sent one scan tick at a time: all the
+gateway POSTs of a tick run concurrently, and the next tick starts when they have all been answered, so the
+advertisements of a tag always reach the server in order.
+
+At the end it prints throughput, request latency percentiles, and the permanence_log and unassigned_tag_entry rows
+created during the run next to the ones the simulated walks should have produced.
+
+Usage:
+    python -m tools.loadgen --setup [--tags N] [--shipyards N] [--assigned FRACTION]
+    python -m tools.loadgen [--url URL] [--ticks N] [--gateways-per-shipyard N] [--batch N] [--duplicates P]
+                            [--noise P] [--trickle P] [--tick-seconds S] [--format json|frames] [--gzip] [--seed N]
+    python -m tools.loadgen --cleanup
+DATABASE_URL has to point to the same database the server uses. The synthetic shipyards, beacons, tags and crew are
+created by --setup (friendly numbers from 9000, MAC addresses starting with FEED) and removed by --cleanup. Every
+run continues the packet counters stored in the tag table, and waits until the server has written its final ones
+back before reporting, so that runs can follow each other against the same server.
+"""
+
+import argparse
+import gzip
+import json
+import os
+import random
+import statistics
+import sys
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import psycopg
+import requests
+
+from gatekeeper.framing import encode_frames, FRAMES_CONTENT_TYPE
+
+BEACON_BASE_NUMBER = 9000
+MAC_PREFIX = "FEED"
+NAME_PREFIX = "Loadgen"
+GATEWAY_HEADER = "0201061AFF4C0001"
+GATEWAY_HEADER_SIZE = len(GATEWAY_HEADER) // 2
+PRESENCE_PACKET = 0x03
+TLM_FLAG = 0x04
+
+
+def get_env(env_var: str):
+    ret = os.getenv(env_var)
+    if not ret:
+        raise Exception(f"{env_var} not found")
+    return ret
+
+
+# ===== DATASET =====
+
+def setup(conn, tags, shipyards, assigned):
+    with conn.transaction():
+        ship_id = get_or_create(conn, "ship", "name", f"{NAME_PREFIX} ship")
+        role_id = get_or_create(conn, "crew_member_roles", "role_name", f"{NAME_PREFIX} role")
+
+        for yard in range(shipyards):
+            shipyard_id = get_or_create(conn, "shipyard", "name", f"{NAME_PREFIX} {yard + 1}")
+            for offset, is_first_when_entering in ((0, True), (1, False)):
+                # The beacon limit trigger fires before ON CONFLICT is considered, so existing beacons are skipped here
+                conn.execute("""
+                    INSERT INTO activator_beacon (friendly_number, shipyard_id, is_first_when_entering)
+                    SELECT %(number)s, %(shipyard_id)s, %(first)s
+                    WHERE NOT EXISTS (SELECT 1 FROM activator_beacon WHERE friendly_number = %(number)s)
+                """, {
+                    "number": BEACON_BASE_NUMBER + yard * 2 + offset,
+                    "shipyard_id": shipyard_id,
+                    "first": is_first_when_entering
+                })
+
+        for i in range(tags):
+            tag_id = conn.execute("""
+                INSERT INTO tag (mac_address, remaining_battery)
+                VALUES (%s, 100)
+                ON CONFLICT (mac_address) DO UPDATE SET mac_address = EXCLUDED.mac_address
+                RETURNING id
+            """, (f"{MAC_PREFIX}{i:08X}",)).fetchone()[0]
+            if i < tags * assigned:
+                conn.execute("""
+                    INSERT INTO crew_member (name, role_id, ship_id, tag_id)
+                    VALUES (%s, %s, %s, %s)
+                    ON CONFLICT (tag_id) DO NOTHING
+                """, (f"{NAME_PREFIX} {i + 1}", role_id, ship_id, tag_id))
+    print(f"{tags} tags ({int(tags * assigned)} assigned) over {shipyards} shipyards ready")
+
+
+def get_or_create(conn, table, column, value):
+    row = conn.execute(f"SELECT id FROM {table} WHERE {column} = %s ORDER BY id LIMIT 1", (value,)).fetchone()
+    if row:
+        return row[0]
+    return conn.execute(f"INSERT INTO {table} ({column}) VALUES (%s) RETURNING id", (value,)).fetchone()[0]
+
+
+def cleanup(conn):
+    with conn.transaction():
+        conn.execute("""
+            DELETE FROM crew_member
+            WHERE tag_id IN (SELECT id FROM tag WHERE mac_address LIKE %s)
+        """, (f"{MAC_PREFIX}%",))
+        conn.execute("DELETE FROM tag WHERE mac_address LIKE %s", (f"{MAC_PREFIX}%",))
+        conn.execute("DELETE FROM activator_beacon WHERE friendly_number >= %s", (BEACON_BASE_NUMBER,))
+        conn.execute("DELETE FROM shipyard WHERE name LIKE %s", (f"{NAME_PREFIX} %",))
+        conn.execute("DELETE FROM ship WHERE name = %s", (f"{NAME_PREFIX} ship",))
+        conn.execute("DELETE FROM crew_member_roles WHERE role_name = %s", (f"{NAME_PREFIX} role",))
+    print("Synthetic dataset removed")
+
+
+def load_dataset(conn):
+    beacons = conn.execute("""
+        SELECT friendly_number, shipyard_id, is_first_when_entering
+        FROM activator_beacon
+        WHERE friendly_number >= %s
+        ORDER BY friendly_number
+    """, (BEACON_BASE_NUMBER,)).fetchall()
+    pairs = {}
+    for friendly_number, shipyard_id, is_first_when_entering in beacons:
+        pairs.setdefault(shipyard_id, {})["first" if is_first_when_entering else "second"] = friendly_number
+    pairs = {shipyard_id: pair for shipyard_id, pair in pairs.items() if len(pair) == 2}
+
+    tags = conn.execute("""
+        SELECT t.mac_address, t.packet_counter, cm.id IS NOT NULL
+        FROM tag t
+        LEFT JOIN crew_member cm ON cm.tag_id = t.id
+        WHERE t.mac_address LIKE %s
+        ORDER BY t.mac_address
+    """, (f"{MAC_PREFIX}%",)).fetchall()
+    return pairs, tags
+
+
+def outcome_counts(conn, shipyard_ids):
+    return conn.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM permanence_log WHERE shipyard_id = ANY(%(ids)s)),
+            (SELECT COUNT(*) FROM permanence_log WHERE shipyard_id = ANY(%(ids)s) AND leave_timestamp IS NOT NULL),
+            (SELECT COUNT(*) FROM unassigned_tag_entry WHERE shipyard_id = ANY(%(ids)s))
+    """, {"ids": list(shipyard_ids)}).fetchone()
+
+
+# ===== SIMULATION =====
+
+class SimulatedTag:
+    def __init__(self, mac_address, packet_counter, is_assigned, shipyard_id):
+        self.mac_address = mac_address
+        self.packet_counter = packet_counter if packet_counter is not None else 0
+        self.is_assigned = is_assigned
+        self.shipyard_id = shipyard_id
+
+    def advertisement(self, beacon_number, rng):
+        self.packet_counter = (self.packet_counter + 1) % 256
+        return (
+            f"{GATEWAY_HEADER}{beacon_number:04X}{PRESENCE_PACKET:02X}{self.packet_counter:02X}{self.mac_address}"
+            f"{rng.randint(0xA0, 0xD0):02X}{TLM_FLAG:02X}{rng.randint(2600, 3600):04X}"
+        )
+
+
+def simulate(pairs, tags, args, rng):
+    """
+    Return the device payloads heard by every shipyard at every tick, the movements the walks should produce and
+    the last packet counter of every tag. Each tag enters once and leaves once: around the shift changes, or at
+    random ticks for the trickle.
+    """
+    shipyard_ids = sorted(pairs)
+    ticks = [dict() for _ in range(args.ticks)]  # tick -> shipyard -> payloads
+    expected = {"entries": 0, "exits": 0, "unassigned": 0}
+    first_shift, second_shift = args.ticks // 10, args.ticks * 6 // 10
+    burst = max(1, args.ticks // 20)
+
+    def hear(tick, shipyard_id, payload):
+        payloads = ticks[tick].setdefault(shipyard_id, [])
+        payloads.append(payload)
+        if rng.random() < args.duplicates:
+            payloads.append(payload)
+
+    simulated = []
+    final_counters = {}
+    for index, (mac_address, packet_counter, is_assigned) in enumerate(tags):
+        tag = SimulatedTag(mac_address, packet_counter, is_assigned, shipyard_ids[index % len(shipyard_ids)])
+        if rng.random() < args.trickle:
+            enter_at = rng.randrange(0, args.ticks // 2 - 1)
+            leave_at = rng.randrange(args.ticks // 2, args.ticks - 1)
+        else:
+            enter_at = first_shift + rng.randrange(burst)
+            leave_at = second_shift + rng.randrange(burst)
+        simulated.append((tag, enter_at, leave_at))
+
+    for tag, enter_at, leave_at in simulated:
+        pair = pairs[tag.shipyard_id]
+        busy = {enter_at, enter_at + 1, leave_at, leave_at + 1}
+
+        # Noise is only heard by first beacons: two of them never make a valid pair, not even across runs,
+        # and a walk always starts from a beacon of the tag's own shipyard
+        other_yards = [shipyard_id for shipyard_id in shipyard_ids if shipyard_id != tag.shipyard_id]
+        noise_at = {}
+        if other_yards:
+            for start, end in ((0, enter_at), (enter_at + 2, leave_at), (leave_at + 2, args.ticks)):
+                if end > start and rng.random() < args.noise:
+                    noise_at[rng.randrange(start, end)] = rng.choice(other_yards)
+
+        for tick in range(args.ticks):
+            if tick == enter_at:
+                hear(tick, tag.shipyard_id, tag.advertisement(pair["first"], rng))
+            elif tick == enter_at + 1:
+                hear(tick, tag.shipyard_id, tag.advertisement(pair["second"], rng))
+            elif tick == leave_at:
+                hear(tick, tag.shipyard_id, tag.advertisement(pair["second"], rng))
+            elif tick == leave_at + 1:
+                hear(tick, tag.shipyard_id, tag.advertisement(pair["first"], rng))
+            elif tick in noise_at and tick not in busy:
+                hear(tick, noise_at[tick], tag.advertisement(pairs[noise_at[tick]]["first"], rng))
+
+        final_counters[tag.mac_address] = tag.packet_counter
+        if tag.is_assigned:
+            expected["entries"] += 1
+            expected["exits"] += 1
+        else:
+            expected["unassigned"] += 2
+
+    return ticks, expected, final_counters
+
+
+def gateway_requests(tick_payloads, tick, args):
+    """
+    Split the payloads heard by each shipyard in a tick over its gateways, in batches of args.batch.
+    Returns (devices, body, headers) for every request.
+    """
+    encoded = []
+    for shipyard_payloads in tick_payloads.values():
+        for gateway in range(args.gateways_per_shipyard):
+            payloads = shipyard_payloads[gateway::args.gateways_per_shipyard]
+            for start in range(0, len(payloads), args.batch):
+                batch = payloads[start:start + args.batch]
+                if args.format == "frames":
+                    body = encode_frames((tick + 1, bytes.fromhex(payload)[GATEWAY_HEADER_SIZE:]) for payload in batch)
+                    headers = {"Content-Type": FRAMES_CONTENT_TYPE}
+                else:
+                    body = json.dumps({"data": {"value": {"device_list": [
+                        {"data": payload, "scan_time": tick + 1} for payload in batch
+                    ]}}}).encode()
+                    headers = {"Content-Type": "application/json"}
+                if args.gzip:
+                    body = gzip.compress(body)
+                    headers["Content-Encoding"] = "gzip"
+                encoded.append((len(batch), body, headers))
+    return encoded
+
+
+# ===== REPLAY =====
+
+def replay(ticks, args):
+    local = threading.local()
+    latencies = []
+    failures = {}
+    lock = threading.Lock()
+
+    def post(request):
+        _, body, headers = request
+        session = getattr(local, "session", None)
+        if session is None:
+            session = local.session = requests.Session()
+        while True:
+            started = time.perf_counter()
+            try:
+                response = session.post(args.url, data=body, headers=headers, timeout=60)
+                status = response.status_code
+            except requests.RequestException as e:
+                status = type(e).__name__
+            elapsed = time.perf_counter() - started
+            with lock:
+                latencies.append(elapsed)
+                if status not in (200, 202):
+                    failures[status] = failures.get(status, 0) + 1
+            # The async and sharded modes answer 503 when their queue is full
+            if status != 503:
+                return
+            time.sleep(float(response.headers.get("Retry-After", "1")))
+
+    advertisements = 0
+    requests_sent = 0
+    bytes_sent = 0
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        for tick, tick_payloads in enumerate(ticks):
+            tick_started = time.perf_counter()
+            tick_requests = gateway_requests(tick_payloads, tick, args)
+            list(executor.map(post, tick_requests))
+            requests_sent += len(tick_requests)
+            advertisements += sum(devices for devices, _, _ in tick_requests)
+            bytes_sent += sum(len(body) for _, body, _ in tick_requests)
+            if args.tick_seconds:
+                time.sleep(max(0.0, args.tick_seconds - (time.perf_counter() - tick_started)))
+    elapsed = time.perf_counter() - started
+    return advertisements, requests_sent, bytes_sent, elapsed, latencies, failures
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(p / 100 * (len(ordered) - 1))))]
+
+
+def unwritten_counters(conn, final_counters):
+    return conn.execute("""
+        SELECT COUNT(*)
+        FROM tag t
+        JOIN unnest(%s::varchar[], %s::smallint[]) AS v(mac_address, packet_counter) ON v.mac_address = t.mac_address
+        WHERE t.packet_counter IS DISTINCT FROM v.packet_counter
+    """, (list(final_counters), list(final_counters.values()))).fetchone()[0]
+
+
+def wait_until_settled(conn, shipyard_ids, final_counters, max_seconds):
+    """
+    The async and sharded modes answer before processing, and tag states are written back later: wait until
+    the counts stop moving and the last packet counters are in the tag table.
+    Returns the counts and how many tags still have an older packet counter.
+    """
+    deadline = time.monotonic() + max_seconds
+    last = outcome_counts(conn, shipyard_ids)
+    while True:
+        unwritten = unwritten_counters(conn, final_counters)
+        if time.monotonic() >= deadline:
+            return last, unwritten
+        time.sleep(1.0)
+        current = outcome_counts(conn, shipyard_ids)
+        if current == last and not unwritten:
+            return current, unwritten
+        last = current
+
+
+def run(conn, args):
+    pairs, tags = load_dataset(conn)
+    if not pairs or not tags:
+        raise Exception("No synthetic shipyards or tags found, run with --setup first")
+
+    rng = random.Random(args.seed)
+    ticks, expected, final_counters = simulate(pairs, tags, args, rng)
+    before = outcome_counts(conn, pairs)
+
+    print(f"{len(tags)} tags, {len(pairs)} shipyards, {args.ticks} ticks -> {args.url}")
+    advertisements, requests_sent, bytes_sent, elapsed, latencies, failures = replay(ticks, args)
+    after, unwritten = wait_until_settled(conn, pairs, final_counters, args.settle)
+
+    logs, closed_logs, unassigned = (a - b for a, b in zip(after, before))
+    print(f"requests            {requests_sent} in {elapsed:.2f} s ({requests_sent / elapsed:.1f}/s)")
+    print(f"advertisements      {advertisements} ({advertisements / elapsed:.1f}/s)")
+    print(f"request bodies      {bytes_sent} bytes ({bytes_sent / max(advertisements, 1):.1f} bytes/advertisement)")
+    print(f"latency mean        {statistics.fmean(latencies) * 1000:.1f} ms" if latencies else "latency mean        -")
+    for p in (50, 95, 99):
+        print(f"latency p{p}".ljust(20) + f"{percentile(latencies, p) * 1000:.1f} ms")
+    if failures:
+        print(f"failed requests     {failures}")
+    print(f"permanence_log      {logs} opened (expected {expected['entries']}), {closed_logs} closed (expected {expected['exits']})")
+    print(f"unassigned entries  {unassigned} (expected {expected['unassigned']})")
+    if unwritten:
+        print(f"{unwritten} tags don't have their last packet counter in the tag table yet, the next run may differ")
+
+    if (logs, closed_logs, unassigned) != (expected["entries"], expected["exits"], expected["unassigned"]):
+        print("Outcome counts differ from the simulated walks")
+        return 1
+    return 0
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Synthetic gateway load generator")
+    parser.add_argument("--setup", action="store_true", help="create or reset the synthetic dataset")
+    parser.add_argument("--cleanup", action="store_true", help="remove the synthetic dataset")
+    parser.add_argument("--tags", type=int, default=4000)
+    parser.add_argument("--shipyards", type=int, default=4)
+    parser.add_argument("--assigned", type=float, default=0.9, help="fraction of tags assigned to a crew member")
+    parser.add_argument("--url", default=f"http://127.0.0.1:{os.getenv('FLASK_PORT', '5000')}/gateway-endpoint")
+    parser.add_argument("--ticks", type=int, default=120, help="scan ticks to simulate")
+    parser.add_argument("--tick-seconds", type=float, default=0.0, help="pace the ticks, 0 sends as fast as possible")
+    parser.add_argument("--gateways-per-shipyard", type=int, default=2)
+    parser.add_argument("--batch", type=int, default=50, help="devices per gateway POST")
+    parser.add_argument("--concurrency", type=int, default=16, help="concurrent POSTs")
+    parser.add_argument("--duplicates", type=float, default=0.2, help="probability an advertisement is sent twice")
+    parser.add_argument("--noise", type=float, default=0.05, help="probability of a cross-yard advertisement between walks")
+    parser.add_argument("--trickle", type=float, default=0.2, help="fraction of tags walking outside the shift bursts")
+    parser.add_argument("--settle", type=float, default=30.0, help="seconds to wait for queued ingest to finish")
+    parser.add_argument("--format", choices=("json", "frames"), default="json", help="gateway message format")
+    parser.add_argument("--gzip", action="store_true", help="gzip the request bodies")
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(get_env("DATABASE_URL"), autocommit=True) as conn:
+        if args.cleanup:
+            cleanup(conn)
+            return 0
+        if args.setup:
+            setup(conn, args.tags, args.shipyards, args.assigned)
+            return 0
+        return run(conn, args)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
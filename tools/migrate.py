@@ -0,0 +1,52 @@
+"""Schema migrations runner
+Purpose: applies the SQL files in the migrations folder, in file name order, to the database in DATABASE_URL.
+Every applied file is recorded in the schema_migration table, so running this again only applies the new ones.
+
+Usage: python -m tools.migrate [--list]
+Run it as the owner of the schema: the application user created in DESIGN-DOCUMENT.md can't create objects.
+"""
+
+import os
+import sys
+import psycopg
+
+MIGRATIONS_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "migrations")
+
+
+def get_env(env_var: str):
+    ret = os.getenv(env_var)
+    if not ret:
+        raise Exception(f"{env_var} not found")
+    return ret
+
+
+def migration_files():
+    return sorted(name for name in os.listdir(MIGRATIONS_DIR) if name.endswith(".sql"))
+
+
+def main(argv):
+    with psycopg.connect(get_env("DATABASE_URL"), autocommit=True) as conn:
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS schema_migration (
+                name VARCHAR(255) PRIMARY KEY,
+                applied_at TIMESTAMP NOT NULL DEFAULT NOW()
+            )
+        """)
+        applied = {row[0] for row in conn.execute("SELECT name FROM schema_migration").fetchall()}
+
+        for name in migration_files():
+            if "--list" in argv:
+                print(f"{'applied' if name in applied else 'pending'} {name}")
+                continue
+            if name in applied:
+                continue
+            with open(os.path.join(MIGRATIONS_DIR, name), encoding="utf-8") as f:
+                script = f.read()
+            print(f"Applying {name}")
+            with conn.transaction():
+                conn.execute(script)
+                conn.execute("INSERT INTO schema_migration (name) VALUES (%s)", (name,))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
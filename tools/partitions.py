@@ -0,0 +1,98 @@
+"""Event table partitions tool
+Purpose: manages the monthly partitions of permanence_log and unassigned_tag_entry from the command line, for cron
+or by hand: lists them with their estimated rows, creates the ones of the coming months, detaches the expired ones
+into the event_archive schema, and exports the archived ones to gzipped CSV files before dropping them. The backend
+already creates the coming months and detaches the expired ones by itself (PARTITION_MONTHS_AHEAD and
+RETENTION_MONTHS), the export is only done here.
+
+Usage: python -m tools.partitions [--create MONTHS_AHEAD] [--retention MONTHS] [--export DIR] [--list]
+Run it as the owner of the schema, like tools.migrate. Every archived table is written to DIR/<table>.csv.gz, with
+a header row, and dropped only once the file is complete; the files can be loaded back with COPY ... (FORMAT csv,
+HEADER) into a table created LIKE the event table.
+"""
+
+import argparse
+import gzip
+import os
+import sys
+
+import psycopg
+from psycopg import sql
+
+EVENT_TABLES = ("permanence_log", "unassigned_tag_entry")
+ARCHIVE_SCHEMA = "event_archive"
+
+
+def get_env(env_var: str):
+    ret = os.getenv(env_var)
+    if not ret:
+        raise Exception(f"{env_var} not found")
+    return ret
+
+
+def list_partitions(conn):
+    rows = conn.execute("""
+        SELECT parent.relname, child.relname, pg_get_expr(child.relpartbound, child.oid), child.reltuples::bigint
+        FROM pg_inherits
+        JOIN pg_class parent ON parent.oid = pg_inherits.inhparent
+        JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+        WHERE parent.relnamespace = 'public'::regnamespace AND parent.relname = ANY(%s)
+        ORDER BY parent.relname, child.relname
+    """, (list(EVENT_TABLES),)).fetchall()
+    for parent, partition, bound, rows_estimate in rows:
+        print(f"{partition:<32} {bound:<72} {max(rows_estimate, 0):>10} rows")
+    archived = conn.execute("""
+        SELECT relname, reltuples::bigint FROM pg_class
+        WHERE relnamespace = %s::regnamespace AND relkind = 'r'
+        ORDER BY relname
+    """, (ARCHIVE_SCHEMA,)).fetchall()
+    for partition, rows_estimate in archived:
+        print(f"{ARCHIVE_SCHEMA}.{partition:<18} {'archived':<72} {max(rows_estimate, 0):>10} rows")
+
+
+def export_archived(conn, directory):
+    os.makedirs(directory, exist_ok=True)
+    tables = [row[0] for row in conn.execute("""
+        SELECT relname FROM pg_class
+        WHERE relnamespace = %s::regnamespace AND relkind = 'r'
+        ORDER BY relname
+    """, (ARCHIVE_SCHEMA,)).fetchall()]
+    for table in tables:
+        path = os.path.join(directory, f"{table}.csv.gz")
+        if os.path.exists(path):
+            print(f"{path} already exists, {ARCHIVE_SCHEMA}.{table} skipped")
+            continue
+        identifier = sql.Identifier(ARCHIVE_SCHEMA, table)
+        # Written under another name first, so that an interrupted export never looks complete
+        with gzip.open(f"{path}.part", "wb") as f:
+            with conn.cursor().copy(sql.SQL("COPY {} TO STDOUT (FORMAT csv, HEADER)").format(identifier)) as copy:
+                for data in copy:
+                    f.write(data)
+        os.replace(f"{path}.part", path)
+        conn.execute(sql.SQL("DROP TABLE {}").format(identifier))
+        print(f"{ARCHIVE_SCHEMA}.{table} exported to {path} and dropped")
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Manage the monthly partitions of the log and entry tables")
+    parser.add_argument("--create", type=int, metavar="MONTHS_AHEAD", help="create the partitions up to this many months ahead")
+    parser.add_argument("--retention", type=int, metavar="MONTHS", help="detach the partitions older than this many months")
+    parser.add_argument("--export", metavar="DIR", help="export the archived partitions to DIR and drop them")
+    parser.add_argument("--list", action="store_true", help="list the partitions and the archived ones")
+    args = parser.parse_args(argv)
+
+    with psycopg.connect(get_env("DATABASE_URL"), autocommit=True) as conn:
+        if args.create is not None:
+            created = conn.execute("SELECT create_event_partitions(%s)", (args.create,)).fetchone()[0]
+            print(f"{created} partitions created")
+        if args.retention is not None:
+            for row in conn.execute("SELECT detach_event_partitions(%s)", (args.retention,)).fetchall():
+                print(f"{row[0]} detached to {ARCHIVE_SCHEMA}")
+        if args.export:
+            export_archived(conn, args.export)
+        if args.list or not (args.create is not None or args.retention is not None or args.export):
+            list_partitions(conn)
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,116 @@
+"""Advertisement archive replay
+Purpose: pushes the advertisements archived by the gateway endpoint (ARCHIVE_DIR) through the ingest engine again,
+at full speed, to reprocess history after a beacon misconfiguration or to benchmark the ingest logic on real traffic.
+Segments are read through mmap and applied in the order they were received, in batches, with the same beacon
+registry, tag state engine and Ingestor the server uses. The logs and entries get the time every advertisement was
+received by the gateway endpoint, not the time of the replay. The duplicate cache is left out: its time to live is
+measured in wall clock time, which doesn't mean anything at replay speed, and the tag state engine drops the
+duplicates anyway.
+
+Usage: python -m tools.replay_archive ARCHIVE_DIR --database-url URL [--since ISO_TIME] [--until ISO_TIME]
+                                      [--batch N] [--force]
+The database should be a scratch copy: the replay writes logs, unassigned tag entries and tag states into it.
+Replaying into the DATABASE_URL of the server is refused unless --force is given.
+"""
+
+import argparse
+import os
+import sys
+import time
+from datetime import datetime
+
+from psycopg.rows import dict_row
+from psycopg_pool import ConnectionPool
+
+from gatekeeper.archive import read_archive, segment_files
+from gatekeeper.beacons import BeaconRegistry
+from gatekeeper.ingest import Ingestor
+from gatekeeper.tag_state import TagStateEngine, ADVERTISEMENT_ACCEPTED, ADVERTISEMENT_DUPLICATE, ADVERTISEMENT_IGNORED
+
+
+def outcome_rows(pool):
+    with pool.connection() as conn:
+        return conn.execute("""
+            SELECT
+                (SELECT COUNT(*) FROM permanence_log) AS logs,
+                (SELECT COUNT(*) FROM unassigned_tag_entry) AS entries
+        """).fetchone()
+
+
+def main(argv):
+    parser = argparse.ArgumentParser(description="Replay archived gateway advertisements")
+    parser.add_argument("archive_dir")
+    parser.add_argument("--database-url", required=True, help="scratch database to replay into")
+    parser.add_argument("--since", type=datetime.fromisoformat, help="only advertisements received from this time")
+    parser.add_argument("--until", type=datetime.fromisoformat, help="only advertisements received before this time")
+    parser.add_argument("--batch", type=int, default=500, help="advertisements per transaction")
+    parser.add_argument("--force", action="store_true", help="allow replaying into DATABASE_URL")
+    args = parser.parse_args(argv)
+
+    if args.database_url == os.getenv("DATABASE_URL") and not args.force:
+        raise Exception("Refusing to replay into DATABASE_URL, pass --force if this is really a scratch database")
+    if not segment_files(args.archive_dir):
+        raise Exception(f"No archive segments in {args.archive_dir}")
+    since = args.since.timestamp() if args.since else None
+    until = args.until.timestamp() if args.until else None
+
+    pool = ConnectionPool(
+        conninfo=args.database_url,
+        min_size=1,
+        max_size=2,
+        timeout=30.0,
+        configure=lambda conn: setattr(conn, 'row_factory', dict_row)
+    )
+    beacon_registry = BeaconRegistry(pool)
+    tag_state_engine = TagStateEngine(pool, beacon_registry)
+    ingestor = Ingestor(pool, beacon_registry, tag_state_engine)
+    beacon_registry.load()
+    tag_state_engine.load()
+    before = outcome_rows(pool)
+
+    counts = {ADVERTISEMENT_ACCEPTED: 0, ADVERTISEMENT_DUPLICATE: 0, ADVERTISEMENT_IGNORED: 0}
+    replayed = 0
+    read_seconds = 0.0
+    started = time.perf_counter()
+
+    def apply(batch, timestamps):
+        for outcome, count in ingestor.process_advertisements(batch, timestamps).items():
+            counts[outcome] += count
+
+    batch = []
+    timestamps = []
+    read_started = time.perf_counter()
+    for record in read_archive(args.archive_dir):
+        if since is not None and record.received_at < since:
+            continue
+        if until is not None and record.received_at >= until:
+            continue
+        batch.append(record.advertisement())
+        # The scan time is the clock of the gateway, the receipt time the one of the server that wrote the logs
+        timestamps.append(datetime.fromtimestamp(record.received_at))
+        if len(batch) >= args.batch:
+            read_seconds += time.perf_counter() - read_started
+            apply(batch, timestamps)
+            replayed += len(batch)
+            batch = []
+            timestamps = []
+            read_started = time.perf_counter()
+    read_seconds += time.perf_counter() - read_started
+    if batch:
+        apply(batch, timestamps)
+        replayed += len(batch)
+    tag_state_engine.flush(force=True)
+    elapsed = time.perf_counter() - started
+
+    after = outcome_rows(pool)
+    pool.close()
+
+    print(f"advertisements      {replayed} in {elapsed:.2f} s ({replayed / elapsed if elapsed else 0:.1f}/s)")
+    print(f"archive read        {read_seconds:.2f} s")
+    print(f"outcomes            {counts}")
+    print(f"permanence_log      {after['logs'] - before['logs']} new rows")
+    print(f"unassigned entries  {after['entries'] - before['entries']} new rows")
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])